@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of Sonia.compute_energy with and without prefetching of chunks.
+
+A deep SoNNia model is scored on generated sequences tiled up to the
+requested sizes, once evaluating the chunks one after the other
+(prefetch=0) and once preparing them in a background thread, e.g.
+
+    python benchmark_compute_energy.py -n 1000000 -n 10000000
+"""
+from optparse import OptionParser
+import time
+
+import numpy as np
+
+from sonnia.sonnia import SoNNia
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--num_seqs', type='int', action='append', dest='num_seqs', help='number of sequences to score (can be repeated). Default is 1e6 and 1e7.')
+    parser.add_option('--pool_size', type='int', default=int(1e5), dest='pool_size', help='number of distinct generated sequences which are tiled.')
+    parser.add_option('--chunksize', type='int', default=int(1e5), dest='chunksize', help='number of sequences evaluated in a single call to the model.')
+    parser.add_option('--prefetch', type='int', default=1, dest='prefetch', help='number of chunks prepared ahead. Default is 1.')
+    (options, args) = parser.parse_args()
+
+    sizes = options.num_seqs or [int(1e6), int(1e7)]
+
+    qm = SoNNia(pgen_model='humanTRB')
+    pool = qm.generate_sequences_pre(options.pool_size)
+    pool_encoding = qm.encode_data(pool)
+
+    print('num_seqs\tsequential (s)\tpipelined (s)\tspeedup')
+    for num_seqs in sizes:
+        rows = np.resize(np.arange(len(pool)), num_seqs)
+        encoding = pool_encoding[rows]
+
+        start = time.perf_counter()
+        sequential = qm.compute_energy(encoding, options.chunksize, verbose=False, prefetch=0)
+        sequential_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pipelined = qm.compute_energy(
+            encoding, options.chunksize, verbose=False, prefetch=options.prefetch
+        )
+        pipelined_time = time.perf_counter() - start
+
+        if not np.array_equal(sequential, pipelined):
+            raise RuntimeError('The sequential and pipelined energies differ.')
+        print(f'{num_seqs}\t{sequential_time:.1f}\t{pipelined_time:.1f}\t'
+              f'{sequential_time / pipelined_time:.2f}x')
+
+if __name__ == '__main__': main()
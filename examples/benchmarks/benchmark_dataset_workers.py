@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of the epoch time of Sonia.infer_selection against the number of workers.
+
+A SoNNia model is trained for a few epochs on generated sequences, once
+for each number of workers assembling the mini-batches, e.g.
+
+    python benchmark_dataset_workers.py -w 1 -w 2 -w 4
+
+The mini-batches do not depend on the number of workers, so the trained
+weights are checked to be the same.
+"""
+from optparse import OptionParser
+import time
+
+import numpy as np
+
+from sonnia.sonnia import SoNNia
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-w', '--workers', type='int', action='append', dest='workers', help='number of workers (can be repeated). Default is 1, 2 and 4.')
+    parser.add_option('--num_data', type='int', default=int(1e5), dest='num_data', help='number of data sequences.')
+    parser.add_option('--num_gen', type='int', default=int(3e5), dest='num_gen', help='number of gen sequences.')
+    parser.add_option('--batch_size', type='int', default=5000, dest='batch_size', help='size of the mini-batches.')
+    parser.add_option('--epochs', type='int', default=3, dest='epochs', help='number of epochs per run.')
+    parser.add_option('--sampling', type='str', default='unbalanced', dest='sampling', help='sampling of the mini-batches. Default is unbalanced.')
+    parser.add_option('--use_multiprocessing', action='store_true', default=False, dest='use_multiprocessing', help='use processes rather than threads as workers.')
+    (options, args) = parser.parse_args()
+
+    worker_counts = options.workers or [1, 2, 4]
+
+    qm = SoNNia(pgen_model='humanTRB', seed=0)
+    data_seqs = qm.generate_sequences_pre(options.num_data)
+    gen_seqs = qm.generate_sequences_pre(options.num_gen)
+    initial_weights = qm.model.get_weights()
+
+    print('workers\tepoch time (s)\tspeedup')
+    reference = None
+    for workers in worker_counts:
+        # A new model for each run, so that no optimizer state is carried over.
+        qm = SoNNia(pgen_model='humanTRB', seed=0)
+        qm.update_model(add_data_seqs=data_seqs, add_gen_seqs=gen_seqs)
+        qm.model.set_weights(initial_weights)
+        start = time.perf_counter()
+        qm.infer_selection(
+            epochs=options.epochs, batch_size=options.batch_size, seed=0,
+            sampling=options.sampling, workers=workers,
+            use_multiprocessing=options.use_multiprocessing
+        )
+        epoch_time = (time.perf_counter() - start) / options.epochs
+
+        weights = qm.model.get_weights()
+        if reference is None:
+            reference = (epoch_time, weights)
+        elif not all(np.allclose(w, r, atol=1e-5) for w, r in zip(weights, reference[1])):
+            raise RuntimeError(f'The weights trained with {workers} workers differ.')
+        print(f'{workers}\t{epoch_time:.2f}\t{reference[0] / epoch_time:.2f}x')
+
+if __name__ == '__main__': main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark of Sonia.encode_data against the per-sequence find_seq_features loop.
+
+Sequences are drawn once from the default human TRB generative model and
+tiled up to the requested sizes, e.g.
+
+    python benchmark_encoding.py -n 1000000 -n 10000000
+"""
+from optparse import OptionParser
+import time
+
+import numpy as np
+import scipy.sparse as sparse
+
+from sonnia.sonia import Sonia
+
+def encode_legacy(qm, seqs):
+    # The encoding loop used by Sonia.encode_data before vectorization.
+    indices = []
+    indptr = [0]
+    for seq in seqs:
+        specified_features = qm.find_seq_features(seq)
+        indices += specified_features
+        indptr.append(len(specified_features) + indptr[-1])
+    data = np.ones(len(indices), dtype=np.int8)
+    return sparse.csr_array((data, indices, indptr), shape=(len(seqs), len(qm.features)))
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--num_seqs', type='int', action='append', dest='num_seqs', help='number of sequences to encode (can be repeated). Default is 1e6 and 1e7.')
+    parser.add_option('--pool_size', type='int', default=int(1e5), dest='pool_size', help='number of distinct generated sequences which are tiled.')
+    parser.add_option('--gene_features', default='joint_vj', dest='gene_features', help='gene features of the model.')
+    parser.add_option('--processes', type='int', default=1, dest='processes', help='number of encoding worker processes. Default is 1.')
+    parser.add_option('--skip_legacy', action='store_true', dest='skip_legacy', default=False, help='only time the vectorized encoder.')
+    (options, args) = parser.parse_args()
+
+    sizes = options.num_seqs or [int(1e6), int(1e7)]
+
+    qm = Sonia(pgen_model='humanTRB', gene_features=options.gene_features,
+               processes=options.processes)
+    pool = qm.generate_sequences_pre(options.pool_size)
+
+    print('num_seqs\tlegacy (s)\tvectorized (s)\tspeedup')
+    for num_seqs in sizes:
+        seqs = np.resize(pool, (num_seqs, pool.shape[1]))
+
+        start = time.perf_counter()
+        encoding = qm.encode_data(seqs)
+        vectorized_time = time.perf_counter() - start
+
+        if options.skip_legacy:
+            print(f'{num_seqs}\t-\t{vectorized_time:.1f}\t-')
+            continue
+
+        start = time.perf_counter()
+        legacy_encoding = encode_legacy(qm, seqs)
+        legacy_time = time.perf_counter() - start
+
+        legacy_encoding.sort_indices()
+        if (legacy_encoding != encoding).nnz != 0:
+            raise RuntimeError('The vectorized and legacy encodings differ.')
+        print(f'{num_seqs}\t{legacy_time:.1f}\t{vectorized_time:.1f}\t'
+              f'{legacy_time / vectorized_time:.1f}x')
+
+if __name__ == '__main__': main()
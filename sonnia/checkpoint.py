@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checkpoints of Sonia.infer_selection for resuming interrupted training.
+
+A checkpoint is a single .npz file named checkpoint_<epoch>.npz after the
+number of completed epochs. It holds the model weights, the optimizer
+variables and a JSON record of the training state. The record holds the
+random state that shuffled the training set, the seeds and epoch of the
+SoniaDataset plans, and the history of the metrics. Files are written to a
+temporary name and renamed, so a killed process never leaves a truncated
+checkpoint. Only the most recent checkpoints are kept.
+
+Because the mini-batches of an epoch depend only on the dataset seed and
+the epoch number (see SoniaDataset.epoch_plan), training resumed from a
+checkpoint sees the same mini-batches as an uninterrupted run.
+"""
+from __future__ import annotations
+import glob
+import json
+import os
+from typing import *
+
+import keras
+import numpy as np
+from numpy.typing import NDArray
+
+CHECKPOINT_PATTERN = 'checkpoint_{epoch:05d}.npz'
+
+def save_checkpoint(
+    filename: str,
+    model: keras.Model,
+    state: Dict[str, Any]
+) -> None:
+    """
+    Save the weights and optimizer variables of a model with a training state.
+
+    Parameters
+    ----------
+    filename : str
+        The .npz file to write. It is replaced atomically.
+    model : keras.Model
+        The compiled model.
+    state : dict
+        The training state. It must be serializable to JSON.
+    """
+    arrays = {'state': np.array(json.dumps(state))}
+    for idx, weights in enumerate(model.get_weights()):
+        arrays[f'weight_{idx}'] = weights
+    if model.optimizer is not None and model.optimizer.built:
+        for idx, variable in enumerate(model.optimizer.variables):
+            arrays[f'optimizer_{idx}'] = keras.ops.convert_to_numpy(variable)
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as tmp_file:
+        np.savez(tmp_file, **arrays)
+    os.replace(tmp_filename, filename)
+
+def load_checkpoint(
+    path: str,
+    model: keras.Model
+) -> Dict[str, Any]:
+    """
+    Restore the weights and optimizer variables of a model from a checkpoint.
+
+    Parameters
+    ----------
+    path : str
+        A checkpoint file, or a directory whose latest checkpoint is loaded.
+    model : keras.Model
+        The compiled model, with the same structure as the checkpointed one.
+
+    Returns
+    -------
+    dict
+        The training state saved with the checkpoint.
+    """
+    if os.path.isdir(path):
+        filename = latest_checkpoint(path)
+        if filename is None:
+            raise RuntimeError(f'No checkpoint found in {path}.')
+    else:
+        filename = path
+
+    with np.load(filename, allow_pickle=False) as checkpoint:
+        state = json.loads(str(checkpoint['state']))
+        weights = _numbered_arrays(checkpoint, 'weight')
+        optimizer_variables = _numbered_arrays(checkpoint, 'optimizer')
+
+    model_weights = model.get_weights()
+    if (len(weights) != len(model_weights)
+            or any(w.shape != m.shape for w, m in zip(weights, model_weights))):
+        raise ValueError(f'The weights in {filename} do not match the model.')
+    model.set_weights(weights)
+
+    if optimizer_variables:
+        optimizer = model.optimizer
+        if not optimizer.built:
+            optimizer.build(model.trainable_variables)
+        if len(optimizer.variables) != len(optimizer_variables):
+            raise ValueError(f'The optimizer variables in {filename} do not match the model.')
+        for variable, value in zip(optimizer.variables, optimizer_variables):
+            variable.assign(value)
+    return state
+
+def latest_checkpoint(
+    directory: str
+) -> Optional[str]:
+    """Return the checkpoint of a directory with the most epochs, or None."""
+    filenames = checkpoint_files(directory)
+    return filenames[-1] if filenames else None
+
+def checkpoint_files(
+    directory: str
+) -> List[str]:
+    """Return the checkpoints of a directory, ordered by epoch."""
+    return sorted(glob.glob(os.path.join(directory, 'checkpoint_*.npz')))
+
+def _numbered_arrays(
+    checkpoint: Any,
+    prefix: str
+) -> List[NDArray]:
+    num_arrays = sum(key.startswith(prefix + '_') for key in checkpoint.files)
+    return [checkpoint[f'{prefix}_{idx}'] for idx in range(num_arrays)]
+
+class TrainingCheckpoint(keras.callbacks.Callback):
+    """
+    Keras callback saving a checkpoint every few epochs and rotating old ones.
+
+    Attributes
+    ----------
+    directory : str
+        The directory of the checkpoints.
+    state : dict
+        The training state saved with every checkpoint. The keys 'epoch'
+        and 'history' are updated by the callback.
+    history : dict of {str : list of float}
+        The metrics of all epochs, including those before a resume.
+    every : int
+        The number of epochs between checkpoints.
+    keep : int
+        The number of checkpoints kept.
+    """
+    def __init__(
+        self,
+        directory: str,
+        state: Dict[str, Any],
+        history: Optional[Dict[str, List[float]]] = None,
+        every: int = 1,
+        keep: int = 2
+    ) -> None:
+        """
+        Parameters
+        ----------
+        directory : str
+            The directory of the checkpoints. It is created if needed.
+        state : dict
+            The training state saved with every checkpoint.
+        history : dict of {str : list of float}, optional
+            The metrics of the epochs before a resume.
+        every : int, default 1
+            The number of epochs between checkpoints.
+        keep : int, default 2
+            The number of checkpoints kept. Older ones are deleted.
+        """
+        super().__init__()
+        if every < 1 or keep < 1:
+            raise ValueError('every and keep must be positive.')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.state = state
+        self.history = {key: list(values) for key, values in (history or {}).items()}
+        self.every = every
+        self.keep = keep
+
+    def on_epoch_end(
+        self,
+        epoch: int,
+        logs: Optional[Dict[str, float]] = None
+    ) -> None:
+        for key, value in (logs or {}).items():
+            self.history.setdefault(key, []).append(float(value))
+        if (epoch + 1) % self.every != 0:
+            return
+
+        self.state['epoch'] = epoch + 1
+        self.state['history'] = self.history
+        save_checkpoint(
+            os.path.join(self.directory, CHECKPOINT_PATTERN.format(epoch=epoch + 1)),
+            self.model, self.state
+        )
+        for filename in checkpoint_files(self.directory)[:-self.keep]:
+            os.remove(filename)
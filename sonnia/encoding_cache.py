@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""On-disk cache of filtered sequences and their one-hot encodings.
+
+Entries are uncompressed .npz files named by a hash of what produced them:
+the feature list and the sequence array for an encoding, or the pgen model,
+the filter options and the raw input for filtered sequences. The directory is
+bounded in size and the least recently used entries are evicted first.
+"""
+from __future__ import annotations
+import hashlib
+import logging
+import os
+import tempfile
+from typing import *
+
+import numpy as np
+from numpy.typing import NDArray
+import pandas as pd
+import scipy.sparse as sparse
+
+from sonnia.feature_encoder import PaddedEncoding
+
+def hash_features(
+    features: Sequence[Sequence[str]]
+) -> str:
+    """Return a hash of a feature list, e.g. Sonia.features."""
+    digest = hashlib.blake2b(digest_size=16)
+    for feature in features:
+        digest.update('\x1f'.join(feature).encode())
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+def hash_seqs(
+    seqs: Sequence[Sequence[str]] | NDArray[str] | pd.DataFrame | str
+) -> str:
+    """
+    Return a hash of the content of sequences.
+
+    A DataFrame is hashed by its columns and values, and a str is taken to be
+    the path of a csv file whose bytes are hashed. Otherwise, seqs is hashed
+    as an array of str, so a list and an array of the same sequences have the
+    same hash.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(seqs, str):
+        with open(seqs, 'rb') as seqs_file:
+            for block in iter(lambda: seqs_file.read(1 << 24), b''):
+                digest.update(block)
+    elif isinstance(seqs, pd.DataFrame):
+        digest.update(repr(list(seqs.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(seqs, index=False).to_numpy().tobytes())
+    else:
+        seqs = np.asarray(seqs)
+        if seqs.dtype.kind != 'U':
+            seqs = seqs.astype(str)
+        digest.update(f'{seqs.dtype.str}{seqs.shape}'.encode())
+        digest.update(np.ascontiguousarray(seqs).data)
+    return digest.hexdigest()
+
+class EncodingCache(object):
+    """
+    Size-bounded on-disk cache of sequence encodings.
+
+    Attributes
+    ----------
+    cache_dir : str
+        The directory holding the .npz entries.
+    max_bytes : int
+        The largest total size of the entries. The least recently used ones
+        are removed when it is exceeded.
+
+    Methods
+    -------
+    key(*parts)
+        Return the name of the entry for the given parts.
+    load(key)
+        Return the arrays of an entry, or None if it is not cached.
+    save(key, **arrays)
+        Store arrays under a key and evict entries over max_bytes.
+    load_encoding(key)
+        Return a cached csr_array or PaddedEncoding, or None.
+    save_encoding(key, encoding)
+        Store a csr_array or PaddedEncoding.
+    """
+    def __init__(
+        self,
+        cache_dir: str,
+        max_bytes: int = 10 * 2**30
+    ) -> None:
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            The directory of the cache. It is created if it does not exist.
+        max_bytes : int, default 10 GiB
+            The largest total size of the cached files.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(
+        *parts: Any
+    ) -> str:
+        """Return the name of the entry for the given parts (e.g. hashes and options)."""
+        return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+    def _path(
+        self,
+        key: str
+    ) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def load(
+        self,
+        key: str
+    ) -> Optional[Dict[str, NDArray]]:
+        """Return the arrays stored under key, or None if it is not cached."""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f'Ignoring unreadable encoding cache entry {path}: {e}')
+            return None
+        # The modification time orders the entries for eviction.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return arrays
+
+    def save(
+        self,
+        key: str,
+        **arrays: NDArray
+    ) -> None:
+        """Store arrays under key and evict entries until the cache fits in max_bytes."""
+        # Write to a temporary file first so that concurrent readers never
+        # see a partial entry.
+        with tempfile.NamedTemporaryFile(
+            dir=self.cache_dir, suffix='.tmp', delete=False
+        ) as tmp_file:
+            np.savez(tmp_file, **arrays)
+        os.replace(tmp_file.name, self._path(key))
+        self.evict()
+
+    def evict(
+        self
+    ) -> None:
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npz'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def load_encoding(
+        self,
+        key: str
+    ) -> Optional[sparse.csr_array | PaddedEncoding]:
+        """Return the csr_array or PaddedEncoding stored under key, or None."""
+        arrays = self.load(key)
+        if arrays is None:
+            return None
+        shape = tuple(arrays['shape'])
+        if 'idxs' in arrays:
+            return PaddedEncoding(arrays['idxs'], shape[1])
+        data = np.ones(len(arrays['indices']), dtype=np.int8)
+        return sparse.csr_array((data, arrays['indices'], arrays['indptr']), shape=shape)
+
+    def save_encoding(
+        self,
+        key: str,
+        encoding: sparse.csr_array | PaddedEncoding
+    ) -> None:
+        """Store a one-hot csr_array or PaddedEncoding under key."""
+        shape = np.array(encoding.shape, dtype=np.int64)
+        if isinstance(encoding, PaddedEncoding):
+            self.save(key, idxs=encoding.idxs, shape=shape)
+        else:
+            self.save(key, indices=encoding.indices, indptr=encoding.indptr, shape=shape)
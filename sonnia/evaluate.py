@@ -22,10 +22,11 @@ This program will evaluate pgen and ppost of sequences
 
 from __future__ import print_function, division,absolute_import
 import os
+import sys
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 from optparse import OptionParser
 from sonnia.sonnia import SoNNia
-from sonnia.sonia import Sonia
+from sonnia.sonia import SEQ_ROW_BYTES, Sonia
 from sonnia.utils import gene_to_num_str
 import sonnia.sonnia
 
@@ -59,7 +60,9 @@ def main():
     parser.add_option('--Q', '--selection_factor', action='store_true', dest='Q', default=False, help='compute Q')
     parser.add_option('--recompute_productive_norm', '--compute_norm', action='store_true', dest='recompute_productive_norm', default=False, help='recompute productive normalization')
     parser.add_option('--skip_off','--skip_empty_off', action='store_true', dest = 'skip_empty', default=True, help='stop skipping empty or blank sequences/lines (if for example you want to keep line index fidelity between the infile and outfile).')
-    parser.add_option('-s','--chunk_size', type='int',metavar='N', dest='chunck_size', default = mp.cpu_count()*int(5e2), help='Number of sequences to evaluate at each iteration')
+    parser.add_option('-s','--chunk_size', type='int',metavar='N', dest='chunck_size', default = None, help='Number of sequences to evaluate at each iteration. Default is derived from --memory_budget, or is 500 per CPU without it.')
+    parser.add_option('--memory_budget', type='float', metavar='GB', dest='memory_budget', default=None, help='memory in GB that a chunk of sequences may take. Chunk sizes are derived from it and the number of model features.')
+    parser.add_option('--stream', action='store_true', dest='stream', default=False, help='read, filter (with sonnia.utils.filter_seqs) and evaluate the infile (which may be gzip compressed) one chunk at a time instead of loading it in memory. Sequences failing the filters are dropped, so the CDR3, V and J of each sequence are written before its values. Gene masks must be single genes.')
 
     #vj genes
     parser.add_option('--v_in', '--v_mask_index', type='int', metavar='INDEX', dest='V_mask_index', default=1, help='specifies V_masks are found in column INDEX in the input file. Default is 1.')
@@ -173,9 +176,9 @@ def main():
     if delimiter is None: #Default case
         if options.infile_name is None:
             delimiter = '\t'
-        elif infile_name.endswith('.tsv'): #parse TAB separated value file
+        elif infile_name.endswith(('.tsv', '.tsv.gz')): #parse TAB separated value file
             delimiter = '\t'
-        elif infile_name.endswith('.csv'): #parse COMMA separated value file
+        elif infile_name.endswith(('.csv', '.csv.gz')): #parse COMMA separated value file
             delimiter = ','
     else:
         try:
@@ -226,6 +229,12 @@ def main():
     # choose sonia model type
     try: sonia_model=SoNNia(ppost_model=model_folder)
     except: sonia_model=Sonia(ppost_model=model_folder)
+    if options.memory_budget is not None:
+        sonia_model.memory_budget = int(options.memory_budget * 2**30)
+    options.chunck_size = sonia_model.budget_chunksize(
+        'evaluate', sonia_model.energy_row_bytes() + SEQ_ROW_BYTES,
+        mp.cpu_count() * int(5e2), options.chunck_size
+    )
     if options.recompute_productive_norm: 
         print('Recompute productive normalization.')
         sonia_model.norm_productive=pgen_model.compute_regex_CDR3_template_pgen('CX{0,}')
@@ -291,6 +300,44 @@ def main():
             print('Specify and option: --ppost, --pgen or --Q')
 
 
+    elif options.stream:
+        print('Evaluate file in chunks')
+
+        if not (options.ppost or options.Q or options.pgen):
+            print('Specify one option: --ppost, --pgen or --Q')
+            return -1
+
+        csv_kwargs = {'sep': r'\s+' if delimiter is None else delimiter, 'header': None,
+                      'skiprows': lines_to_skip, 'nrows': max_number_of_seqs,
+                      'usecols': [seq_in_index, V_mask_index, J_mask_index]}
+        if comment_delimiter is not None: csv_kwargs['comment'] = comment_delimiter
+        chunks_iter = sonia_model.iter_encode(infile_name, chunksize=options.chunck_size,
+                                              seq_col=seq_in_index, v_col=V_mask_index,
+                                              j_col=J_mask_index, **csv_kwargs)
+
+        if options.outfile_name is not None: outfile = open(options.outfile_name, 'w')
+        else: outfile = sys.stdout
+        columns = ['CDR3', 'V', 'J']
+        if options.ppost: columns += ['Q', 'Pgen', 'Ppost']
+        elif options.Q: columns += ['Q']
+        else: columns += ['Pgen']
+        outfile.write(delimiter_out.join(columns) + '\n')
+
+        for seqs, encoding in tqdm(chunks_iter, disable=options.outfile_name is None):
+            values = []
+            if options.ppost or options.Q:
+                Q = np.exp(-sonia_model.compute_energy(encoding, verbose=False)) / sonia_model.Z
+                values.append(Q)
+            if options.ppost:
+                pgen = sonia_model.compute_all_pgens(seqs) / sonia_model.norm_productive
+                values += [pgen, pgen * Q]
+            elif options.pgen:
+                values.append(sonia_model.compute_all_pgens(seqs))
+            for seq, seq_values in zip(seqs, zip(*values)):
+                outfile.write(delimiter_out.join(list(seq) + [str(x) for x in seq_values]) + '\n')
+
+        if options.outfile_name is not None: outfile.close()
+
     else:
         print('Load file')
 
@@ -0,0 +1,1090 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Vectorized one-hot encoding of sequence features.
+
+The encoder reproduces the features found by Sonia.find_seq_features, but
+works on whole arrays of sequences at once. CDR3 sequences are converted to
+a uint8 code matrix and genes to integer IDs of a sonnia.utils.GeneVocabulary.
+The column of every length, amino acid and gene feature is then read from
+index tables built from the feature dictionary.
+"""
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import multiprocessing as mp
+from typing import *
+
+import numpy as np
+from numpy.typing import NDArray
+import pandas as pd
+import scipy.sparse as sparse
+from tqdm import tqdm
+
+from sonnia.utils import GeneVocabulary
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+# Code given to characters which are not one of the 20 amino acids.
+UNKNOWN_CODE = len(AMINO_ACIDS)
+
+_CODE_TABLE = np.full(128, UNKNOWN_CODE, dtype=np.uint8)
+for _code, _amino_acid in enumerate(AMINO_ACIDS):
+    _CODE_TABLE[ord(_amino_acid)] = _code
+
+class ChainSpec(NamedTuple):
+    """
+    Columns and feature prefixes of one chain of a sequence.
+
+    The gene prefixes replace the leading 'v' or 'j' of
+    sonnia.utils.gene_to_num_str, e.g. 'v_h' + '5-1' for a heavy chain.
+    """
+    cdr3_col: int
+    v_col: int
+    j_col: int
+    length_prefix: str
+    aa_prefix: str
+    v_prefix: str
+    j_prefix: str
+
+SINGLE_CHAIN = (ChainSpec(0, 1, 2, 'l', 'a', 'v', 'j'),)
+PAIRED_CHAINS = (ChainSpec(0, 1, 2, 'l_h', 'a_h', 'v_h', 'j_h'),
+                 ChainSpec(3, 4, 5, 'l_l', 'a_l', 'v_l', 'j_l'))
+# Pairs of (chain index, gene type) combined into across chain features, in
+# the order used by SoniaPaired.find_seq_features.
+PAIRED_CROSS_CHAIN = (((0, 'v'), (1, 'v')), ((0, 'v'), (1, 'j')),
+                      ((0, 'j'), (1, 'v')), ((0, 'j'), (1, 'j')))
+
+def cdr3s_to_codes(
+    cdr3s: Sequence[str]
+) -> Tuple[NDArray[np.uint8], NDArray[np.int64]]:
+    """
+    Convert CDR3 amino acid sequences to a matrix of amino acid codes.
+
+    Parameters
+    ----------
+    cdr3s : sequence of str
+        The CDR3 amino acid sequences.
+
+    Returns
+    -------
+    codes : numpy.ndarray of numpy.uint8
+        Array of shape (len(cdr3s), max CDR3 length). Amino acids are coded
+        by their index in AMINO_ACIDS, other characters and padding by
+        UNKNOWN_CODE.
+    lengths : numpy.ndarray of numpy.int64
+        The length of each CDR3 sequence.
+    """
+    cdr3s = np.ascontiguousarray(np.asarray(cdr3s, dtype=str))
+    lengths = np.char.str_len(cdr3s).astype(np.int64)
+    if len(cdr3s) == 0 or lengths.max() == 0:
+        return np.zeros((len(cdr3s), 0), dtype=np.uint8), lengths
+    unicode_points = cdr3s.view(np.uint32).reshape(len(cdr3s), -1)
+    # The string dtype may be wider than the longest CDR3 (e.g. when the
+    # column is sliced out of an array that also holds gene names).
+    unicode_points = unicode_points[:, :lengths.max()]
+    codes = _CODE_TABLE.take(np.minimum(unicode_points, 127))
+    return codes, lengths
+
+class FeatureEncoder(object):
+    """
+    Vectorized one-hot encoder of the features of a Sonia model.
+
+    The encoder only holds the feature dictionary and lookup tables, so it is
+    cheap to pickle and can be sent to worker processes.
+
+    Attributes
+    ----------
+    feature_dict : dict of {tuple of str : int}
+        The features and their column in the one-hot encoding.
+    num_features : int
+        The number of columns of the encoding.
+    chains : tuple of ChainSpec
+        The chains making up a sequence.
+    cross_chain : tuple
+        Pairs of (chain index, gene type) forming across chain gene features.
+    vocabularies : tuple of sonnia.utils.GeneVocabulary
+        The gene vocabulary of each chain.
+
+    Methods
+    -------
+    gene_ids(seqs)
+        Return the V and J gene IDs of each chain of the sequences.
+    feature_idxs(seqs, gene_ids=None)
+        Return the candidate feature columns of each sequence.
+    encode(seqs, gene_ids=None, chunksize=int(1e5), processes=1, padded=False)
+        One-hot encode sequences into a scipy.sparse.csr_array or a
+        PaddedEncoding.
+    """
+    def __init__(
+        self,
+        feature_dict: Dict[Tuple[str], int],
+        num_features: Optional[int] = None,
+        chains: Sequence[ChainSpec] = SINGLE_CHAIN,
+        cross_chain: Sequence[Tuple[Tuple[int, str], Tuple[int, str]]] = (),
+        vocabularies: Optional[Sequence[GeneVocabulary]] = None
+    ) -> None:
+        self.feature_dict = feature_dict
+        if num_features is None:
+            num_features = len(feature_dict)
+        self.num_features = num_features
+        self.chains = tuple(chains)
+        self.cross_chain = tuple(cross_chain)
+        if vocabularies is None:
+            vocabularies = [GeneVocabulary() for _ in self.chains]
+        self.vocabularies = tuple(vocabularies)
+        self._length_tables = {}
+        self._aa_tables = {}
+        self._gene_tables = {}
+
+    def _length_table(
+        self,
+        prefix: str,
+        max_len: int
+    ) -> NDArray[np.int32]:
+        """Feature columns of the CDR3 lengths 0, ..., max_len (-1 if absent)."""
+        table = self._length_tables.get(prefix)
+        if table is None or len(table) <= max_len:
+            table = np.array(
+                [self.feature_dict.get((f'{prefix}{length}',), -1)
+                 for length in range(max_len + 1)], dtype=np.int32
+            )
+            self._length_tables[prefix] = table
+        return table
+
+    def _aa_table(
+        self,
+        prefix: str,
+        max_len: int
+    ) -> Tuple[NDArray[np.int32], NDArray[np.int32]]:
+        """
+        Feature columns of the amino acids indexed from the left and right.
+
+        The forward table is indexed by (position, code) and the backward table
+        by (distance from the end, code). Row 0 of the backward table and the
+        UNKNOWN_CODE column are -1.
+        """
+        tables = self._aa_tables.get(prefix)
+        if tables is None or tables[0].shape[0] < max_len:
+            fwd = np.full((max_len, UNKNOWN_CODE + 1), -1, dtype=np.int32)
+            bkd = np.full((max_len + 1, UNKNOWN_CODE + 1), -1, dtype=np.int32)
+            for code, amino_acid in enumerate(AMINO_ACIDS):
+                for pos in range(max_len):
+                    fwd[pos, code] = self.feature_dict.get(
+                        (f'{prefix}{amino_acid}{pos}',), -1
+                    )
+                    bkd[pos + 1, code] = self.feature_dict.get(
+                        (f'{prefix}{amino_acid}{-pos - 1}',), -1
+                    )
+            tables = (fwd, bkd)
+            self._aa_tables[prefix] = tables
+        return tables
+
+    def _gene_table(
+        self,
+        chain_idx: int,
+        gene_type: str,
+        prefix: str
+    ) -> Tuple[List[Tuple[str]], NDArray[np.int32]]:
+        """
+        Return the keys and feature columns of the genes of a vocabulary.
+
+        Both are indexed by gene ID. The last entry stands for missing genes
+        (ID -1) and never matches a feature.
+        """
+        num_strs = self.vocabularies[chain_idx].num_strs[gene_type]
+        keys, cols = self._gene_tables.get((chain_idx, gene_type), ([], None))
+        if cols is None or len(keys) != len(num_strs) + 1:
+            # The vocabulary only grows, so the table is extended.
+            keys = keys[:-1] + [(prefix + num_str[1:],)
+                                for num_str in num_strs[len(keys[:-1]):]]
+            keys.append(('',))
+            cols = self._lookup(keys)
+            self._gene_tables[(chain_idx, gene_type)] = (keys, cols)
+        return keys, cols
+
+    def gene_ids(
+        self,
+        seqs: Sequence[Sequence[str]] | NDArray[str]
+    ) -> NDArray[np.int32]:
+        """
+        Return the gene IDs of sequences.
+
+        Parameters
+        ----------
+        seqs : sequence of sequence of str or numpy.ndarray of str
+            The sequences.
+
+        Returns
+        -------
+        numpy.ndarray of numpy.int32
+            Array of shape (len(seqs), 2 * len(self.chains)) with the V and
+            J gene IDs of each chain.
+        """
+        seqs = as_seq_array(seqs, self.chains)
+        gene_ids = np.zeros((seqs.shape[0], 2 * len(self.chains)), dtype=np.int32)
+        for chain_idx, chain in enumerate(self.chains):
+            vocabulary = self.vocabularies[chain_idx]
+            gene_ids[:, 2 * chain_idx] = vocabulary.gene_ids(seqs[:, chain.v_col], 'V')
+            gene_ids[:, 2 * chain_idx + 1] = vocabulary.gene_ids(seqs[:, chain.j_col], 'J')
+        return gene_ids
+
+    def _lookup(
+        self,
+        keys: Iterable[Tuple[str]]
+    ) -> NDArray[np.int32]:
+        return np.fromiter(
+            (self.feature_dict.get(key, -1) for key in keys), dtype=np.int32
+        )
+
+    def _combination_cols(
+        self,
+        inverse_1: NDArray[np.int64],
+        keys_1: List[Tuple[str]],
+        inverse_2: NDArray[np.int64],
+        keys_2: List[Tuple[str]],
+    ) -> Tuple[NDArray[np.int32], NDArray[np.int64], List[Tuple[str]]]:
+        """
+        Return the columns of the joint keys keys_1[i] + keys_2[j].
+
+        Only the combinations present in the sequences are looked up. The
+        inverse indices and joint keys are returned for further combinations.
+        """
+        combined = inverse_1.astype(np.int64) * len(keys_2) + inverse_2
+        inverse, unique_combined = pd.factorize(combined)
+        keys = [keys_1[idx // len(keys_2)] + keys_2[idx % len(keys_2)]
+                for idx in unique_combined.tolist()]
+        return self._lookup(keys).take(inverse), inverse, keys
+
+    def feature_idxs(
+        self,
+        seqs: NDArray[str],
+        gene_ids: Optional[NDArray[np.int32]] = None
+    ) -> NDArray[np.int32]:
+        """
+        Return the candidate feature columns of each sequence.
+
+        Parameters
+        ----------
+        seqs : numpy.ndarray of str
+            Two-dimensional array of sequences with the columns given by
+            self.chains.
+        gene_ids : numpy.ndarray of numpy.int32, optional
+            The gene IDs of the sequences as returned by gene_ids. They are
+            computed from seqs if None.
+
+        Returns
+        -------
+        idxs : numpy.ndarray of numpy.int32
+            Array of shape (len(seqs), K). Every entry is the column of a
+            feature of the sequence or -1 if the feature is not in the model.
+        """
+        if seqs.shape[0] == 0:
+            return np.zeros((0, 0), dtype=np.int32)
+
+        if gene_ids is None:
+            gene_ids = self.gene_ids(seqs)
+
+        cols = []
+        gene_info = []
+        for chain_idx, chain in enumerate(self.chains):
+            codes, lengths = cdr3s_to_codes(seqs[:, chain.cdr3_col])
+            max_len = codes.shape[1]
+
+            length_table = self._length_table(chain.length_prefix, max_len)
+            cols.append(length_table.take(lengths)[:, None])
+
+            if max_len > 0:
+                fwd, bkd = self._aa_table(chain.aa_prefix, max_len)
+                num_codes = UNKNOWN_CODE + 1
+                positions = np.arange(max_len)
+                # Padding is coded as UNKNOWN_CODE so it never matches a feature.
+                cols.append(fwd.ravel().take(positions * num_codes + codes))
+                distances = np.maximum(lengths[:, None] - positions, 0)
+                cols.append(bkd.ravel().take(distances * num_codes + codes))
+
+            # Missing genes (ID -1) index the last entry of the gene tables.
+            v_keys, v_cols = self._gene_table(chain_idx, 'V', chain.v_prefix)
+            j_keys, j_cols = self._gene_table(chain_idx, 'J', chain.j_prefix)
+            v_inverse = gene_ids[:, 2 * chain_idx] % len(v_keys)
+            j_inverse = gene_ids[:, 2 * chain_idx + 1] % len(j_keys)
+            cols.append(v_cols.take(v_inverse)[:, None])
+            cols.append(j_cols.take(j_inverse)[:, None])
+
+            vj_cols, vj_inverse, vj_keys = self._combination_cols(
+                v_inverse, v_keys, j_inverse, j_keys
+            )
+            cols.append(vj_cols[:, None])
+
+            length_keys = [(f'{chain.length_prefix}{length}',)
+                           for length in range(max_len + 1)]
+            vjl_cols, _, _ = self._combination_cols(
+                vj_inverse, vj_keys, lengths, length_keys
+            )
+            cols.append(vjl_cols[:, None])
+
+            gene_info.append({'v': (v_inverse, v_keys), 'j': (j_inverse, j_keys)})
+
+        for (chain_1, gene_1), (chain_2, gene_2) in self.cross_chain:
+            inverse_1, keys_1 = gene_info[chain_1][gene_1]
+            inverse_2, keys_2 = gene_info[chain_2][gene_2]
+            cross_cols, _, _ = self._combination_cols(
+                inverse_1, keys_1, inverse_2, keys_2
+            )
+            cols.append(cross_cols[:, None])
+
+        return np.concatenate(cols, axis=1)
+
+    def encode(
+        self,
+        seqs: Sequence[Sequence[str]] | NDArray[str],
+        gene_ids: Optional[NDArray[np.int32]] = None,
+        chunksize: int = int(1e5),
+        processes: int = 1,
+        padded: bool = False,
+        verbose: bool = False
+    ) -> sparse.csr_array | PaddedEncoding:
+        """
+        One-hot encode sequences into a sparse array.
+
+        Parameters
+        ----------
+        seqs : sequence of sequence of str or numpy.ndarray of str
+            The sequences. A one-dimensional array is taken to contain only
+            CDR3 amino acid sequences.
+        gene_ids : numpy.ndarray of numpy.int32, optional
+            The gene IDs of the sequences as returned by gene_ids. They are
+            computed from seqs if None.
+        chunksize : int, default int(1e5)
+            The number of sequences encoded at once, which bounds the size of
+            the temporary arrays.
+        processes : int, default 1
+            The number of worker processes. If larger than 1 and there is more
+            than one chunk, the chunks are encoded by a pool of workers that
+            exchange the sequences and CSR pieces through shared memory.
+        padded : bool, default False
+            Return a PaddedEncoding instead of a csr_array.
+        verbose : bool, default False
+            Show a progress bar over the chunks.
+
+        Returns
+        -------
+        csr_arr : scipy.sparse.csr_array or PaddedEncoding
+            The one-hot encoding with sorted indices in each row.
+        """
+        seqs = as_seq_array(seqs, self.chains)
+        num_seqs = seqs.shape[0]
+
+        if processes > 1 and num_seqs > chunksize:
+            csr_arr = self._encode_parallel(seqs, gene_ids, chunksize, processes, verbose)
+            if padded:
+                return PaddedEncoding.from_csr(csr_arr)
+            return csr_arr
+
+        indices = []
+        counts = []
+        starts = range(0, num_seqs, chunksize)
+        tqdm_desc = 'Encoding sequence features'
+        for start in tqdm(starts, position=0, desc=tqdm_desc, disable=not verbose):
+            chunk_gene_ids = None
+            if gene_ids is not None:
+                chunk_gene_ids = gene_ids[start:start + chunksize]
+            chunk_idxs = self.feature_idxs(seqs[start:start + chunksize], chunk_gene_ids)
+            if padded:
+                indices.append(PaddedEncoding.from_idxs(chunk_idxs, self.num_features))
+                continue
+            chunk_indices, chunk_counts = idxs_to_csr_parts(chunk_idxs)
+            indices.append(chunk_indices)
+            counts.append(chunk_counts)
+
+        if padded:
+            if len(indices) == 0:
+                return PaddedEncoding(
+                    np.zeros((0, 0), dtype=padded_dtype(self.num_features)), self.num_features
+                )
+            return PaddedEncoding.vstack(indices)
+        return csr_from_parts(indices, counts, (num_seqs, self.num_features))
+
+    def _encode_parallel(
+        self,
+        seqs: NDArray[str],
+        gene_ids: Optional[NDArray[np.int32]],
+        chunksize: int,
+        processes: int,
+        verbose: bool
+    ) -> sparse.csr_array:
+        """
+        Encode chunks of sequences in a pool of worker processes.
+
+        The sequences (and gene IDs) are copied once into shared memory. Every
+        worker writes the feature counts of its rows into a shared array and
+        its CSR indices into a new shared memory block, whose name is sent
+        back. The blocks are then copied into the indices of the encoding.
+        """
+        num_seqs = seqs.shape[0]
+        shared_blocks = []
+        try:
+            seqs_block, _ = _shared_copy(seqs)
+            shared_blocks.append(seqs_block)
+            gene_ids_spec = None
+            if gene_ids is not None:
+                gene_ids = np.asarray(gene_ids, dtype=np.int32)
+                gene_ids_block, _ = _shared_copy(gene_ids)
+                shared_blocks.append(gene_ids_block)
+                gene_ids_spec = (gene_ids_block.name, gene_ids.shape, gene_ids.dtype.str)
+            counts_block, counts = _shared_copy(np.zeros(num_seqs, dtype=np.int64))
+            shared_blocks.append(counts_block)
+
+            bounds = [(start, min(start + chunksize, num_seqs))
+                      for start in range(0, num_seqs, chunksize)]
+            initargs = (
+                self, (seqs_block.name, seqs.shape, seqs.dtype.str), gene_ids_spec,
+                (counts_block.name, counts.shape, counts.dtype.str)
+            )
+            tqdm_desc = 'Encoding sequence features'
+            with mp.Pool(processes=processes, initializer=_init_encode_worker,
+                         initargs=initargs) as pool:
+                chunks = list(tqdm(
+                    pool.imap(_encode_shared_chunk, bounds), total=len(bounds),
+                    position=0, desc=tqdm_desc, disable=not verbose
+                ))
+
+            nnz = sum(chunk_nnz for _, chunk_nnz in chunks)
+            indices = np.empty(nnz, dtype=_index_dtype(nnz))
+            offset = 0
+            for block_name, chunk_nnz in chunks:
+                if block_name is None:
+                    continue
+                block = shared_memory.SharedMemory(name=block_name)
+                try:
+                    indices[offset:offset + chunk_nnz] = np.ndarray(
+                        (chunk_nnz,), dtype=np.int32, buffer=block.buf
+                    )
+                finally:
+                    block.close()
+                    block.unlink()
+                offset += chunk_nnz
+            return one_hot_csr(indices, counts, (num_seqs, self.num_features))
+        finally:
+            for block in shared_blocks:
+                block.close()
+                block.unlink()
+
+class PaddedEncoding(object):
+    """
+    One-hot encoding stored as a padded matrix of feature columns.
+
+    Row i holds the sorted columns of the features of sequence i, preceded by
+    -1 padding. The ones of the encoding are implicit, so a sequence takes
+    K * idxs.itemsize bytes, where K is the largest number of features of a
+    sequence, instead of the data, indices and indptr entries of a CSR row.
+    The supported operations mirror those used on scipy.sparse.csr_array
+    encodings (row indexing, toarray, shape).
+
+    Attributes
+    ----------
+    idxs : numpy.ndarray of numpy.int16 or numpy.int32
+        The padded feature columns of shape (N, K).
+    shape : tuple of int
+        The shape (N, number of features) of the one-hot encoding.
+
+    Methods
+    -------
+    from_csr(csr_arr)
+        Convert a one-hot csr_array.
+    from_idxs(idxs, num_features)
+        Compress the candidate feature columns given by FeatureEncoder.feature_idxs.
+    vstack(encodings)
+        Stack padded encodings vertically.
+    toarray()
+        Return the dense one-hot encoding.
+    tocsr()
+        Return the encoding as a csr_array.
+    feature_sums(weights=None)
+        Return the (weighted) number of sequences with each feature.
+    dot(values)
+        Return the sum of the feature values of each sequence.
+    """
+    def __init__(
+        self,
+        idxs: NDArray[np.int16] | NDArray[np.int32],
+        num_features: int
+    ) -> None:
+        self.idxs = idxs
+        self.shape = (idxs.shape[0], num_features)
+
+    @classmethod
+    def from_idxs(
+        cls,
+        idxs: NDArray[np.int32],
+        num_features: int
+    ) -> PaddedEncoding:
+        """Compress the candidate feature columns given by FeatureEncoder.feature_idxs."""
+        idxs = np.sort(idxs, axis=1)
+        width = int(np.count_nonzero(idxs >= 0, axis=1).max(initial=0))
+        return cls(
+            idxs[:, idxs.shape[1] - width:].astype(padded_dtype(num_features)),
+            num_features
+        )
+
+    @classmethod
+    def from_csr(
+        cls,
+        csr_arr: sparse.csr_array
+    ) -> PaddedEncoding:
+        """Convert a one-hot csr_array."""
+        num_seqs, num_features = csr_arr.shape
+        counts = np.diff(csr_arr.indptr)
+        width = int(counts.max(initial=0))
+        idxs = np.full((num_seqs, width), -1, dtype=padded_dtype(num_features))
+        rows = np.repeat(np.arange(num_seqs), counts)
+        cols = (width - counts[rows]
+                + np.arange(len(csr_arr.indices)) - csr_arr.indptr[rows])
+        idxs[rows, cols] = csr_arr.indices
+        return cls(np.sort(idxs, axis=1), num_features)
+
+    @staticmethod
+    def vstack(
+        encodings: Sequence[PaddedEncoding]
+    ) -> PaddedEncoding:
+        """Stack padded encodings vertically, padding them to the same width."""
+        width = max(encoding.idxs.shape[1] for encoding in encodings)
+        dtype = np.result_type(*[encoding.idxs.dtype for encoding in encodings])
+        idxs = np.full(
+            (sum(len(encoding) for encoding in encodings), width), -1, dtype=dtype
+        )
+        start = 0
+        for encoding in encodings:
+            idxs[start:start + len(encoding), width - encoding.idxs.shape[1]:] = encoding.idxs
+            start += len(encoding)
+        return PaddedEncoding(idxs, encodings[0].shape[1])
+
+    def __len__(
+        self
+    ) -> int:
+        return self.shape[0]
+
+    def __getitem__(
+        self,
+        key: int | slice | NDArray[np.integer] | NDArray[np.bool_]
+    ) -> PaddedEncoding:
+        if isinstance(key, (int, np.integer)):
+            key = [key]
+        return PaddedEncoding(self.idxs[key], self.shape[1])
+
+    @property
+    def indices(
+        self
+    ) -> NDArray[np.int16] | NDArray[np.int32]:
+        """The feature columns of all rows, concatenated (as csr_array.indices)."""
+        return self.idxs[self.idxs >= 0]
+
+    @property
+    def nnz(
+        self
+    ) -> int:
+        return int(np.count_nonzero(self.idxs >= 0))
+
+    @property
+    def nbytes(
+        self
+    ) -> int:
+        return self.idxs.nbytes
+
+    def toarray(
+        self,
+        out: Optional[NDArray[np.int8]] = None
+    ) -> NDArray[np.int8]:
+        """Return the dense one-hot encoding, written to out if it is given."""
+        if out is None:
+            dense = np.zeros(self.shape, dtype=np.int8)
+        else:
+            dense = out
+            dense.fill(0)
+        present = self.idxs >= 0
+        dense[np.nonzero(present)[0], self.idxs[present]] = 1
+        return dense
+
+    def tocsr(
+        self
+    ) -> sparse.csr_array:
+        """Return the encoding as a csr_array."""
+        return one_hot_csr(
+            self.indices, np.count_nonzero(self.idxs >= 0, axis=1), self.shape
+        )
+
+    def feature_sums(
+        self,
+        weights: Optional[NDArray[np.floating]] = None
+    ) -> NDArray[np.float64]:
+        """Return the (weighted) number of sequences with each feature."""
+        present = self.idxs >= 0
+        if weights is not None:
+            weights = np.broadcast_to(np.asarray(weights)[:, None], self.idxs.shape)[present]
+        return np.bincount(
+            self.idxs[present], weights=weights, minlength=self.shape[1]
+        ).astype(np.float64)
+
+    def dot(
+        self,
+        values: NDArray[np.floating]
+    ) -> NDArray[np.floating]:
+        """Return the sum of the feature values of each sequence (encoding @ values)."""
+        # The padding index -1 gathers the appended zero.
+        values = np.append(values, np.zeros(1, dtype=values.dtype))
+        return values[self.idxs].sum(axis=1)
+
+class EncodingView(object):
+    """
+    Rows of one-hot encodings stacked vertically, selected by index without copying.
+
+    Row i of the view is row rows[i] of the encodings as stacked by
+    vstack_encodings, e.g. the data and gen encodings of a Sonia model
+    followed by each other. Indexing a view only indexes rows, so shuffling,
+    splitting or repeating the rows of a training set takes 8 bytes per row
+    rather than a copy of the encodings. The supported operations mirror
+    those used on scipy.sparse.csr_array encodings for training (row
+    indexing, toarray, shape) and by sonnia.linear_solver (encoding_dot and
+    feature_sums).
+
+    Attributes
+    ----------
+    encodings : tuple of scipy.sparse.csr_array or PaddedEncoding
+        The stacked encodings, which must have the same number of features.
+    rows : numpy.ndarray of numpy.int64
+        The rows of the stacked encodings in the view.
+    offsets : numpy.ndarray of numpy.int64
+        The first stacked row of each encoding, followed by the number of
+        stacked rows.
+    shape : tuple of int
+        The shape (number of rows, number of features) of the view.
+
+    Methods
+    -------
+    toarray(out=None)
+        Return the dense one-hot encoding of the rows.
+    feature_sums(weights=None)
+        Return the (weighted) number of rows with each feature.
+    dot(values)
+        Return the sum of the feature values of each row.
+    """
+    def __init__(
+        self,
+        encodings: Sequence[sparse.csr_array | PaddedEncoding],
+        rows: Optional[NDArray[np.integer]] = None
+    ) -> None:
+        self.encodings = tuple(encodings)
+        self.offsets = np.cumsum(
+            [0] + [encoding.shape[0] for encoding in self.encodings], dtype=np.int64
+        )
+        if rows is None:
+            rows = np.arange(self.offsets[-1])
+        self.rows = np.asarray(rows, dtype=np.int64)
+        # An encoding without rows may be an empty placeholder array.
+        num_features = max(
+            (encoding.shape[1] for encoding in self.encodings if len(encoding.shape) == 2),
+            default=0
+        )
+        self.shape = (len(self.rows), num_features)
+        self._split = None
+
+    def __len__(
+        self
+    ) -> int:
+        return self.shape[0]
+
+    def __getitem__(
+        self,
+        key: int | slice | NDArray[np.integer] | NDArray[np.bool_]
+    ) -> EncodingView:
+        if isinstance(key, (int, np.integer)):
+            key = [key]
+        return EncodingView(self.encodings, self.rows[key])
+
+    @property
+    def nbytes(
+        self
+    ) -> int:
+        """The bytes taken by the view itself, without the encodings."""
+        return self.rows.nbytes
+
+    def _split_rows(
+        self
+    ) -> List[Tuple[sparse.csr_array | PaddedEncoding, NDArray[np.int64], NDArray[np.int64]]]:
+        """
+        Return each encoding with the positions in the view of its rows and those rows.
+
+        The split is kept, as the solvers of sonnia.linear_solver multiply the
+        same view many times.
+        """
+        if self._split is None:
+            sources = np.searchsorted(self.offsets, self.rows, side='right') - 1
+            self._split = []
+            for source, encoding in enumerate(self.encodings):
+                positions = np.flatnonzero(sources == source)
+                if len(positions):
+                    self._split.append(
+                        (encoding, positions, self.rows[positions] - self.offsets[source])
+                    )
+        return self._split
+
+    def toarray(
+        self,
+        out: Optional[NDArray] = None
+    ) -> NDArray:
+        """Return the dense one-hot encoding of the rows, written to out if it is given."""
+        if out is None:
+            dense = np.zeros(self.shape, dtype=np.int8)
+        else:
+            dense = out
+            dense.fill(0)
+        for encoding, positions, rows in self._split_rows():
+            if isinstance(encoding, PaddedEncoding):
+                idxs = encoding.idxs[rows]
+                present = idxs >= 0
+                dense[positions[np.nonzero(present)[0]], idxs[present]] = 1
+            else:
+                # The entries of the rows are gathered from indptr, so that
+                # only the selected rows are read.
+                starts = encoding.indptr[rows]
+                counts = encoding.indptr[rows + 1] - starts
+                entries = (np.repeat(starts - np.cumsum(counts) + counts, counts)
+                           + np.arange(counts.sum()))
+                dense[np.repeat(positions, counts), encoding.indices[entries]] = (
+                    encoding.data[entries]
+                )
+        return dense
+
+    def _stacked_weights(
+        self,
+        weights: Optional[NDArray[np.floating]]
+    ) -> NDArray[np.float64]:
+        """Return the summed weight of each stacked row, which rows may repeat."""
+        return np.bincount(self.rows, weights=weights, minlength=self.offsets[-1])
+
+    def feature_sums(
+        self,
+        weights: Optional[NDArray[np.floating]] = None
+    ) -> NDArray[np.float64]:
+        """Return the (weighted) number of rows with each feature."""
+        stacked_weights = self._stacked_weights(weights)
+        return sum(
+            feature_sums(encoding, stacked_weights[start:stop])
+            for encoding, start, stop in zip(self.encodings, self.offsets[:-1], self.offsets[1:])
+        )
+
+    def dot(
+        self,
+        values: NDArray[np.floating]
+    ) -> NDArray[np.floating]:
+        """Return the sum of the feature values of each row (view @ values)."""
+        result = np.empty(len(self.rows), dtype=np.result_type(values, np.float32))
+        for encoding, positions, rows in self._split_rows():
+            result[positions] = encoding_dot(encoding, values)[rows]
+        return result
+
+def padded_dtype(
+    num_features: int
+) -> type:
+    """The smallest integer type of a PaddedEncoding with num_features columns."""
+    if num_features <= np.iinfo(np.int16).max:
+        return np.int16
+    return np.int32
+
+def is_encoding(
+    encoding: Any
+) -> bool:
+    """Return whether encoding is a csr_array or PaddedEncoding (and not e.g. an iterator)."""
+    return sparse.issparse(encoding) or isinstance(encoding, PaddedEncoding)
+
+def as_csr(
+    encoding: sparse.csr_array | PaddedEncoding
+) -> sparse.csr_array:
+    """Return a csr_array of a csr_array or PaddedEncoding."""
+    if isinstance(encoding, PaddedEncoding):
+        return encoding.tocsr()
+    return encoding
+
+def vstack_encodings(
+    encodings: Sequence[sparse.csr_array | PaddedEncoding]
+) -> sparse.csr_array | PaddedEncoding:
+    """Stack encodings, keeping the padded format if all of them use it."""
+    if all(isinstance(encoding, PaddedEncoding) for encoding in encodings):
+        return PaddedEncoding.vstack(encodings)
+    return sparse.vstack([as_csr(encoding) for encoding in encodings], format='csr')
+
+def encoding_dot(
+    encoding: sparse.csr_array | PaddedEncoding | EncodingView,
+    values: NDArray[np.floating]
+) -> NDArray[np.floating]:
+    """
+    Return the sum of the feature values of each sequence of a one-hot encoding.
+
+    This is the sparse product encoding @ values, which never densifies the
+    encoding.
+    """
+    if isinstance(encoding, (PaddedEncoding, EncodingView)):
+        return encoding.dot(values)
+    return encoding @ values
+
+def feature_sums(
+    encoding: sparse.csr_array | PaddedEncoding | EncodingView,
+    weights: Optional[NDArray[np.floating]] = None
+) -> NDArray[np.float64]:
+    """
+    Return the (weighted) number of sequences with each feature.
+
+    Parameters
+    ----------
+    encoding : scipy.sparse.csr_array, PaddedEncoding or EncodingView
+        The one-hot encoding.
+    weights : numpy.ndarray, optional
+        The weight of each sequence. If None, every sequence has weight 1.
+
+    Returns
+    -------
+    numpy.ndarray of numpy.float64
+        The sum of the weights of the sequences with each feature.
+    """
+    if isinstance(encoding, (PaddedEncoding, EncodingView)):
+        return encoding.feature_sums(weights)
+    if weights is not None:
+        weights = np.repeat(np.asarray(weights, dtype=np.float64), np.diff(encoding.indptr))
+    return np.bincount(
+        encoding.indices, weights=weights, minlength=encoding.shape[1]
+    ).astype(np.float64)
+
+def cooccurrence_sums(
+    encoding: sparse.csr_array | PaddedEncoding,
+    weights: Sequence[NDArray[np.floating]],
+    chunksize: int = int(1e5),
+    threads: int = 1,
+    columns: Optional[Tuple[NDArray[np.int64], NDArray[np.int64]]] = None
+) -> List[sparse.csr_array]:
+    """
+    Return the weighted number of sequences with each pair of features.
+
+    For each weight vector w, this is encoding.T @ diag(w) @ encoding, summed
+    over chunks of rows. The chunks are multiplied in a thread pool, since the
+    sparse products release the GIL.
+
+    Parameters
+    ----------
+    encoding : scipy.sparse.csr_array or PaddedEncoding
+        The one-hot encoding.
+    weights : sequence of numpy.ndarray
+        The weight vectors, each with one weight per sequence. All of them
+        are summed in the same pass over the encoding.
+    chunksize : int, default int(1e5)
+        The number of sequences multiplied at once.
+    threads : int, default 1
+        The number of threads multiplying chunks.
+    columns : tuple of two numpy.ndarray of numpy.int64, optional
+        The features of the rows and of the columns of the sums. Defaults to
+        all features for both.
+
+    Returns
+    -------
+    list of scipy.sparse.csr_array of numpy.float64
+        The (len(columns[0]), len(columns[1])) sums, one per weight vector.
+    """
+    return cooccurrence_block_sums(encoding, weights, [columns], chunksize, threads)[0]
+
+def cooccurrence_block_sums(
+    encoding: sparse.csr_array | PaddedEncoding,
+    weights: Sequence[NDArray[np.floating]],
+    blocks: Sequence[Optional[Tuple[NDArray[np.int64], NDArray[np.int64]]]],
+    chunksize: int = int(1e5),
+    threads: int = 1
+) -> List[List[sparse.csr_array]]:
+    """
+    Return cooccurrence_sums of several blocks of features in one pass over the encoding.
+
+    Each chunk of rows is taken once, and its columns are then sliced for
+    every block.
+
+    Parameters
+    ----------
+    encoding : scipy.sparse.csr_array or PaddedEncoding
+        The one-hot encoding.
+    weights : sequence of numpy.ndarray
+        The weight vectors, each with one weight per sequence.
+    blocks : sequence of tuple of two numpy.ndarray of numpy.int64
+        The features of the rows and of the columns of each block (as the
+        columns of cooccurrence_sums). None stands for all features.
+    chunksize : int, default int(1e5)
+        The number of sequences multiplied at once.
+    threads : int, default 1
+        The number of threads multiplying chunks.
+
+    Returns
+    -------
+    list of list of scipy.sparse.csr_array of numpy.float64
+        For each block, the sums, one per weight vector.
+    """
+    encoding = as_csr(encoding)
+    weights = [np.asarray(w, dtype=np.float64) for w in weights]
+    blocks = list(blocks)
+
+    def chunk_sums(start_idx):
+        chunk = encoding[start_idx:start_idx + chunksize]
+        sums = []
+        for columns in blocks:
+            if columns is None:
+                left, right = chunk, chunk
+            else:
+                left, right = chunk[:, columns[0]], chunk[:, columns[1]]
+            left_transpose = left.T
+            row_counts = np.diff(right.indptr)
+            for w in weights:
+                weighted_right = sparse.csr_array(
+                    (np.repeat(w[start_idx:start_idx + chunksize], row_counts),
+                     right.indices, right.indptr),
+                    shape=right.shape
+                )
+                sums.append(sparse.csr_array(left_transpose @ weighted_right))
+        return sums
+
+    # The sums of all blocks are kept in one flat list, block by block.
+    totals = []
+    for columns in blocks:
+        if columns is None:
+            shape = (encoding.shape[1], encoding.shape[1])
+        else:
+            shape = (len(columns[0]), len(columns[1]))
+        totals.extend(sparse.csr_array(shape) for _ in weights)
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        for sums in executor.map(chunk_sums, range(0, encoding.shape[0], chunksize)):
+            totals = [total + chunk_sum for total, chunk_sum in zip(totals, sums)]
+    return [totals[i:i + len(weights)] for i in range(0, len(totals), max(len(weights), 1))]
+
+# Per-process state of the workers of FeatureEncoder._encode_parallel.
+_ENCODE_WORKER = {}
+
+def _attach_shared(
+    spec: Tuple[str, Tuple[int, ...], str]
+) -> Tuple[shared_memory.SharedMemory, NDArray]:
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _init_encode_worker(
+    encoder: FeatureEncoder,
+    seqs_spec: Tuple[str, Tuple[int, ...], str],
+    gene_ids_spec: Optional[Tuple[str, Tuple[int, ...], str]],
+    counts_spec: Tuple[str, Tuple[int, ...], str]
+) -> None:
+    _ENCODE_WORKER['encoder'] = encoder
+    # The blocks are kept so that the arrays stay valid.
+    _ENCODE_WORKER['blocks'] = []
+    for key, spec in (('seqs', seqs_spec), ('gene_ids', gene_ids_spec),
+                      ('counts', counts_spec)):
+        if spec is None:
+            _ENCODE_WORKER[key] = None
+            continue
+        block, arr = _attach_shared(spec)
+        _ENCODE_WORKER['blocks'].append(block)
+        _ENCODE_WORKER[key] = arr
+
+def _encode_shared_chunk(
+    bounds: Tuple[int, int]
+) -> Tuple[Optional[str], int]:
+    """Encode the rows start:stop and return the shared block of the indices."""
+    start, stop = bounds
+    gene_ids = _ENCODE_WORKER['gene_ids']
+    if gene_ids is not None:
+        gene_ids = gene_ids[start:stop]
+    indices, counts = idxs_to_csr_parts(
+        _ENCODE_WORKER['encoder'].feature_idxs(_ENCODE_WORKER['seqs'][start:stop], gene_ids)
+    )
+    _ENCODE_WORKER['counts'][start:stop] = counts
+    if len(indices) == 0:
+        return None, 0
+    block = shared_memory.SharedMemory(create=True, size=indices.nbytes)
+    np.ndarray(indices.shape, dtype=np.int32, buffer=block.buf)[:] = indices
+    block.close()
+    return block.name, len(indices)
+
+def _shared_copy(
+    arr: NDArray
+) -> Tuple[shared_memory.SharedMemory, NDArray]:
+    """Copy an array into a new shared memory block."""
+    block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)
+    shared[...] = arr
+    return block, shared
+
+def as_seq_array(
+    seqs: Sequence[Sequence[str]] | NDArray[str],
+    chains: Sequence[ChainSpec] = SINGLE_CHAIN
+) -> NDArray[str]:
+    """
+    Return the sequences as a two-dimensional array of str.
+
+    A one-dimensional input is taken to contain only CDR3 sequences and is
+    padded with empty gene columns.
+    """
+    seqs = np.asarray(seqs)
+    if seqs.dtype.kind != 'U':
+        seqs = seqs.astype(str)
+    if seqs.ndim == 1:
+        num_cols = max(max(chain[:3]) for chain in chains) + 1
+        padded = np.zeros((len(seqs), num_cols), dtype=seqs.dtype)
+        padded[:, 0] = seqs
+        seqs = padded
+    return seqs
+
+def idxs_to_csr_parts(
+    idxs: NDArray[np.int32]
+) -> Tuple[NDArray[np.int32], NDArray[np.int64]]:
+    """
+    Compress candidate feature columns into CSR indices and row counts.
+
+    Parameters
+    ----------
+    idxs : numpy.ndarray of numpy.int32
+        Candidate feature columns of shape (N, K) with -1 for absent features.
+
+    Returns
+    -------
+    indices : numpy.ndarray of numpy.int32
+        The sorted feature columns of every row, concatenated.
+    counts : numpy.ndarray of numpy.int64
+        The number of features of every row.
+    """
+    idxs = np.sort(idxs, axis=1)
+    present = idxs >= 0
+    return idxs[present], np.count_nonzero(present, axis=1)
+
+def csr_from_parts(
+    indices: Sequence[NDArray[np.int32]],
+    counts: Sequence[NDArray[np.int64]],
+    shape: Tuple[int, int]
+) -> sparse.csr_array:
+    """Assemble a one-hot csr_array from chunks of indices and row counts."""
+    if len(indices) > 0:
+        indices = np.concatenate(indices)
+        counts = np.concatenate(counts)
+    else:
+        indices = np.zeros(0, dtype=np.int32)
+        counts = np.zeros(0, dtype=np.int64)
+    return one_hot_csr(indices, counts, shape)
+
+def _index_dtype(
+    nnz: int
+) -> type:
+    # Keep 32 bit indices (as scipy does) unless the encoding is too large.
+    if nnz < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+def one_hot_csr(
+    indices: NDArray[np.integer],
+    counts: NDArray[np.int64],
+    shape: Tuple[int, int]
+) -> sparse.csr_array:
+    """Return the csr_array of ones with the given indices and row counts."""
+    index_dtype = _index_dtype(len(indices))
+    indices = indices.astype(index_dtype, copy=False)
+    indptr = np.zeros(shape[0] + 1, dtype=index_dtype)
+    np.cumsum(counts, out=indptr[1:])
+    data = np.ones(len(indices), dtype=np.int8)
+    return sparse.csr_array((data, indices, indptr), shape=shape)
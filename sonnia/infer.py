@@ -52,6 +52,10 @@ def main():
     parser.add_option('--epochs', type='int', default = 30, dest='epochs' ,help='number of epochs for inference, default is 30')
     parser.add_option('--batch_size', type='int', default = 5000, dest='batch_size' ,help='size of batch for the stochastic gradient descent')
     parser.add_option('--validation_split', type='float', default = 0.2, dest='validation_split' ,help='fraction of sequences used for validation.')
+    parser.add_option('--workers', type='int', default = 1, dest='workers' ,help='number of threads assembling mini-batches ahead of training. Default is 1.')
+    parser.add_option('--solver', type='choice', default = 'keras', dest='solver', choices=['keras', 'lbfgs', 'proximal'], help="training of the model. 'lbfgs' and 'proximal' train linear models to convergence on the full training set. Default is keras.")
+    parser.add_option('--checkpoint_dir', type='str', dest='checkpoint_dir', metavar='PATH/TO/DIR', help='save a checkpoint of the training to PATH/TO/DIR after every epoch.')
+    parser.add_option('--resume_from', type='str', dest='resume_from', metavar='PATH/TO/CHECKPOINT', help='resume the training from a checkpoint, or the latest checkpoint of a directory.')
     parser.add_option('--gene_features', dest='gene_features', default=None, help="Define gene features. Default is 'joint_vj' for linear model and 'indep_vj' for deep model. Options: 'joint_vj', 'indep_vj', 'v', 'j', 'none', 'vjl'.")
 
     parser.add_option('--linear', action='store_true', dest='linear_model', default=False, help='Join gene features.')
@@ -435,7 +439,7 @@ def main():
         if recompute_productive_norm: sonia_model.norm_productive=sonia_model.pgen_model.compute_regex_CDR3_template_pgen('CX{0,}')
         
         print('Model initialised. Start inference')
-        sonia_model.infer_selection(epochs=options.epochs,verbose=1,batch_size=options.batch_size,validation_split=options.validation_split)
+        sonia_model.infer_selection(epochs=options.epochs,verbose=1,batch_size=options.batch_size,validation_split=options.validation_split,workers=options.workers,solver=options.solver,checkpoint_dir=options.checkpoint_dir,resume_from=options.resume_from)
         print('Save Model')
         if options.outfile_name is not None: #OUTFILE SPECIFIED
             name_out=options.outfile_name
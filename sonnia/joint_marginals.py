@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Block-restricted joint marginals between groups of features.
+
+The full matrix of joint marginals has len(features)**2 entries. This is too
+large for vjl models or paired models with across-chain features. Instead,
+features are grouped by the kind of their subfeatures, and only chosen pairs
+of groups are computed.
+
+Group names join the kinds of the subfeatures with '-'. Examples are 'l',
+'a' and 'v-j' for a Sonia model with joint_vj features, and 'l_h', 'a_l',
+'v_l-j_l' and 'v_h-v_l' for a paired model.
+"""
+from __future__ import annotations
+from typing import *
+
+import numpy as np
+from numpy.typing import NDArray
+
+def feature_group(
+    feature: Sequence[str]
+) -> str:
+    """Return the name of the group of a feature, e.g. 'a' for ('aA5',)."""
+    # Subfeatures of paired models carry the chain after an underscore, e.g.
+    # 'a_hA5' or 'v_lTRAV1'.
+    return '-'.join(
+        subfeature[:3] if subfeature[1:2] == '_' else subfeature[:1]
+        for subfeature in feature
+    )
+
+def feature_groups(
+    features: Sequence[Sequence[str]]
+) -> Dict[str, NDArray[np.int64]]:
+    """Return the indices of the features of each group, in order of first appearance."""
+    groups = {}
+    for idx, feature in enumerate(features):
+        groups.setdefault(feature_group(feature), []).append(idx)
+    return {name: np.array(idxs, dtype=np.int64) for name, idxs in groups.items()}
+
+class JointMarginalBlocks(object):
+    """
+    Float32 blocks of joint marginals between pairs of feature groups.
+
+    A block (group_a, group_b) holds, for each feature i of group_a and j of
+    group_b, the weighted fraction of sequences with both features. Blocks
+    of a group with itself keep only the lower triangle without the
+    diagonal, as the full joint marginals do. The blocks are held in memory
+    or in a single memory-mapped file. In the latter case, each block is
+    mapped only when it is read.
+
+    Attributes
+    ----------
+    groups : dict of {str : numpy.ndarray of numpy.int64}
+        The feature indices of each group.
+    blocks : list of tuple of (str, str)
+        The pairs of groups.
+    filename : str or None
+        The memory-mapped file holding the blocks.
+
+    Methods
+    -------
+    features(block)
+        Return the feature indices of the rows and columns of a block.
+    toarray(num_features)
+        Return the joint marginals as a dense lower-triangular matrix.
+    """
+    def __init__(
+        self,
+        groups: Dict[str, NDArray[np.int64]],
+        blocks: Sequence[Tuple[str, str]],
+        filename: Optional[str] = None
+    ) -> None:
+        """
+        Parameters
+        ----------
+        groups : dict of {str : numpy.ndarray of numpy.int64}
+            The feature indices of each group, e.g. from feature_groups.
+        blocks : sequence of tuple of (str, str)
+            The pairs of groups to hold.
+        filename : str, optional
+            The file in which the zero-initialized blocks are memory-mapped.
+            If None, the blocks are kept in memory.
+        """
+        self.blocks = [tuple(block) for block in blocks]
+        for block in self.blocks:
+            for group in block:
+                if group not in groups:
+                    raise ValueError(f'Unknown feature group {group}. The groups '
+                                     f'are {", ".join(groups)}.')
+        self.groups = groups
+        self.filename = filename
+
+        self._offsets = {}
+        offset = 0
+        for block in self.blocks:
+            self._offsets[block] = offset
+            offset += 4 * int(np.prod(self._shape(block)))
+        if filename is None:
+            self._arrays = {
+                block: np.zeros(self._shape(block), dtype=np.float32) for block in self.blocks
+            }
+        else:
+            with open(filename, 'wb') as blocks_file:
+                blocks_file.truncate(offset)
+
+    def _shape(
+        self,
+        block: Tuple[str, str]
+    ) -> Tuple[int, int]:
+        return len(self.groups[block[0]]), len(self.groups[block[1]])
+
+    def __getitem__(
+        self,
+        block: Tuple[str, str]
+    ) -> NDArray[np.float32]:
+        """Return a block, mapped from the file if the blocks are memory-mapped."""
+        block = tuple(block)
+        if block not in self._offsets:
+            raise KeyError(block)
+        if self.filename is None:
+            return self._arrays[block]
+        return np.memmap(self.filename, dtype=np.float32, mode='r+',
+                         offset=self._offsets[block], shape=self._shape(block))
+
+    def __iter__(
+        self
+    ) -> Iterator[Tuple[str, str]]:
+        return iter(self.blocks)
+
+    def __len__(
+        self
+    ) -> int:
+        return len(self.blocks)
+
+    def items(
+        self
+    ) -> Iterator[Tuple[Tuple[str, str], NDArray[np.float32]]]:
+        """Yield (block, array) pairs, mapping each block when it is reached."""
+        for block in self.blocks:
+            yield block, self[block]
+
+    def features(
+        self,
+        block: Tuple[str, str]
+    ) -> Tuple[NDArray[np.int64], NDArray[np.int64]]:
+        """Return the feature indices of the rows and columns of a block."""
+        return self.groups[block[0]], self.groups[block[1]]
+
+    def toarray(
+        self,
+        num_features: int
+    ) -> NDArray[np.float32]:
+        """
+        Return the joint marginals as a dense (num_features, num_features) matrix.
+
+        Entries outside the blocks are 0, and every entry is placed in the
+        lower triangle as in Sonia.joint_marginals.
+        """
+        dense = np.zeros((num_features, num_features), dtype=np.float32)
+        for block, values in self.items():
+            rows, cols = self.features(block)
+            row_idxs, col_idxs = np.meshgrid(rows, cols, indexing='ij')
+            lower = row_idxs > col_idxs
+            dense[row_idxs[lower], col_idxs[lower]] = values[lower]
+            if block[0] != block[1]:
+                # An off-diagonal block holds both orders of its pairs.
+                upper = row_idxs < col_idxs
+                dense[col_idxs[upper], row_idxs[upper]] = values[upper]
+        return dense
@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Full-batch convex solvers for the feature energies of linear Sonia models.
+
+The loss of a linear model is a convex function of its feature energies,
+and its gradient is a difference of weighted feature marginals. Both are
+computed here with sparse products over the one-hot encoding, which is
+never densified. LinearObjective gives the loss and gradient of either
+objective of Sonia.infer_selection, and the same regularization as the
+l1_l2 kernel regularizer of the Keras model.
+
+minimize_lbfgs minimizes it with scipy's L-BFGS-B. An L1 penalty is
+handled by splitting the energies into positive and negative parts with
+nonnegativity bounds, which keeps the problem smooth. minimize_proximal
+uses accelerated proximal gradient steps (FISTA with backtracking), which
+apply the L1 penalty exactly by soft-thresholding.
+
+SharedGenObjective sums the losses of several linear models trained on
+different data seqs against the same gen seqs. Their energies form the
+columns of one matrix, so the gen seqs are visited once per evaluation for
+all the models, with one sparse product for the energies and one for the
+gradient.
+"""
+from __future__ import annotations
+from typing import *
+
+import numpy as np
+from numpy.typing import NDArray
+import scipy.optimize as optimize
+import scipy.sparse as sparse
+from scipy.special import expit
+
+from sonnia.feature_encoder import as_csr, encoding_dot, feature_sums, PaddedEncoding
+
+class LinearObjective(object):
+    """
+    Loss of a linear Sonia model as a function of its feature energies.
+
+    Attributes
+    ----------
+    encoding : scipy.sparse.csr_array or PaddedEncoding
+        The one-hot encoding of the data and gen seqs.
+    y : numpy.ndarray of numpy.int8
+        The labels, 0 for data and 1 for gen seqs.
+    objective : str
+        'BCE' for the binary cross-entropy of the labels, or anything else
+        for the likelihood loss of Sonia._loss.
+    gamma : float
+        The weight of the gauge penalty of the likelihood loss.
+    l2_reg : float
+        The L2 penalty of the energies.
+    data_marginals : numpy.ndarray of numpy.float64
+        The weighted marginals of the features over the data seqs.
+
+    Methods
+    -------
+    __call__(energy_params)
+        Return the loss and its gradient.
+    likelihood(energy_params)
+        Return the likelihood metric of Sonia._likelihood.
+    model_marginals(energy_params)
+        Return the marginals of the features over the Q-weighted gen seqs.
+    """
+    def __init__(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding,
+        y: NDArray[np.int8],
+        sample_weight: Optional[NDArray[np.float64]] = None,
+        objective: str = 'BCE',
+        gamma: float = 1.,
+        l2_reg: float = 0.,
+        min_energy_clip: float = -np.inf,
+        max_energy_clip: float = np.inf
+    ) -> None:
+        """
+        Parameters
+        ----------
+        encoding : scipy.sparse.csr_array or PaddedEncoding
+            The one-hot encoding of the data and gen seqs.
+        y : numpy.ndarray of numpy.int8
+            The labels, 0 for data and 1 for gen seqs.
+        sample_weight : numpy.ndarray of numpy.float64, optional
+            The weight of each sequence, e.g. its multiplicity.
+        objective : str, default 'BCE'
+            'BCE' for the binary cross-entropy, otherwise the likelihood loss.
+        gamma : float, default 1.
+            The weight of the gauge penalty of the likelihood loss.
+        l2_reg : float, default 0.
+            The L2 penalty of the energies.
+        min_energy_clip : float, optional
+            The energies are clipped from below, as by the Keras model.
+        max_energy_clip : float, optional
+            The energies are clipped from above, as by the Keras model.
+        """
+        self.encoding = encoding
+        self.y = np.asarray(y)
+        self.objective = objective
+        self.gamma = gamma
+        self.l2_reg = l2_reg
+        self.min_energy_clip = min_energy_clip
+        self.max_energy_clip = max_energy_clip
+
+        if sample_weight is None:
+            sample_weight = np.ones(len(self.y))
+        self.sample_weight = np.asarray(sample_weight, dtype=np.float64)
+        is_gen = self.y == 1
+        self.data_weights = np.where(is_gen, 0., self.sample_weight)
+        self.gen_weights = np.where(is_gen, self.sample_weight, 0.)
+        if self.data_weights.sum() == 0 or self.gen_weights.sum() == 0:
+            raise RuntimeError('Both data and gen seqs are needed to compute the loss.')
+        self.data_marginals = (
+            feature_sums(encoding, self.data_weights) / self.data_weights.sum()
+        )
+
+    def _energies(
+        self,
+        energy_params: NDArray[np.float64]
+    ) -> Tuple[NDArray[np.float64], NDArray[np.bool_]]:
+        """Return the clipped energies and whether each one lies within the clips."""
+        energies = encoding_dot(self.encoding, energy_params)
+        unclipped = (energies >= self.min_energy_clip) & (energies <= self.max_energy_clip)
+        return np.clip(energies, self.min_energy_clip, self.max_energy_clip), unclipped
+
+    def _log_z(
+        self,
+        energies: NDArray[np.float64]
+    ) -> Tuple[float, NDArray[np.float64]]:
+        """Return log <exp(-E)>_gen and the normalized weights of the gen seqs in it."""
+        shift = np.max(-energies[self.gen_weights > 0])
+        q = self.gen_weights * np.exp(-energies - shift)
+        total = q.sum()
+        return np.log(total / self.gen_weights.sum()) + shift, q / total
+
+    def __call__(
+        self,
+        energy_params: NDArray[np.float64]
+    ) -> Tuple[float, NDArray[np.float64]]:
+        """Return the loss (with the L2 penalty) and its gradient."""
+        energies, unclipped = self._energies(energy_params)
+        if self.objective == 'BCE':
+            # Keras averages the weighted losses over the number of sequences.
+            loss = np.sum(
+                self.sample_weight * (np.logaddexp(0, energies) - self.y * energies)
+            ) / len(self.y)
+            energy_grad = self.sample_weight * (expit(energies) - self.y) / len(self.y)
+        else:
+            log_z, gen_probs = self._log_z(energies)
+            data_energy = np.dot(self.data_weights, energies) / self.data_weights.sum()
+            loss = data_energy + log_z + self.gamma * log_z**2
+            energy_grad = (
+                self.data_weights / self.data_weights.sum()
+                - (1 + 2 * self.gamma * log_z) * gen_probs
+            )
+        grad = feature_sums(self.encoding, energy_grad * unclipped)
+        loss += self.l2_reg * np.dot(energy_params, energy_params)
+        grad += 2 * self.l2_reg * energy_params
+        return loss, grad
+
+    def likelihood(
+        self,
+        energy_params: NDArray[np.float64]
+    ) -> float:
+        """Return <E>_data + log <exp(-E)>_gen, the metric of Sonia._likelihood."""
+        energies, _ = self._energies(energy_params)
+        log_z, _ = self._log_z(energies)
+        return np.dot(self.data_weights, energies) / self.data_weights.sum() + log_z
+
+    def model_marginals(
+        self,
+        energy_params: NDArray[np.float64]
+    ) -> NDArray[np.float64]:
+        """Return the marginals of the features over the gen seqs weighted by Q."""
+        energies, _ = self._energies(energy_params)
+        _, gen_probs = self._log_z(energies)
+        return feature_sums(self.encoding, gen_probs)
+
+class SharedGenObjective(object):
+    """
+    Summed losses of several linear Sonia models sharing the same gen seqs.
+
+    The energies of the K models are the columns of a (number of features,
+    K) matrix, which the solvers see flattened in C order. The loss of each
+    model is that of a LinearObjective on its data seqs and the gen seqs, so
+    the minimizer is that of the K separate problems.
+
+    Attributes
+    ----------
+    data_encodings : list of scipy.sparse.csr_array or PaddedEncoding
+        The one-hot encodings of the data seqs of each model.
+    gen_encoding : scipy.sparse.csr_array
+        The one-hot encoding of the shared gen seqs.
+    data_weights : list of numpy.ndarray of numpy.float64
+        The weights of the data seqs of each model.
+    gen_weights : numpy.ndarray of numpy.float64
+        The weights of the gen seqs.
+    objective : str
+        'BCE' for the binary cross-entropy of the labels, or anything else
+        for the likelihood loss of Sonia._loss.
+    gamma : float
+        The weight of the gauge penalty of the likelihood loss.
+    l2_reg : float
+        The L2 penalty of the energies.
+    data_marginals : numpy.ndarray of numpy.float64
+        The weighted marginals of the features over the data seqs of each
+        model, one column per model.
+
+    Methods
+    -------
+    __call__(energy_params)
+        Return the summed loss and its gradient.
+    likelihoods(energy_params)
+        Return the likelihood metric of Sonia._likelihood of each model.
+    model_marginals(energy_params)
+        Return the marginals of the features over the Q-weighted gen seqs of each model.
+    """
+    def __init__(
+        self,
+        data_encodings: Sequence[sparse.csr_array | PaddedEncoding],
+        gen_encoding: sparse.csr_array | PaddedEncoding,
+        data_weights: Optional[Sequence[NDArray[np.float64]]] = None,
+        gen_weights: Optional[NDArray[np.float64]] = None,
+        objective: str = 'BCE',
+        gamma: float = 1.,
+        l2_reg: float = 0.,
+        min_energy_clip: float = -np.inf,
+        max_energy_clip: float = np.inf
+    ) -> None:
+        """
+        Parameters
+        ----------
+        data_encodings : sequence of scipy.sparse.csr_array or PaddedEncoding
+            The one-hot encodings of the data seqs of each model.
+        gen_encoding : scipy.sparse.csr_array or PaddedEncoding
+            The one-hot encoding of the shared gen seqs. A PaddedEncoding is
+            converted to a csr_array once, for the products with matrices.
+        data_weights : sequence of numpy.ndarray of numpy.float64, optional
+            The weight of each data sequence of each model, e.g. its multiplicity.
+        gen_weights : numpy.ndarray of numpy.float64, optional
+            The weight of each gen sequence.
+        objective : str, default 'BCE'
+            'BCE' for the binary cross-entropy, otherwise the likelihood loss.
+        gamma : float, default 1.
+            The weight of the gauge penalty of the likelihood loss.
+        l2_reg : float, default 0.
+            The L2 penalty of the energies.
+        min_energy_clip : float, optional
+            The energies are clipped from below, as by the Keras model.
+        max_energy_clip : float, optional
+            The energies are clipped from above, as by the Keras model.
+        """
+        self.data_encodings = list(data_encodings)
+        self.gen_encoding = as_csr(gen_encoding)
+        self.objective = objective
+        self.gamma = gamma
+        self.l2_reg = l2_reg
+        self.min_energy_clip = min_energy_clip
+        self.max_energy_clip = max_energy_clip
+        self.num_features = self.gen_encoding.shape[1]
+        self.num_models = len(self.data_encodings)
+
+        if data_weights is None:
+            data_weights = [np.ones(encoding.shape[0]) for encoding in self.data_encodings]
+        self.data_weights = [np.asarray(w, dtype=np.float64) for w in data_weights]
+        if gen_weights is None:
+            gen_weights = np.ones(self.gen_encoding.shape[0])
+        self.gen_weights = np.asarray(gen_weights, dtype=np.float64)
+        if (self.num_models == 0 or self.gen_weights.sum() == 0
+                or any(w.sum() == 0 for w in self.data_weights)):
+            raise RuntimeError('Both data and gen seqs are needed to compute the loss.')
+        self.data_totals = np.array([w.sum() for w in self.data_weights])
+        self.data_marginals = np.stack([
+            feature_sums(encoding, w) / w.sum()
+            for encoding, w in zip(self.data_encodings, self.data_weights)
+        ], axis=1)
+        self._last_gen = None
+
+    def _clip(
+        self,
+        energies: NDArray[np.float64]
+    ) -> Tuple[NDArray[np.float64], NDArray[np.bool_]]:
+        """Return the clipped energies and whether each one lies within the clips."""
+        unclipped = (energies >= self.min_energy_clip) & (energies <= self.max_energy_clip)
+        return np.clip(energies, self.min_energy_clip, self.max_energy_clip), unclipped
+
+    def _gen_terms(
+        self,
+        energy_params: NDArray[np.float64]
+    ) -> Tuple[NDArray[np.float64], NDArray[np.bool_], NDArray[np.float64], NDArray[np.float64]]:
+        """
+        Return the clipped gen energies of all models (one column per model),
+        whether they lie within the clips, log <exp(-E)>_gen of each model and
+        the normalized weights of the gen seqs in it.
+
+        The terms of the last energies are kept, since the solvers call back
+        with the energies they have just evaluated.
+        """
+        if self._last_gen is not None and np.array_equal(self._last_gen[0], energy_params):
+            return self._last_gen[1]
+        energies, unclipped = self._clip(self.gen_encoding @ energy_params)
+        shift = np.max(-energies[self.gen_weights > 0], axis=0)
+        q = self.gen_weights[:, None] * np.exp(-energies - shift)
+        totals = q.sum(axis=0)
+        terms = (energies, unclipped, np.log(totals / self.gen_weights.sum()) + shift, q / totals)
+        self._last_gen = (energy_params.copy(), terms)
+        return terms
+
+    def _data_energies(
+        self,
+        energy_params: NDArray[np.float64]
+    ) -> List[Tuple[NDArray[np.float64], NDArray[np.bool_]]]:
+        return [
+            self._clip(encoding_dot(encoding, energy_params[:, k]))
+            for k, encoding in enumerate(self.data_encodings)
+        ]
+
+    def __call__(
+        self,
+        flat_params: NDArray[np.float64]
+    ) -> Tuple[float, NDArray[np.float64]]:
+        """Return the summed loss (with the L2 penalty) and its flattened gradient."""
+        energy_params = flat_params.reshape(self.num_features, self.num_models)
+        gen_energies, gen_unclipped, log_z, gen_probs = self._gen_terms(energy_params)
+        grad = np.empty_like(energy_params)
+        if self.objective == 'BCE':
+            # As Keras, the weighted losses of each model are averaged over
+            # its (weighted) number of sequences.
+            totals = self.data_totals + self.gen_weights.sum()
+            loss = np.sum(
+                self.gen_weights @ (np.logaddexp(0, gen_energies) - gen_energies) / totals
+            )
+            gen_grad = self.gen_weights[:, None] * (expit(gen_energies) - 1) / totals
+            for k, (energies, unclipped) in enumerate(self._data_energies(energy_params)):
+                loss += np.dot(self.data_weights[k], np.logaddexp(0, energies)) / totals[k]
+                grad[:, k] = feature_sums(
+                    self.data_encodings[k],
+                    self.data_weights[k] * expit(energies) / totals[k] * unclipped
+                )
+        else:
+            loss = np.sum(log_z + self.gamma * log_z**2)
+            gen_grad = -(1 + 2 * self.gamma * log_z) * gen_probs
+            for k, (energies, unclipped) in enumerate(self._data_energies(energy_params)):
+                loss += np.dot(self.data_weights[k], energies) / self.data_totals[k]
+                grad[:, k] = feature_sums(
+                    self.data_encodings[k], self.data_weights[k] / self.data_totals[k] * unclipped
+                )
+        grad += self.gen_encoding.T @ (gen_grad * gen_unclipped)
+        loss += self.l2_reg * np.dot(flat_params, flat_params)
+        grad += 2 * self.l2_reg * energy_params
+        return loss, grad.ravel()
+
+    def likelihoods(
+        self,
+        flat_params: NDArray[np.float64]
+    ) -> NDArray[np.float64]:
+        """Return <E>_data + log <exp(-E)>_gen of each model, the metric of Sonia._likelihood."""
+        energy_params = flat_params.reshape(self.num_features, self.num_models)
+        _, _, log_z, _ = self._gen_terms(energy_params)
+        data_energies = np.array([
+            np.dot(w, energies) for w, (energies, _) in
+            zip(self.data_weights, self._data_energies(energy_params))
+        ])
+        return data_energies / self.data_totals + log_z
+
+    def model_marginals(
+        self,
+        flat_params: NDArray[np.float64]
+    ) -> NDArray[np.float64]:
+        """Return the marginals of the features over the Q-weighted gen seqs, one column per model."""
+        energy_params = flat_params.reshape(self.num_features, self.num_models)
+        _, _, _, gen_probs = self._gen_terms(energy_params)
+        return self.gen_encoding.T @ gen_probs
+
+def minimize_lbfgs(
+    objective: Callable[[NDArray[np.float64]], Tuple[float, NDArray[np.float64]]],
+    energy_params: NDArray[np.float64],
+    l1_reg: float = 0.,
+    tol: float = 1e-5,
+    max_iter: int = 1000,
+    callback: Optional[Callable[[NDArray[np.float64]], None]] = None
+) -> optimize.OptimizeResult:
+    """
+    Minimize objective(x) + l1_reg * |x|_1 with L-BFGS-B.
+
+    Parameters
+    ----------
+    objective : callable
+        Return the smooth loss and its gradient, e.g. a LinearObjective.
+    energy_params : numpy.ndarray of numpy.float64
+        The starting point.
+    l1_reg : float, default 0.
+        The L1 penalty. If positive, x is split into nonnegative parts
+        x = u - v, on which the penalty l1_reg * sum(u + v) is smooth.
+    tol : float, default 1e-5
+        Stop when the largest component of the projected gradient is below
+        tol.
+    max_iter : int, default 1000
+        The maximum number of iterations.
+    callback : callable, optional
+        Called with the energies after each iteration.
+
+    Returns
+    -------
+    scipy.optimize.OptimizeResult
+        The result, with the minimizing energies as x.
+    """
+    # The loss is flat near its minimum, so the relative decrease of the loss
+    # is a poor stopping criterion, and the gradient decides instead.
+    options = {'maxiter': max_iter, 'ftol': 1e-12, 'gtol': tol}
+    if l1_reg == 0:
+        return optimize.minimize(
+            objective, energy_params, jac=True, method='L-BFGS-B',
+            options=options, callback=callback
+        )
+
+    num_params = len(energy_params)
+    def split_objective(parts):
+        loss, grad = objective(parts[:num_params] - parts[num_params:])
+        loss += l1_reg * parts.sum()
+        return loss, np.concatenate((grad + l1_reg, l1_reg - grad))
+    def split_callback(parts):
+        if callback is not None:
+            callback(parts[:num_params] - parts[num_params:])
+
+    result = optimize.minimize(
+        split_objective,
+        np.concatenate((np.maximum(energy_params, 0), np.maximum(-energy_params, 0))),
+        jac=True, method='L-BFGS-B', bounds=[(0, None)] * (2 * num_params),
+        options=options, callback=split_callback
+    )
+    result.x = result.x[:num_params] - result.x[num_params:]
+    return result
+
+def minimize_proximal(
+    objective: Callable[[NDArray[np.float64]], Tuple[float, NDArray[np.float64]]],
+    energy_params: NDArray[np.float64],
+    l1_reg: float = 0.,
+    tol: float = 1e-5,
+    max_iter: int = 1000,
+    callback: Optional[Callable[[NDArray[np.float64]], None]] = None
+) -> optimize.OptimizeResult:
+    """
+    Minimize objective(x) + l1_reg * |x|_1 with accelerated proximal gradient steps.
+
+    The step size is found by backtracking, and the momentum is restarted
+    whenever the loss increases.
+
+    Parameters
+    ----------
+    objective : callable
+        Return the smooth loss and its gradient, e.g. a LinearObjective.
+    energy_params : numpy.ndarray of numpy.float64
+        The starting point.
+    l1_reg : float, default 0.
+        The L1 penalty, applied by soft-thresholding.
+    tol : float, default 1e-5
+        Stop when the largest component of the gradient mapping,
+        lipschitz * (y - x) for a step from y to x, is below tol. It is the
+        gradient for l1_reg = 0.
+    max_iter : int, default 1000
+        The maximum number of iterations.
+    callback : callable, optional
+        Called with the energies after each iteration.
+
+    Returns
+    -------
+    scipy.optimize.OptimizeResult
+        The result, with the minimizing energies as x.
+    """
+    def total_loss(x, smooth_loss):
+        return smooth_loss + l1_reg * np.abs(x).sum()
+
+    x = np.asarray(energy_params, dtype=np.float64)
+    smooth_loss, grad = objective(x)
+    loss = total_loss(x, smooth_loss)
+    momentum_point, momentum_loss, momentum_grad = x, smooth_loss, grad
+    t = 1.
+    lipschitz = 1.
+    num_evals = 1
+    success = False
+    for iteration in range(1, max_iter + 1):
+        # Backtrack until the quadratic model bounds the smooth loss.
+        while True:
+            step = momentum_point - momentum_grad / lipschitz
+            new_x = np.sign(step) * np.maximum(np.abs(step) - l1_reg / lipschitz, 0)
+            new_smooth_loss, new_grad = objective(new_x)
+            num_evals += 1
+            diff = new_x - momentum_point
+            if new_smooth_loss <= (momentum_loss + np.dot(momentum_grad, diff)
+                                   + lipschitz / 2 * np.dot(diff, diff)) + 1e-12:
+                break
+            lipschitz *= 2
+        new_loss = total_loss(new_x, new_smooth_loss)
+        converged = lipschitz * np.abs(diff).max(initial=0) <= tol
+
+        if new_loss > loss and not converged:
+            # Restart the momentum from the last iterate.
+            t = 1.
+            momentum_point, momentum_loss, momentum_grad = x, smooth_loss, grad
+            continue
+
+        new_t = (1 + np.sqrt(1 + 4 * t**2)) / 2
+        if t == 1:
+            momentum_point, momentum_loss, momentum_grad = new_x, new_smooth_loss, new_grad
+        else:
+            momentum_point = new_x + (t - 1) / new_t * (new_x - x)
+            momentum_loss, momentum_grad = objective(momentum_point)
+            num_evals += 1
+        x, smooth_loss, grad, loss, t = new_x, new_smooth_loss, new_grad, new_loss, new_t
+        # Let the step grow again.
+        lipschitz /= 2
+        if callback is not None:
+            callback(x)
+        if converged:
+            success = True
+            break
+
+    return optimize.OptimizeResult(
+        x=x, fun=loss, jac=grad, nit=iteration, nfev=num_evals, success=success,
+        message='Converged.' if success else 'Reached the maximum number of iterations.'
+    )
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Fused training of linear Sonia models that share the same gen seqs.
+
+Repertoires compared against the same generated sequences (e.g. one model
+per donor) each need a linear selection model, but the gen seqs only have
+to be filtered and encoded once. infer_selection_models trains all of them
+together from a template Sonia holding the gen seqs. The energies of the K
+models are the columns of one matrix, fit to convergence by the full-batch
+solvers of sonnia.linear_solver, so each evaluation of the loss makes one
+sparse product with the gen encoding for all models. The result is K
+ordinary Sonia objects, with their Z, gauge and marginals set as by
+Sonia.infer_selection, which can be saved with save_model.
+"""
+from __future__ import annotations
+import copy
+import logging
+from typing import *
+
+import numpy as np
+from numpy.typing import NDArray
+import pandas as pd
+
+from sonnia.feature_encoder import as_csr
+from sonnia.linear_solver import minimize_lbfgs, minimize_proximal, SharedGenObjective
+from sonnia.sonia import Sonia
+
+def infer_selection_models(
+    template: Sonia,
+    data_seqs: Sequence[Sequence[Sequence[str]] | pd.DataFrame | str],
+    solver: str = 'lbfgs',
+    seed: Optional[int | np.random.Generator | np.random.BitGenerator | np.random.SeedSequence] = None,
+    validation_split: float = 0.2,
+    set_gauge: bool = True,
+    tol: float = 1e-5,
+    max_iter: int = 1000,
+    verbose: int = 0,
+    **kwargs: Dict[str, Any]
+) -> List[Sonia]:
+    """
+    Train one linear selection model per set of data seqs against shared gen seqs.
+
+    Parameters
+    ----------
+    template : Sonia
+        A linear Sonia model holding the gen seqs and their encoding. Its
+        features, regularization, objective and weights (the starting point
+        of the training) are those of the returned models, which share its
+        gen seqs, gen encoding and gen marginals. Its data seqs are ignored.
+        The models are trained to convergence rather than for a few epochs,
+        so without l1_reg or l2_reg the energies of features which are rare
+        in the data grow until they are clipped. Set a regularization to get
+        models comparable to those of a few epochs of Sonia.infer_selection.
+    data_seqs : sequence
+        The data seqs of each model, in any form accepted by
+        Sonia.update_model.
+    solver : str, default 'lbfgs'
+        'lbfgs' or 'proximal', as in Sonia.infer_selection.
+    seed : int or np.random.Generator or np.random.BitGenerator or np.random.SeedSequence, optional
+        Sets the random seed of the validation split and of the models.
+    validation_split : float, default 0.2
+        The fraction of the gen seqs, and of the data seqs of each model,
+        used for validation. The validation gen seqs are the same for all
+        models.
+    set_gauge : bool, default True
+        Set the gauge of each model.
+    tol : float, default 1e-5
+        The tolerance of the solver.
+    max_iter : int, default 1000
+        The maximum number of iterations of the solver.
+    verbose : int, default 0
+        Log the likelihoods at each iteration.
+    **kwargs : dict of {str : any}
+        Keyword arguments for sonnia.utils.filter_seqs for preprocessing the
+        data seqs.
+
+    Returns
+    -------
+    list of Sonia
+        The trained models, in the order of data_seqs. Their likelihood_train,
+        likelihood_test and L1_converge_history hold one value per iteration.
+    """
+    if solver not in ('lbfgs', 'proximal'):
+        raise ValueError('solver must be \'lbfgs\' or \'proximal\'.')
+    if validation_split < 0 or validation_split >= 1:
+        raise ValueError('validation_split must be in [0, 1).')
+    linear_params = template.linear_energy_params()
+    if linear_params is None:
+        raise ValueError('Only linear models can be trained together.')
+    energy_params, min_clip, max_clip = linear_params
+    if template.l1_reg == 0 and template.l2_reg == 0:
+        logging.warning(
+            'The models are trained to convergence without regularization, so the '
+            'energies of rare features are only bounded by the energy clips.'
+        )
+    if template.gen_encoding.shape[0] == 0:
+        raise RuntimeError('No gen seqs were given. Cannot infer selection models.')
+
+    rng = np.random.default_rng(seed)
+    models = []
+    for seqs, child_state in zip(data_seqs, rng.bit_generator._seed_seq.spawn(len(data_seqs))):
+        model = _model_from_template(template, np.random.default_rng(child_state))
+        model.update_model(add_data_seqs=seqs, **kwargs)
+        if model.data_encoding.shape[0] == 0:
+            raise RuntimeError('No data seqs were given. Cannot infer a selection model.')
+        models.append(model)
+    if len(models) == 0:
+        return models
+
+    # The same gen seqs are held out for all the models.
+    gen_counts = _weights(template, template.gen_seq_counts)
+    gen_val, gen_train = _split(template.gen_encoding.shape[0], validation_split, rng)
+    data_splits = [
+        _split(model.data_encoding.shape[0], validation_split, model.rng) for model in models
+    ]
+    objective_kwargs = dict(
+        objective=template.objective, gamma=template.gamma, l2_reg=template.l2_reg,
+        min_energy_clip=min_clip, max_energy_clip=max_clip
+    )
+    train_objective = SharedGenObjective(
+        [model.data_encoding[train] for model, (_, train) in zip(models, data_splits)],
+        template.gen_encoding[gen_train],
+        [_weights(model, model.data_seq_counts)[train]
+         for model, (_, train) in zip(models, data_splits)],
+        gen_counts[gen_train], **objective_kwargs
+    )
+    if len(gen_val) == 0 or any(len(val) == 0 for val, _ in data_splits):
+        val_objective = None
+    else:
+        val_objective = SharedGenObjective(
+            [model.data_encoding[val] for model, (val, _) in zip(models, data_splits)],
+            template.gen_encoding[gen_val],
+            [_weights(model, model.data_seq_counts)[val]
+             for model, (val, _) in zip(models, data_splits)],
+            gen_counts[gen_val], **objective_kwargs
+        )
+
+    likelihood_train = []
+    likelihood_test = []
+    l1_converge_history = []
+    def record(params):
+        likelihood_train.append(-train_objective.likelihoods(params) * 1.44)
+        if val_objective is not None:
+            likelihood_test.append(-val_objective.likelihoods(params) * 1.44)
+        l1_converge_history.append(np.abs(
+            train_objective.data_marginals - train_objective.model_marginals(params)
+        ).sum(axis=0))
+        if verbose:
+            logging.info(
+                f'Iteration {len(likelihood_train)}: mean likelihood '
+                f'{likelihood_train[-1].mean():.6f}, largest L1 distance of the '
+                f'marginals {l1_converge_history[-1].max():.6f}.'
+            )
+
+    minimize = minimize_lbfgs if solver == 'lbfgs' else minimize_proximal
+    result = minimize(
+        train_objective,
+        np.repeat(energy_params.astype(np.float64)[:, None], len(models), axis=1).ravel(),
+        l1_reg=template.l1_reg, tol=tol, max_iter=max_iter, callback=record
+    )
+    if not result.success:
+        logging.warning(f'The {solver} solver did not converge: {result.message}')
+    fitted_params = result.x.reshape(-1, len(models)).astype(np.float32)
+    logging.info('Finished training.')
+
+    # Z, as in Sonia.infer_selection, from the energies of the gen seqs under
+    # all the models at once.
+    gen_encoding = as_csr(template.gen_encoding)
+    energies_gen = np.clip(gen_encoding @ fitted_params, min_clip, max_clip)
+    for k, model in enumerate(models):
+        model.learning_history = result
+        model.likelihood_train = np.array([values[k] for values in likelihood_train])
+        model.likelihood_test = np.array([values[k] for values in likelihood_test])
+        model.L1_converge_history = [float(values[k]) for values in l1_converge_history]
+        model.model.set_weights([fitted_params[:, k:k + 1]])
+        model.energies_gen = np.ascontiguousarray(energies_gen[:, k])
+        model.Z = np.average(
+            np.exp(-model.energies_gen), weights=model._seq_counts(model.gen_seq_counts)
+        )
+        if set_gauge and model.gene_features != 'vjl': model.set_gauge()
+    del energies_gen
+
+    # The model marginals of all the models, with their gauged energies.
+    logging.info('Updating marginals.')
+    gauged_params = np.concatenate([model.model.get_weights()[0] for model in models], axis=1)
+    energies = np.clip(
+        gen_encoding @ gauged_params,
+        [model.min_energy_clip for model in models],
+        [model.max_energy_clip for model in models]
+    )
+    qs = np.exp(-energies) * gen_counts[:, None]
+    model_marginals = (gen_encoding.T @ qs) / qs.sum(axis=0, dtype=np.float64)
+    for k, model in enumerate(models):
+        model.model_marginals = model_marginals[:, k]
+        model.model_params = model.model.get_weights()
+    logging.info('Finished updating marginals.')
+    return models
+
+def _model_from_template(
+    template: Sonia,
+    rng: np.random.Generator
+) -> Sonia:
+    """Return a copy of template without data seqs, sharing its gen seqs, with a new Keras model."""
+    model = copy.copy(template)
+    for attr in ('X', 'Y', 'W', 'energies_gen', 'learning_history'):
+        model.__dict__.pop(attr, None)
+    model.data_seqs = []
+    model.data_gene_ids = np.zeros((0, 0), dtype=np.int32)
+    model.data_seq_counts = np.zeros(0, dtype=np.int64)
+    model.data_encoding = np.array([])
+    model.data_marginals = np.zeros(len(template.features))
+    model.model_marginals = np.zeros(len(template.features))
+    model.L1_converge_history = []
+    model.likelihood_train = []
+    model.likelihood_test = []
+    model._logged_chunksizes = set()
+    model.clear_score_cache()
+    model.rng = rng
+    model.update_model_structure(initialize=True)
+    model.model.set_weights(template.model.get_weights())
+    return model
+
+def _weights(
+    model: Sonia,
+    counts: NDArray[np.int64]
+) -> NDArray[np.float64]:
+    """Return the multiplicities of the seqs of a deduplicated model, else ones."""
+    if model.deduplicate:
+        return counts.astype(np.float64)
+    return np.ones(len(counts))
+
+def _split(
+    num_seqs: int,
+    validation_split: float,
+    rng: np.random.Generator
+) -> Tuple[NDArray[np.int64], NDArray[np.int64]]:
+    """Return the shuffled rows of the validation seqs and of the training seqs."""
+    shuffle = rng.permutation(num_seqs)
+    val_end_idx = int(validation_split * num_seqs)
+    return np.sort(shuffle[:val_end_idx]), np.sort(shuffle[val_end_idx:])
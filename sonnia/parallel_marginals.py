@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Process-parallel weighted reductions over one-hot encodings.
+
+The CSR arrays of an encoding and the weights of its sequences are copied
+once into shared memory, so workers do not receive pickled slices. Each
+worker sums a contiguous range of rows into its own accumulator, chunk by
+chunk. The ranges cover every row. The accumulators are then added pairwise
+in a tree. These reductions back the marginals (feature_sums) and the joint
+marginals (cooccurrence_sums and cooccurrence_block_sums) of Sonia models.
+"""
+from __future__ import annotations
+import multiprocessing as mp
+from typing import *
+
+import numpy as np
+from numpy.typing import NDArray
+import scipy.sparse as sparse
+
+from sonnia.feature_encoder import (
+    _attach_shared, _shared_copy, as_csr, cooccurrence_block_sums, feature_sums, PaddedEncoding
+)
+
+# Per-process state of the workers of _parallel_reduce.
+_REDUCE_WORKER = {}
+
+def parallel_feature_sums(
+    encoding: sparse.csr_array | PaddedEncoding,
+    weights: Sequence[NDArray[np.floating]],
+    processes: int,
+    chunksize: int = int(1e5)
+) -> List[NDArray[np.float64]]:
+    """
+    Return the weighted number of sequences with each feature, for several weightings.
+
+    Parameters
+    ----------
+    encoding : scipy.sparse.csr_array or PaddedEncoding
+        The one-hot encoding.
+    weights : sequence of numpy.ndarray
+        The weight vectors, each with one weight per sequence.
+    processes : int
+        The number of worker processes.
+    chunksize : int, default int(1e5)
+        The number of sequences a worker sums at once.
+
+    Returns
+    -------
+    list of numpy.ndarray of numpy.float64
+        The sums, one per weight vector (as feature_sums).
+    """
+    return _parallel_reduce('feature_sums', encoding, weights, processes, chunksize)
+
+def parallel_cooccurrence_sums(
+    encoding: sparse.csr_array | PaddedEncoding,
+    weights: Sequence[NDArray[np.floating]],
+    processes: int,
+    chunksize: int = int(1e5),
+    columns: Optional[Tuple[NDArray[np.int64], NDArray[np.int64]]] = None
+) -> List[sparse.csr_array]:
+    """
+    Return the weighted number of sequences with each pair of features.
+
+    Parameters
+    ----------
+    encoding : scipy.sparse.csr_array or PaddedEncoding
+        The one-hot encoding.
+    weights : sequence of numpy.ndarray
+        The weight vectors, each with one weight per sequence.
+    processes : int
+        The number of worker processes.
+    chunksize : int, default int(1e5)
+        The number of sequences a worker multiplies at once.
+    columns : tuple of two numpy.ndarray of numpy.int64, optional
+        The features of the rows and of the columns of the sums. Defaults to
+        all features for both.
+
+    Returns
+    -------
+    list of scipy.sparse.csr_array of numpy.float64
+        The sums, one per weight vector (as cooccurrence_sums).
+    """
+    return parallel_cooccurrence_block_sums(
+        encoding, weights, processes, [columns], chunksize
+    )[0]
+
+def parallel_cooccurrence_block_sums(
+    encoding: sparse.csr_array | PaddedEncoding,
+    weights: Sequence[NDArray[np.floating]],
+    processes: int,
+    blocks: Sequence[Optional[Tuple[NDArray[np.int64], NDArray[np.int64]]]],
+    chunksize: int = int(1e5)
+) -> List[List[sparse.csr_array]]:
+    """
+    Return the weighted pair counts of several blocks of features with one pool.
+
+    Parameters
+    ----------
+    encoding : scipy.sparse.csr_array or PaddedEncoding
+        The one-hot encoding.
+    weights : sequence of numpy.ndarray
+        The weight vectors, each with one weight per sequence.
+    processes : int
+        The number of worker processes.
+    blocks : sequence of tuple of two numpy.ndarray of numpy.int64
+        The features of the rows and of the columns of each block. None
+        stands for all features.
+    chunksize : int, default int(1e5)
+        The number of sequences a worker multiplies at once.
+
+    Returns
+    -------
+    list of list of scipy.sparse.csr_array of numpy.float64
+        For each block, the sums, one per weight vector (as
+        cooccurrence_block_sums).
+    """
+    sums = _parallel_reduce(
+        'cooccurrence_sums', encoding, weights, processes, chunksize, list(blocks)
+    )
+    # The accumulators are flat, block by block.
+    num_weights = max(len(weights), 1)
+    return [sums[i:i + num_weights] for i in range(0, len(sums), num_weights)]
+
+def _parallel_reduce(
+    reduction: str,
+    encoding: sparse.csr_array | PaddedEncoding,
+    weights: Sequence[NDArray[np.floating]],
+    processes: int,
+    chunksize: int,
+    blocks: Optional[List[Optional[Tuple[NDArray[np.int64], NDArray[np.int64]]]]] = None
+) -> List[Any]:
+    encoding = as_csr(encoding)
+    num_seqs = encoding.shape[0]
+    weights = np.stack([np.asarray(w, dtype=np.float64) for w in weights])
+
+    shared_blocks = []
+    try:
+        specs = {}
+        for key, arr in (('indptr', encoding.indptr), ('indices', encoding.indices),
+                         ('weights', weights)):
+            block, _ = _shared_copy(arr)
+            shared_blocks.append(block)
+            specs[key] = (block.name, arr.shape, arr.dtype.str)
+
+        # One contiguous range of rows per worker, the last one ending at num_seqs.
+        bounds = np.linspace(0, num_seqs, processes + 1).astype(np.int64)
+        tasks = [
+            (reduction, start, stop, chunksize)
+            for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start
+        ]
+        with mp.Pool(processes=processes, initializer=_init_reduce_worker,
+                     initargs=(specs, encoding.shape, blocks)) as pool:
+            partial_sums = pool.map(_reduce_rows, tasks)
+    finally:
+        for block in shared_blocks:
+            block.close()
+            block.unlink()
+
+    if len(partial_sums) == 0:
+        # No rows, so the sums of an empty chunk are the zeros.
+        return _reduce_chunk(reduction, encoding, weights, blocks)
+    return _tree_sum(partial_sums)
+
+def _tree_sum(
+    partial_sums: List[List[Any]]
+) -> List[Any]:
+    """Add lists of accumulators pairwise until one list remains."""
+    while len(partial_sums) > 1:
+        paired = [
+            [left + right for left, right in zip(partial_sums[i], partial_sums[i + 1])]
+            for i in range(0, len(partial_sums) - 1, 2)
+        ]
+        if len(partial_sums) % 2 == 1:
+            paired.append(partial_sums[-1])
+        partial_sums = paired
+    return partial_sums[0]
+
+def _reduce_chunk(
+    reduction: str,
+    chunk: sparse.csr_array,
+    weights: NDArray[np.float64],
+    blocks: Optional[List[Optional[Tuple[NDArray[np.int64], NDArray[np.int64]]]]]
+) -> List[Any]:
+    if reduction == 'feature_sums':
+        return [feature_sums(chunk, w) for w in weights]
+    return [
+        block_sum
+        for block_sums in cooccurrence_block_sums(
+            chunk, weights, blocks, max(chunk.shape[0], 1)
+        )
+        for block_sum in block_sums
+    ]
+
+def _init_reduce_worker(
+    specs: Dict[str, Tuple[str, Tuple[int, ...], str]],
+    shape: Tuple[int, int],
+    blocks: Optional[List[Optional[Tuple[NDArray[np.int64], NDArray[np.int64]]]]]
+) -> None:
+    # The blocks are kept so that the arrays stay valid.
+    _REDUCE_WORKER['blocks'] = []
+    for key, spec in specs.items():
+        block, arr = _attach_shared(spec)
+        _REDUCE_WORKER['blocks'].append(block)
+        _REDUCE_WORKER[key] = arr
+    _REDUCE_WORKER['num_features'] = shape[1]
+    _REDUCE_WORKER['feature_blocks'] = blocks
+
+def _reduce_rows(
+    task: Tuple[str, int, int, int]
+) -> List[Any]:
+    """Sum the rows start:stop of the shared encoding into one accumulator."""
+    reduction, start, stop, chunksize = task
+    indptr = _REDUCE_WORKER['indptr']
+    totals = None
+    for chunk_start in range(start, stop, chunksize):
+        chunk_stop = min(chunk_start + chunksize, stop)
+        chunk_indptr = indptr[chunk_start:chunk_stop + 1]
+        chunk_indices = _REDUCE_WORKER['indices'][chunk_indptr[0]:chunk_indptr[-1]]
+        chunk = sparse.csr_array(
+            (np.ones(len(chunk_indices), dtype=np.int8), chunk_indices,
+             chunk_indptr - chunk_indptr[0]),
+            shape=(chunk_stop - chunk_start, _REDUCE_WORKER['num_features'])
+        )
+        sums = _reduce_chunk(
+            reduction, chunk, _REDUCE_WORKER['weights'][:, chunk_start:chunk_stop],
+            _REDUCE_WORKER['feature_blocks']
+        )
+        totals = sums if totals is None else [
+            total + chunk_sum for total, chunk_sum in zip(totals, sums)
+        ]
+    return totals
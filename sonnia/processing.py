@@ -1,10 +1,10 @@
 import os
-from typing import Optional, Set
+from typing import Optional
 
 import numpy as np
 import pandas as pd
 
-from sonnia.utils import define_pgen_model, gene_to_num_str
+from sonnia.utils import define_pgen_model, GeneVocabulary
 
 class Processing(object):
     def __init__(self,
@@ -78,8 +78,8 @@ class Processing(object):
         Drops unrecongised genes and pseudogenes.
         '''
         
-        v_sel=self.df[self.v_col].apply(lambda x: gene_to_num_str(x,'V') in self.good_vs)
-        j_sel=self.df[self.j_col].apply(lambda x: gene_to_num_str(x,'J') in self.good_js)
+        v_sel=np.isin(self.gene_vocabulary.gene_ids(self.df[self.v_col].values,'V'),self.good_v_ids)
+        j_sel=np.isin(self.gene_vocabulary.gene_ids(self.df[self.j_col].values,'J'),self.good_j_ids)
         self.df['selection_genes']=np.logical_and(v_sel,j_sel)
 
         '''
@@ -152,14 +152,19 @@ class Processing(object):
         (self.genomic_data, _, self.pgen_model, _,
          _, pgen_dir) = define_pgen_model(self.pgen_model, compute_norm=False,return_pgen_dir=True)
 
+        self.gene_vocabulary = GeneVocabulary(self.genomic_data)
+
         def get_functional_genes(fin: str
-                                ) -> Set[str]:
+                                ) -> np.ndarray:
             df = pd.read_csv(fin)
             df = df.loc[df['function'] == 'F']
-            return df['gene'].apply(lambda x: gene_to_num_str(x,fin.split('/')[-1][0]))
+            gene_ids = self.gene_vocabulary.gene_ids(df['gene'].values,fin.split('/')[-1][0])
+            return np.unique(gene_ids[gene_ids >= 0])
 
-        self.good_vs = set(get_functional_genes(os.path.join(pgen_dir, 'V_gene_CDR3_anchors.csv')))
-        self.good_js = set(get_functional_genes(os.path.join(pgen_dir, 'J_gene_CDR3_anchors.csv')))
+        self.good_v_ids = get_functional_genes(os.path.join(pgen_dir, 'V_gene_CDR3_anchors.csv'))
+        self.good_j_ids = get_functional_genes(os.path.join(pgen_dir, 'J_gene_CDR3_anchors.csv'))
+        self.good_vs = {self.gene_vocabulary.num_strs['V'][v] for v in self.good_v_ids}
+        self.good_js = {self.gene_vocabulary.num_strs['J'][j] for j in self.good_j_ids}
 
     def recreate_full_sequence(self,
                                ntcdr3: str,
@@ -180,8 +185,8 @@ class Processing(object):
         """
         chain = self.genomic_data.genV[0][0][:3].lower()
         try:
-            V = self.pgen_model.V_mask_mapping[gene_to_num_str(V,'V')][0]
-            J = self.pgen_model.J_mask_mapping[gene_to_num_str(J,'J')][0]
+            V = self.pgen_model.V_mask_mapping[self.gene_vocabulary.num_str(V,'V')][0]
+            J = self.pgen_model.J_mask_mapping[self.gene_vocabulary.num_str(J,'J')][0]
         except:
             return 'fail'
         fullV_gene = self.genomic_data.genV[V][2]
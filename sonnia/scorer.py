@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""NumPy scoring of sequences with exported Sonia, SoNNia and paired models.
+
+A trained model is exported with NumpyScorer.from_model and saved to a single
+.npz file. Loading and evaluating a scorer imports neither keras nor
+tensorflow, which keeps the start-up time and memory of scoring workers low.
+Linear models are evaluated as a sparse matrix-vector product. Other models
+are evaluated layer by layer from the exported weights of their Keras graph.
+
+NumpyScorer.quantize stores the linear weights and the Dense and
+EmbedViaMatrix kernels in float16, or in int8 with one scale per weight
+array, which cuts the memory traffic of scoring. The stored weights are
+used as they are: linear energies gather them at the columns of the
+encoding and matrix products read the quantized kernels, with the sums
+accumulated in float32 and multiplied by the scale of the weights
+afterwards. quantization_report gives the error in log Q and the measured
+speedup of quantized scorers against the float32 one on a pool of
+sequences. The speedup is close to 1 while the float32 weights fit in the
+CPU caches, since reading the encoding then dominates the scoring time.
+"""
+from __future__ import annotations
+import json
+import time
+from typing import *
+
+import numpy as np
+from numpy.typing import NDArray
+import scipy.sparse as sparse
+
+from sonnia.feature_encoder import (
+    ChainSpec, FeatureEncoder, PaddedEncoding, SINGLE_CHAIN
+)
+
+_ACTIVATIONS = {
+    'linear': lambda x: x,
+    'tanh': np.tanh,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+}
+
+PRECISIONS = ('float32', 'float16', 'int8')
+# The layers whose first weight array (the kernel) is quantized.
+_QUANTIZED_LAYERS = ('Dense', 'EmbedViaMatrix')
+
+class NumpyScorer(object):
+    """
+    Selection factors Q of a Sonia, SoNNia or paired model computed with NumPy.
+
+    Attributes
+    ----------
+    features : list of tuple of str
+        The model features.
+    Z : float
+        The normalization of the selection factors.
+    chains : tuple of sonnia.feature_encoder.ChainSpec
+        The chain columns and feature prefixes of the sequences.
+    cross_chain : tuple
+        The across chain gene features (see sonnia.feature_encoder.FeatureEncoder).
+    linear_weights : numpy.ndarray or None
+        The feature energies of a linear model, in the storage precision.
+    linear_scale : float
+        The factor of linear_weights giving the energies (1 unless int8).
+    min_energy_clip : float
+        The minimum energy of a linear model.
+    max_energy_clip : float
+        The maximum energy of a linear model.
+    layers : list of dict
+        The layers of a non-linear model in topological order, with their
+        type, input names, configuration, weights and the scales of the
+        weights (1 unless int8).
+    input_cols : list of numpy.ndarray of numpy.int64
+        For each input of a non-linear model, the encoding columns which fill
+        it, in the shape of the input (as split_encoding).
+    output : str
+        The name of the layer giving the energies of a non-linear model.
+    precision : str
+        The storage precision of the weights: 'float32', 'float16' or 'int8'.
+
+    Methods
+    -------
+    from_model(qm)
+        Export a trained model.
+    save(save_file)
+        Save the scorer to a single .npz file.
+    load(load_file)
+        Load a saved scorer.
+    quantize(precision)
+        Return a copy of a float32 scorer with weights stored in float16 or int8.
+    encode(seqs)
+        One-hot encode sequences.
+    compute_energy(encoding)
+        Return the energies of encoded sequences.
+    evaluate_selection_factors(seqs)
+        Return the normalized selection factors of sequences.
+    """
+    def __init__(
+        self,
+        features: Sequence[Sequence[str]],
+        Z: float,
+        chains: Sequence[ChainSpec] = SINGLE_CHAIN,
+        cross_chain: Sequence = (),
+        linear_weights: Optional[NDArray[np.float32]] = None,
+        min_energy_clip: float = -np.inf,
+        max_energy_clip: float = np.inf,
+        layers: Optional[List[Dict[str, Any]]] = None,
+        input_cols: Optional[List[NDArray[np.int64]]] = None,
+        output: Optional[str] = None,
+        precision: str = 'float32',
+        linear_scale: float = 1.
+    ) -> None:
+        if linear_weights is None and layers is None:
+            raise ValueError('Either linear_weights or layers must be given.')
+        if precision not in PRECISIONS:
+            raise ValueError(f'precision must be one of {PRECISIONS}, not {precision}.')
+        self.features = [tuple(feature) for feature in features]
+        self.feature_dict = {feature: i for i, feature in enumerate(self.features)}
+        self.Z = float(Z)
+        self.chains = tuple(ChainSpec(*chain) for chain in chains)
+        self.cross_chain = tuple(
+            tuple(tuple(part) for part in cross_feature) for cross_feature in cross_chain
+        )
+        self.linear_weights = linear_weights
+        self.min_energy_clip = float(min_energy_clip)
+        self.max_energy_clip = float(max_energy_clip)
+        self.layers = layers
+        self.input_cols = input_cols
+        self.output = output
+        self.precision = precision
+        self.linear_scale = float(linear_scale)
+        self._encoder = FeatureEncoder(
+            self.feature_dict, len(self.features), chains=self.chains,
+            cross_chain=self.cross_chain
+        )
+
+    @classmethod
+    def from_model(
+        cls,
+        qm: Any
+    ) -> NumpyScorer:
+        """
+        Export a trained Sonia, SoNNia, SoniaPaired or SoNNiaPaired model.
+
+        Parameters
+        ----------
+        qm : sonnia.sonia.Sonia
+            The model. Its Keras graph may contain Dense, EmbedViaMatrix,
+            Activation, Flatten, Concatenate, BatchNormalization and the
+            clipping Lambda layers.
+
+        Returns
+        -------
+        NumpyScorer
+            The scorer of the model.
+        """
+        encoder = qm.feature_encoder()
+        kwargs = {
+            'features': qm.features, 'Z': qm.Z, 'chains': encoder.chains,
+            'cross_chain': encoder.cross_chain,
+        }
+
+        linear_params = qm.linear_energy_params()
+        if linear_params is not None:
+            weights, min_clip, max_clip = linear_params
+            return cls(
+                linear_weights=np.asarray(weights, dtype=np.float32),
+                min_energy_clip=min_clip, max_energy_clip=max_clip, **kwargs
+            )
+
+        # Encoding columns end up in the inputs as split_encoding places them.
+        probe = np.arange(len(qm.features))[np.newaxis]
+        if hasattr(qm, 'split_encoding'):
+            input_cols = [np.asarray(part[0]) for part in qm.split_encoding(probe)]
+        else:
+            input_cols = [probe[0]]
+
+        model = qm.model
+        names = {id(model_input): f'input_{i}' for i, model_input in enumerate(model.inputs)}
+        pending = [layer for layer in model.layers if type(layer).__name__ != 'InputLayer']
+        layers = []
+        while pending:
+            remaining = []
+            for layer in pending:
+                layer_inputs = layer.input
+                if not isinstance(layer_inputs, (list, tuple)):
+                    layer_inputs = [layer_inputs]
+                if not all(id(layer_input) in names for layer_input in layer_inputs):
+                    remaining.append(layer)
+                    continue
+                layers.append({
+                    'name': layer.name,
+                    'type': type(layer).__name__,
+                    'inputs': [names[id(layer_input)] for layer_input in layer_inputs],
+                    'config': _layer_config(layer),
+                    'weights': [np.asarray(w, dtype=np.float32) for w in layer.get_weights()],
+                })
+                names[id(layer.output)] = layer.name
+            if len(remaining) == len(pending):
+                raise ValueError('The model graph cannot be ordered from its inputs.')
+            pending = remaining
+
+        return cls(
+            layers=layers, input_cols=input_cols, output=names[id(model.output)], **kwargs
+        )
+
+    def save(
+        self,
+        save_file: str
+    ) -> None:
+        """Save the scorer to a single .npz file."""
+        header = {
+            'features': self.features, 'Z': self.Z, 'chains': self.chains,
+            'cross_chain': self.cross_chain, 'min_energy_clip': self.min_energy_clip,
+            'max_energy_clip': self.max_energy_clip, 'output': self.output,
+            'precision': self.precision, 'linear_scale': self.linear_scale,
+        }
+        arrays = {}
+        if self.linear_weights is not None:
+            arrays['linear_weights'] = self.linear_weights
+        if self.layers is not None:
+            header['layers'] = [
+                {key: value for key, value in layer.items() if key != 'weights'}
+                | {'num_weights': len(layer['weights'])}
+                for layer in self.layers
+            ]
+            for i, layer in enumerate(self.layers):
+                for j, weights in enumerate(layer['weights']):
+                    arrays[f'weights_{i}_{j}'] = weights
+            for i, cols in enumerate(self.input_cols):
+                arrays[f'input_cols_{i}'] = cols
+            header['num_inputs'] = len(self.input_cols)
+
+        with open(save_file, 'wb') as scorer_file:
+            np.savez(scorer_file, header=np.array(json.dumps(header)), **arrays)
+
+    @classmethod
+    def load(
+        cls,
+        load_file: str
+    ) -> NumpyScorer:
+        """Load a scorer saved by NumpyScorer.save."""
+        with np.load(load_file, allow_pickle=False) as npz:
+            header = json.loads(str(npz['header']))
+            kwargs = {
+                'features': header['features'], 'Z': header['Z'],
+                'chains': header['chains'], 'cross_chain': header['cross_chain'],
+                'min_energy_clip': header['min_energy_clip'],
+                'max_energy_clip': header['max_energy_clip'], 'output': header['output'],
+                'precision': header.get('precision', 'float32'),
+                'linear_scale': header.get('linear_scale', 1.),
+            }
+            if 'linear_weights' in npz.files:
+                kwargs['linear_weights'] = npz['linear_weights']
+            if 'layers' in header:
+                layers = []
+                for i, layer in enumerate(header['layers']):
+                    num_weights = layer.pop('num_weights')
+                    layer['weights'] = [npz[f'weights_{i}_{j}'] for j in range(num_weights)]
+                    layers.append(layer)
+                kwargs['layers'] = layers
+                kwargs['input_cols'] = [
+                    npz[f'input_cols_{i}'] for i in range(header['num_inputs'])
+                ]
+        return cls(**kwargs)
+
+    def quantize(
+        self,
+        precision: str
+    ) -> NumpyScorer:
+        """
+        Return a copy of the scorer with its weights stored in lower precision.
+
+        The linear weights, or the kernels of the Dense and EmbedViaMatrix
+        layers, are stored in float16, or in int8 scaled by their largest
+        absolute value. Biases and normalization weights are kept in float32.
+
+        Parameters
+        ----------
+        precision : str
+            'float16', 'int8', or 'float32' for an unquantized copy.
+
+        Returns
+        -------
+        NumpyScorer
+            The quantized scorer.
+        """
+        if self.precision != 'float32':
+            raise RuntimeError(f'The scorer is already quantized to {self.precision}.')
+        if precision not in PRECISIONS:
+            raise ValueError(f'precision must be one of {PRECISIONS}, not {precision}.')
+
+        kwargs = {
+            'features': self.features, 'Z': self.Z, 'chains': self.chains,
+            'cross_chain': self.cross_chain, 'min_energy_clip': self.min_energy_clip,
+            'max_energy_clip': self.max_energy_clip, 'output': self.output,
+            'input_cols': self.input_cols, 'precision': precision,
+        }
+        if self.linear_weights is not None:
+            kwargs['linear_weights'], kwargs['linear_scale'] = _quantize_array(
+                self.linear_weights, precision
+            )
+        if self.layers is not None:
+            layers = []
+            for layer in self.layers:
+                layer = dict(layer)
+                layer['weights'] = list(layer['weights'])
+                layer['scales'] = [1.] * len(layer['weights'])
+                if layer['type'] in _QUANTIZED_LAYERS:
+                    layer['weights'][0], layer['scales'][0] = _quantize_array(
+                        layer['weights'][0], precision
+                    )
+                layers.append(layer)
+            kwargs['layers'] = layers
+        return type(self)(**kwargs)
+
+    @property
+    def weight_nbytes(
+        self
+    ) -> int:
+        """The memory taken by the stored weights."""
+        if self.linear_weights is not None:
+            return self.linear_weights.nbytes
+        return sum(weights.nbytes for layer in self.layers for weights in layer['weights'])
+
+    def encode(
+        self,
+        seqs: Sequence[Sequence[str]] | NDArray[str]
+    ) -> sparse.csr_array:
+        """One-hot encode sequences (as Sonia.encode_data)."""
+        return self._encoder.encode(seqs)
+
+    def compute_energy(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding,
+        chunksize: int = int(1e4)
+    ) -> NDArray[np.float32]:
+        """
+        Return the energies of one-hot encoded sequences.
+
+        Parameters
+        ----------
+        encoding : scipy.sparse.csr_array or sonnia.feature_encoder.PaddedEncoding
+            The one-hot encoding of the sequences.
+        chunksize : int, default int(1e4)
+            The number of sequences densified at once by non-linear models.
+
+        Returns
+        -------
+        energies : numpy.ndarray of numpy.float32
+            The energies of the sequences.
+        """
+        if self.linear_weights is not None:
+            energies = _gather_sums(encoding, self.linear_weights) * np.float32(self.linear_scale)
+            return np.clip(energies, self.min_energy_clip, self.max_energy_clip).astype(np.float32)
+
+        energies = [np.zeros(0, dtype=np.float32)]
+        for start_idx in range(0, encoding.shape[0], chunksize):
+            dense_encoding = encoding[start_idx:start_idx + chunksize].toarray()
+            energies.append(self._forward(dense_encoding, self.layers))
+        return np.concatenate(energies)
+
+    def evaluate_selection_factors(
+        self,
+        seqs: Sequence[Sequence[str]] | NDArray[str]
+    ) -> NDArray[np.float32]:
+        """Return the normalized selection factors Q of sequences."""
+        return np.exp(-self.compute_energy(self.encode(seqs))) / self.Z
+
+    def _forward(
+        self,
+        dense_encoding: NDArray[np.int8],
+        layers: List[Dict[str, Any]]
+    ) -> NDArray[np.float32]:
+        # The columns are gathered from the int8 encoding, then converted.
+        values = {
+            f'input_{i}': dense_encoding[:, cols].astype(np.float32)
+            for i, cols in enumerate(self.input_cols)
+        }
+        for layer in layers:
+            values[layer['name']] = _apply_layer(layer, [values[name] for name in layer['inputs']])
+        return values[self.output][:, 0].astype(np.float32)
+
+def quantization_report(
+    scorer: NumpyScorer,
+    seqs: Sequence[Sequence[str]] | NDArray[str],
+    precisions: Sequence[str] = ('float16', 'int8'),
+    repeats: int = 3
+) -> Dict[str, Dict[str, float]]:
+    """
+    Compare quantized scorers with a float32 scorer on a pool of sequences.
+
+    Parameters
+    ----------
+    scorer : NumpyScorer
+        The float32 scorer, e.g. NumpyScorer.from_model(qm).
+    seqs : list or numpy.ndarray
+        The sequences scored, typically a held-out pool of generated sequences
+        (e.g. qm.generate_sequences_pre(int(1e5))).
+    precisions : sequence of str, default ('float16', 'int8')
+        The precisions compared.
+    repeats : int, default 3
+        The number of times each scorer scores the pool.
+
+    Returns
+    -------
+    report : dict
+        For each precision, the maximum and mean absolute error in log Q,
+        the scoring time in seconds (the best of repeats), the speedup over
+        the float32 scorer and the size of the weights in bytes. The
+        'float32' entry gives the time and size of the reference.
+    """
+    if scorer.precision != 'float32':
+        raise ValueError('The reference scorer must be float32.')
+    encoding = scorer.encode(seqs)
+    # log Q = -E - log Z, and Z is the same for all precisions.
+    energies, seconds = _timed_energies(scorer, encoding, repeats)
+    reference = -energies.astype(np.float64)
+    report = {'float32': {
+        'max_abs_log_q_error': 0., 'mean_abs_log_q_error': 0., 'seconds': seconds,
+        'speedup': 1., 'weight_nbytes': scorer.weight_nbytes,
+    }}
+    for precision in precisions:
+        quantized = scorer.quantize(precision)
+        energies, quantized_seconds = _timed_energies(quantized, encoding, repeats)
+        errors = np.abs(-energies.astype(np.float64) - reference)
+        report[precision] = {
+            'max_abs_log_q_error': float(errors.max(initial=0.)),
+            'mean_abs_log_q_error': float(errors.mean()) if len(errors) else 0.,
+            'seconds': quantized_seconds,
+            'speedup': seconds / quantized_seconds if quantized_seconds > 0 else np.inf,
+            'weight_nbytes': quantized.weight_nbytes,
+        }
+    return report
+
+def _timed_energies(
+    scorer: NumpyScorer,
+    encoding: sparse.csr_array | PaddedEncoding,
+    repeats: int
+) -> Tuple[NDArray[np.float32], float]:
+    """Return the energies of encoding and the shortest time taken to compute them."""
+    seconds = np.inf
+    for _ in range(max(repeats, 1)):
+        start = time.perf_counter()
+        energies = scorer.compute_energy(encoding)
+        seconds = min(seconds, time.perf_counter() - start)
+    return energies, seconds
+
+def _quantize_array(
+    weights: NDArray[np.float32],
+    precision: str
+) -> Tuple[NDArray, float]:
+    """Return weights stored in precision and the factor which restores them."""
+    if precision == 'float32':
+        return np.asarray(weights, dtype=np.float32), 1.
+    if precision == 'float16':
+        return np.asarray(weights, dtype=np.float16), 1.
+    max_abs = float(np.max(np.abs(weights), initial=0.))
+    scale = max_abs / 127 if max_abs > 0 else 1.
+    return np.round(weights / scale).astype(np.int8), scale
+
+def _gather_sums(
+    encoding: sparse.csr_array | PaddedEncoding,
+    weights: NDArray
+) -> NDArray[np.float32]:
+    """Return encoding @ weights for stored weights, gathered in their dtype and summed in float32."""
+    if isinstance(encoding, PaddedEncoding):
+        # The padding index -1 gathers the appended zero.
+        weights = np.append(weights, np.zeros(1, dtype=weights.dtype))
+        return weights[encoding.idxs].sum(axis=1, dtype=np.float32)
+    encoding = sparse.csr_array(encoding)
+    sums = np.zeros(encoding.shape[0], dtype=np.float32)
+    nonempty = np.diff(encoding.indptr) > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(
+            weights[encoding.indices], encoding.indptr[:-1][nonempty], dtype=np.float32
+        )
+    return sums
+
+def _scaled_matmul(
+    inputs: NDArray[np.float32],
+    weights: NDArray,
+    scale: float
+) -> NDArray[np.float32]:
+    """Return inputs @ (scale * weights), scaling the float32 product instead of the weights."""
+    outputs = np.matmul(inputs, weights, dtype=np.float32)
+    if scale != 1:
+        outputs *= np.float32(scale)
+    return outputs
+
+def _layer_config(
+    layer: Any
+) -> Dict[str, Any]:
+    """Return the part of the configuration of a Keras layer used by _apply_layer."""
+    layer_type = type(layer).__name__
+    config = layer.get_config()
+    if layer_type == 'Dense':
+        return {'activation': config['activation'], 'use_bias': config['use_bias']}
+    if layer_type == 'Activation':
+        return {'activation': config['activation']}
+    if layer_type == 'Concatenate':
+        return {'axis': config['axis']}
+    if layer_type == 'BatchNormalization':
+        return {'epsilon': float(config['epsilon']), 'center': config['center'],
+                'scale': config['scale']}
+    if layer_type == 'Lambda':
+        if getattr(layer.function, '__name__', None) != 'clip':
+            raise ValueError('Only clipping Lambda layers can be exported.')
+        return {'x_min': float(layer.arguments['x_min']),
+                'x_max': float(layer.arguments['x_max'])}
+    if layer_type in ('EmbedViaMatrix', 'Flatten'):
+        return {}
+    raise ValueError(f'Layers of type {layer_type} cannot be exported.')
+
+def _apply_layer(
+    layer: Dict[str, Any],
+    inputs: List[NDArray[np.float32]]
+) -> NDArray[np.float32]:
+    """Evaluate an exported layer in inference mode."""
+    layer_type = layer['type']
+    config = layer['config']
+    weights = layer['weights']
+    if layer_type == 'Dense':
+        outputs = _scaled_matmul(inputs[0], weights[0], layer.get('scales', [1.])[0])
+        if config['use_bias']:
+            outputs = outputs + weights[1]
+        return _ACTIVATIONS[config['activation']](outputs)
+    if layer_type == 'EmbedViaMatrix':
+        return _scaled_matmul(inputs[0], weights[0], layer.get('scales', [1.])[0])
+    if layer_type == 'Activation':
+        return _ACTIVATIONS[config['activation']](inputs[0])
+    if layer_type == 'Flatten':
+        return inputs[0].reshape(len(inputs[0]), -1)
+    if layer_type == 'Concatenate':
+        return np.concatenate(inputs, axis=config['axis'])
+    if layer_type == 'BatchNormalization':
+        weights = list(weights)
+        gamma = weights.pop(0) if config['scale'] else 1
+        beta = weights.pop(0) if config['center'] else 0
+        moving_mean, moving_variance = weights
+        return (gamma * (inputs[0] - moving_mean)
+                / np.sqrt(moving_variance + config['epsilon']) + beta)
+    if layer_type == 'Lambda':
+        return np.clip(inputs[0], config['x_min'], config['x_max'])
+    raise ValueError(f'Layers of type {layer_type} cannot be evaluated.')
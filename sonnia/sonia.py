@@ -5,11 +5,14 @@ Created on Wed Jan 30 12:06:58 2019
 @author: Giulio Isacchini and Zachary Sethna
 """
 from __future__ import print_function, division, absolute_import
+import hashlib
 import inspect
 import itertools
 import logging
 import multiprocessing as mp
 import os
+import queue
+import threading
 from typing import *
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
 
@@ -22,17 +25,77 @@ from keras.models import load_model, Model
 from keras.optimizers import RMSprop
 from keras.regularizers import l1_l2, l2
 import numpy as np
-from numpy.typing import ArrayLike, NDArray
+from numpy.typing import ArrayLike, DTypeLike, NDArray
+import pandas as pd
 import scipy.sparse as sparse
 from tqdm import tqdm
 
-from sonnia.sonia_dataset import SoniaDataset
+from sonnia.checkpoint import load_checkpoint, TrainingCheckpoint
+from sonnia.encoding_cache import EncodingCache, hash_features, hash_seqs
+from sonnia.feature_encoder import (
+    as_csr, as_seq_array, cooccurrence_block_sums, encoding_dot, EncodingView, FeatureEncoder,
+    feature_sums, is_encoding, PaddedEncoding, vstack_encodings
+)
+from sonnia.joint_marginals import feature_groups, JointMarginalBlocks
+from sonnia.linear_solver import LinearObjective, minimize_lbfgs, minimize_proximal
+from sonnia.parallel_marginals import parallel_cooccurrence_block_sums, parallel_feature_sums
+from sonnia.sonia_dataset import PlanEpochs, SoniaDataset
 from sonnia.utils import (
     CSV_READER_PARAMS, compute_pgen_expand, compute_pgen_expand_novj, define_pgen_model,
-    filter_seqs, gene_to_num_str, get_model_dir, partial_joint_marginals
+    deduplicate_seqs, filter_seqs, get_model_dir, GeneVocabulary, LRUCache
 )
 
 FILTER_SEQS_PARAMS = inspect.signature(filter_seqs).parameters.keys()
+# Rough size of a generated or read sequence with its csr encoding row, used
+# with Sonia.energy_row_bytes to size chunks of sequences.
+SEQ_ROW_BYTES = 1024
+# Below this number of sequences, marginals are summed in the main process
+# since starting the worker processes takes longer.
+PARALLEL_MIN_SEQS = int(1e5)
+
+def _get_unless_stopped(
+    items: queue.Queue,
+    stop: threading.Event
+) -> Any:
+    """Return the next item of a queue, or None once stop is set."""
+    while not stop.is_set():
+        try:
+            return items.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+def _put_unless_stopped(
+    items: queue.Queue,
+    item: Any,
+    stop: threading.Event
+) -> bool:
+    """Put an item in a queue unless stop is set first, and return whether it was put."""
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def iter_encoding_chunks(
+    encoding: sparse.csr_array | PaddedEncoding | Iterable[Any]
+) -> Iterator[sparse.csr_array | PaddedEncoding]:
+    """
+    Iterate over the chunks of an encoding.
+
+    A sparse array (or PaddedEncoding) is a single chunk. Otherwise, encoding
+    is an iterable of encodings or of tuples ending with one, e.g. the
+    (seqs, encoding) pairs yielded by Sonia.iter_encode.
+    """
+    if is_encoding(encoding):
+        yield encoding
+        return
+    for encoding_chunk in encoding:
+        if isinstance(encoding_chunk, tuple):
+            encoding_chunk = encoding_chunk[-1]
+        yield encoding_chunk
 
 logging.getLogger().setLevel(logging.INFO)
 logging.basicConfig(format='%(asctime)s: %(message)s')
@@ -72,7 +135,7 @@ class Sonia(object):
         Array of the marginals of each feature over the model weighted gen_seqs
     L1_converge_history : list
         L1 distance between data_marginals and model_marginals at each
-        iteration.
+        iteration of the 'lbfgs' and 'proximal' solvers of infer_selection.
     chain_type : str
         Type of receptor. This specification is used to determine gene names
         and allow integrated OLGA sequence generation. Options: 'humanTRA',
@@ -126,6 +189,12 @@ class Sonia(object):
         max_energy_clip: int = 10,
         seed: Optional[int | np.random.Generator | np.random.BitGenerator | np.random.SeedSequence] = None,
         processes: Optional[int] = None,
+        padded_encoding: bool = False,
+        encoding_cache: Optional[str] = None,
+        encoding_cache_max_bytes: int = 10 * 2**30,
+        deduplicate: bool = False,
+        score_cache_size: int = 0,
+        memory_budget: Optional[int] = None,
         **kwargs: Dict[str, Any]
     ) -> None:
         """
@@ -137,6 +206,35 @@ class Sonia(object):
             Load the data and generated sequences used for training the ppost model.
         seed : int, optional
             The seed used for the random number generator.
+        padded_encoding : bool, default False
+            Store the data and gen encodings as
+            sonnia.feature_encoder.PaddedEncoding (a padded matrix of feature
+            columns) instead of scipy.sparse.csr_array, which takes less memory.
+        encoding_cache : str, optional
+            Directory of an on-disk cache of filtered sequences and encodings,
+            keyed by the content of the sequences and by the model features.
+            Models built from the same sequence pools then skip filtering and
+            encoding them again.
+        encoding_cache_max_bytes : int, default 10 GiB
+            The size of the encoding cache above which the least recently
+            used entries are removed.
+        deduplicate : bool, default False
+            Store only the distinct data and gen sequences, together with their
+            multiplicities (data_seq_counts and gen_seq_counts). Marginals,
+            the normalization Z and the training loss weight each sequence by
+            its multiplicity, so repeated sequences are encoded and scored once.
+        score_cache_size : int, default 0
+            The number of sequences whose energy and Pgen are memoized by
+            evaluate_seqs and evaluate_selection_factors, with least recently
+            used eviction. 0 disables the memo. Energies are dropped when the
+            model weights change, and Q is always computed with the current Z.
+            See score_cache_info and clear_score_cache.
+        memory_budget : int, optional
+            The number of bytes the working arrays of a chunk may take. When
+            given, compute_energy, generate_sequences_post, joint_marginals
+            and the training mini-batches size their chunks from it and the
+            number of features instead of using fixed chunk sizes, and refuse
+            to run when a single sequence does not fit. See budget_chunksize.
         **kwargs : dict of {str : any}
             Keyword arguments for sonnia.utils.filter_seqs for preprocessing.
         """
@@ -169,15 +267,31 @@ class Sonia(object):
                                  'One of them must be None.')
             self.load_pgen_model()
 
+        self.padded_encoding = padded_encoding
+        if encoding_cache is None:
+            self.encoding_cache = None
+        else:
+            self.encoding_cache = EncodingCache(encoding_cache, encoding_cache_max_bytes)
         self.features = np.array(features, dtype=object)
         self.feature_dict = {tuple(f): i for i, f in enumerate(self.features)}
         self.data_seqs = []
         self.gen_seqs = []
+        self.data_gene_ids = np.zeros((0, 0), dtype=np.int32)
+        self.gen_gene_ids = np.zeros((0, 0), dtype=np.int32)
+        self.deduplicate = deduplicate
+        self.score_cache_size = score_cache_size
+        self.clear_score_cache()
+        self.memory_budget = memory_budget
+        self._logged_chunksizes = set()
+        self.data_seq_counts = np.zeros(0, dtype=np.int64)
+        self.gen_seq_counts = np.zeros(0, dtype=np.int64)
         self.data_encoding = np.array([])
         self.gen_encoding = np.array([])
         self.data_marginals = np.zeros(len(features))
         self.gen_marginals = np.zeros(len(features))
         self.model_marginals = np.zeros(len(features))
+        # The weights, number of gen seqs and total Q of the last model_marginals.
+        self._model_marginals_state = None
         self.L1_converge_history = []
         self.l2_reg = l2_reg
         self.l1_reg = l1_reg
@@ -191,6 +305,7 @@ class Sonia(object):
         self.max_depth = max_depth
         self.max_L = max_L
         if processes is None: self.processes = mp.cpu_count()
+        else: self.processes = processes
         self.gamma = gamma
         self.Z = 1.
         self.amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
@@ -222,13 +337,14 @@ class Sonia(object):
         -------
         None
         """
+        v_genes = self.gene_vocabulary.genomic_num_strs('V')
+        j_genes = self.gene_vocabulary.genomic_num_strs('J')
+
         features = []
         if self.gene_features == 'vjl':
             features += [[v, j, 'l'+str(l)]
-                         for v in set([gene_to_num_str(genV[0],'V')
-                                       for genV in self.genomic_data.genV])
-                         for j in set([gene_to_num_str(genJ[0],'J')
-                                       for genJ in self.genomic_data.genJ])
+                         for v in v_genes
+                         for j in j_genes
                          for l in range(1, self.max_L + 1)]
         else:
             features += [['l' + str(L)] for L in range(1, self.max_L + 1)]
@@ -239,17 +355,13 @@ class Sonia(object):
 
         if self.gene_features == 'joint_vj':
             features += [[v, j]
-                         for v in set([gene_to_num_str(genV[0],'V')
-                                       for genV in self.genomic_data.genV])
-                         for j in set([gene_to_num_str(genJ[0],'J')
-                                       for genJ in self.genomic_data.genJ])]
+                         for v in v_genes
+                         for j in j_genes]
 
         if self.gene_features in {'indep_vj', 'v'}:
-            features += [[v] for v in set([gene_to_num_str(genV[0],'V')
-                                           for genV in self.genomic_data.genV])]
+            features += [[v] for v in v_genes]
         if self.gene_features in {'indep_vj', 'j'}:
-            features += [[j] for j in set([gene_to_num_str(genJ[0],'J')
-                                           for genJ in self.genomic_data.genJ])]
+            features += [[j] for j in j_genes]
 
         self.update_model(add_features=features)
 
@@ -294,8 +406,8 @@ class Sonia(object):
             if bkd_key in feature_dict:
                 seq_features.add(feature_dict[bkd_key])
 
-        v_key = (gene_to_num_str(seq[1], 'V'),)
-        j_key = (gene_to_num_str(seq[2], 'J'),)
+        v_key = (self.gene_vocabulary.num_str(seq[1], 'V'),)
+        j_key = (self.gene_vocabulary.num_str(seq[2], 'J'),)
         vj_key = v_key + j_key
         vjl_key = v_key + j_key + cdr3_len_key
         if v_key in feature_dict:
@@ -309,14 +421,67 @@ class Sonia(object):
 
         return list(seq_features)
 
+    def feature_encoder(
+        self,
+        features: Optional[Sequence[Tuple[str]]] = None,
+    ) -> FeatureEncoder:
+        """
+        Return a vectorized encoder of the model (or the given) features.
+
+        Parameters
+        ----------
+        features: sequence of tuples of str, optional
+            An iterable containing tuples of features. If None, the model
+            features are used.
+
+        Returns
+        -------
+        sonnia.feature_encoder.FeatureEncoder
+            The encoder of the features.
+        """
+        vocabularies = (self.gene_vocabulary,)
+        if features is None:
+            return FeatureEncoder(
+                self.feature_dict, len(self.features), vocabularies=vocabularies
+            )
+        feature_dict = {tuple(feature): idx for idx, feature in enumerate(features)}
+        return FeatureEncoder(feature_dict, len(features), vocabularies=vocabularies)
+
+    def gene_ids(
+        self,
+        sequences: Sequence[Sequence[str]]
+    ) -> NDArray[np.int32]:
+        """
+        Map the V and J genes of sequences to their IDs in the gene vocabulary.
+
+        Parameters
+        ----------
+        sequences : sequence of sequence of str
+            A sequence of receptor sequences (e.g., CDR3 amino acid, V gene,
+            and J gene strings.)
+
+        Returns
+        -------
+        numpy.ndarray of numpy.int32
+            Array with the V and J gene IDs of each sequence (and of each
+            chain for paired models).
+        """
+        return self.feature_encoder().gene_ids(sequences)
+
     def encode_data(
         self,
         sequences: Sequence[Sequence[str]],
         features: Optional[Sequence[Tuple[str]]] = None,
-    ) -> sparse.csr_array:
+        gene_ids: Optional[NDArray[np.int32]] = None,
+        padded: Optional[bool] = None
+    ) -> sparse.csr_array | PaddedEncoding:
         """
         One-hot encode all the features from the given sequences with a sparse matrix.
 
+        The encoding is computed by sonnia.feature_encoder.FeatureEncoder and
+        matches the features found by find_seq_features for each sequence.
+        Large inputs are split into chunks encoded by self.processes workers.
+
         Parameters
         ----------
         sequences : sequence of sequence of str
@@ -324,39 +489,118 @@ class Sonia(object):
             and J gene strings.)
         features: sequence of tuples of str, optional
             An iterable containing tuples of features.
+        gene_ids : numpy.ndarray of numpy.int32, optional
+            The gene IDs of the sequences as returned by gene_ids. They are
+            computed from the sequences if None.
+        padded : bool, optional
+            Return a sonnia.feature_encoder.PaddedEncoding instead of a
+            csr_array. Defaults to self.padded_encoding.
 
         Returns
         -------
-        csr_arr : scipy.sparse.csr_array
+        csr_arr : scipy.sparse.csr_array or sonnia.feature_encoder.PaddedEncoding
             A sparse array representation of the one-hot encoding.
         """
-        if features is not None:
-            feature_dict = {
-                tuple(feature): idx for idx, feature in enumerate(features)
-            }
-            num_features = len(features)
-        else:
-            num_features = len(self.features)
+        if padded is None:
+            padded = self.padded_encoding
 
-        indices = []
-        indptr = [0]
+        if self.encoding_cache is not None:
+            cache_key = self.encoding_cache.key(
+                'encoding', hash_features(self.features if features is None else features),
+                hash_seqs(sequences), padded
+            )
+            encoding = self.encoding_cache.load_encoding(cache_key)
+            if encoding is not None:
+                logging.info('Loaded the encoding from the encoding cache.')
+                return encoding
+
+        encoding = self.feature_encoder(features).encode(
+            sequences, gene_ids=gene_ids, processes=self.processes, padded=padded,
+            verbose=True
+        )
+        if self.encoding_cache is not None:
+            self.encoding_cache.save_encoding(cache_key, encoding)
+        return encoding
+
+    def iter_encode(
+        self,
+        seqs: str | Iterable[Sequence[str]],
+        chunksize: int = int(1e5),
+        features: Optional[Sequence[Tuple[str]]] = None,
+        filter_sequences: bool = True,
+        **kwargs: Dict[str, Any]
+    ) -> Iterator[Tuple[NDArray[str], sparse.csr_array]]:
+        """
+        Read, filter and one-hot encode sequences one chunk at a time.
 
-        tqdm_desc = 'Encoding sequence features'
-        for seq in tqdm(sequences, position=0, desc=tqdm_desc):
-            specified_features = self.find_seq_features(seq, features)
-            indices += specified_features
-            indptr.append(len(specified_features) + indptr[-1])
+        Only one chunk of sequences and its encoding are held in memory, so
+        repertoires larger than the available RAM can be evaluated. The
+        generator can be passed to compute_energy and compute_marginals.
 
-        data = np.ones(len(indices), dtype=np.int8)
-        csr_arr = sparse.csr_array(
-            (data, indices, indptr),
-            shape=(len(sequences), num_features)
-        )
-        return csr_arr
+        Parameters
+        ----------
+        seqs : str or iterable of sequence of str
+            The path to a CSV or TSV file (optionally gzip compressed), or an
+            iterable of sequences, which may be a generator.
+        chunksize : int, default int(1e5)
+            The number of sequences (rows of the file) read at once.
+        features: sequence of tuples of str, optional
+            An iterable containing tuples of features. If None, the model
+            features are used.
+        filter_sequences : bool, default True
+            Apply sonia.utils.filter_seqs to every chunk (not done for paired
+            models, as in update_model). Deduplication of nucleotide
+            recombinations is then done within each chunk only. If False, the
+            columns of the chunk are used as they are.
+        **kwargs : dict of {str : any}
+            Keyword arguments for sonnia.utils.filter_seqs and pandas.read_csv.
+            The separator defaults to a tab for .tsv and .tsv.gz files.
+
+        Yields
+        ------
+        seqs_chunk : numpy.ndarray of str
+            The (filtered) sequences of the chunk.
+        encoding_chunk : scipy.sparse.csr_array or sonnia.feature_encoder.PaddedEncoding
+            The one-hot encoding of seqs_chunk (padded if self.padded_encoding).
+        """
+        filter_kwargs = {key: val for key, val in kwargs.items()
+                         if key in FILTER_SEQS_PARAMS}
+        csv_kwargs = {key: val for key, val in kwargs.items()
+                      if key not in FILTER_SEQS_PARAMS}
+        for keyword in csv_kwargs:
+            if keyword not in CSV_READER_PARAMS:
+                raise RuntimeError(f'Unknown keyword: {keyword}.')
+        filter_sequences = filter_sequences and 'Paired' not in type(self).__name__
+
+        if isinstance(seqs, str):
+            if 'sep' not in csv_kwargs and 'delimiter' not in csv_kwargs:
+                if seqs.endswith(('.tsv', '.tsv.gz')):
+                    csv_kwargs['sep'] = '\t'
+            chunks = pd.read_csv(seqs, chunksize=chunksize, dtype=str, **csv_kwargs)
+        else:
+            iterator = iter(seqs)
+            chunks = iter(lambda: list(itertools.islice(iterator, chunksize)), [])
+
+        encoder = self.feature_encoder(features)
+        for chunk in chunks:
+            if filter_sequences:
+                seqs_chunk = filter_seqs(
+                    chunk, self, verbose=False, raise_if_empty=False, **filter_kwargs
+                )
+            elif isinstance(chunk, pd.DataFrame):
+                seqs_chunk = chunk.to_numpy(dtype=str)
+            else:
+                seqs_chunk = as_seq_array(chunk, encoder.chains)
+            if len(seqs_chunk) == 0:
+                continue
+            yield seqs_chunk, encoder.encode(
+                seqs_chunk, chunksize=chunksize, processes=self.processes,
+                padded=self.padded_encoding
+            )
 
     def encoding_to_feature_strs(
         self,
-        encoding: sparse.csr_array,
+        encoding: sparse.csr_array | PaddedEncoding,
         features: Optional[Sequence[Tuple[str]]] = None
     ) -> Sequence[Sequence[Tuple[str]]]:
         """
@@ -364,7 +608,7 @@ class Sonia(object):
 
         Parameters
         ----------
-        encoding : scipy.sparse.csr_array
+        encoding : scipy.sparse.csr_array or sonnia.feature_encoder.PaddedEncoding
             The sparse representation of one-hot encoded sequence features.
         features : sequence of tuples of str, optional
             A sequence containing tuples of features.
@@ -379,6 +623,7 @@ class Sonia(object):
             np_features = np.fromiter(self.feature_dict.keys(), dtype=object)
         else:
             np_features = np.array(features)
+        encoding = as_csr(encoding)
 
         feature_strs = []
         zipped = zip(encoding.indptr[:-1], encoding.indptr[1:])
@@ -392,7 +637,7 @@ class Sonia(object):
 
     def encoding_to_feature_idxs(
         self,
-        encoding: sparse.csr_array,
+        encoding: sparse.csr_array | PaddedEncoding,
     ) -> Sequence[Sequence[int]]:
         """
         Convert the one-hot encoded sequences to a list of the indices corresponding
@@ -400,7 +645,7 @@ class Sonia(object):
 
         Parameters
         ----------
-        encoding : scipy.sparse.csr_array
+        encoding : scipy.sparse.csr_array or sonnia.feature_encoder.PaddedEncoding
             The sparse representation of one-hot encoded sequences.
 
         Returns
@@ -409,6 +654,7 @@ class Sonia(object):
             Each sublist contains all the features of the sequence represented
             as ints.
         """
+        encoding = as_csr(encoding)
         feature_idxs = []
         zipped = zip(encoding.indptr[:-1], encoding.indptr[1:])
         tqdm_desc = 'Getting feature indices'
@@ -421,29 +667,61 @@ class Sonia(object):
 
     def compute_energy(
         self,
-        encoding: sparse.csr_array,
-        chunksize: int = int(1e6),
+        encoding: sparse.csr_array | PaddedEncoding | Iterable[Any],
+        chunksize: Optional[int] = None,
         verbose: bool = True,
+        prefetch: int = 1,
     ) -> NDArray[np.float32]:
         """
         Compute the energy of a list of sequences according to the model.
 
         Parameters
         ----------
-        encoding : scipy.sparse.csr_array
-            Sparse representation of one-hot-encoded sequence features.
-        chunksize : int, default int(1e6)
+        encoding : scipy.sparse.csr_array, PaddedEncoding or iterable
+            Sparse representation of one-hot-encoded sequence features, or an
+            iterable of encoding chunks or of (seqs, encoding) pairs, such as
+            the generator returned by iter_encode.
+        chunksize : int, optional
             The amount of sequences to be evaluated in a single call to the model.
             Since a dense one-hot encoding is used, RAM usage will blow up for
-            very large amounts of sequences.
+            very large amounts of sequences. Defaults to the number of
+            sequences fitting in memory_budget (see energy_row_bytes), or to
+            int(1e6) without a budget. It is capped by memory_budget.
         verbose : bool, default True
             Show a progress bar for the chunks being evaluated.
+        prefetch : int, default 1
+            The number of chunks a background thread prepares (densifies and
+            splits) while the model evaluates the current chunk. Each
+            prefetched chunk holds one more input buffer in memory. 0
+            evaluates the chunks one after the other. Linear models, which
+            are not densified, ignore it.
 
         Returns
         -------
         energies : numpy.ndarray of numpy.float32
             Energies of sequences according to the model.
         """
+        if not is_encoding(encoding):
+            energies = [
+                self.compute_energy(encoding_chunk, chunksize, verbose=False, prefetch=prefetch)
+                for encoding_chunk in tqdm(
+                    iter_encoding_chunks(encoding), position=0,
+                    desc='Computing energies', disable=not verbose
+                )
+            ]
+            if len(energies) == 0:
+                return np.zeros(0, dtype=np.float32)
+            return np.concatenate(energies)
+
+        # A linear model is a sparse matrix-vector product followed by the
+        # clip, so neither densifying nor Keras are needed.
+        linear_params = self.linear_energy_params()
+
+        if linear_params is not None:
+            prefetch = 0
+        chunksize = self.budget_chunksize(
+            'compute_energy', self.energy_row_bytes(prefetch), int(1e6), chunksize
+        )
         length_encoding = encoding.shape[0]
         num_slices = (
             length_encoding // chunksize
@@ -453,39 +731,257 @@ class Sonia(object):
         energies = []
         tqdm_desc = 'Computing energies'
         disable = not verbose
+        if linear_params is None and prefetch > 0 and num_slices > 1:
+            with tqdm(
+                total=num_slices, position=0, desc=tqdm_desc, disable=disable
+            ) as progress:
+                energies = self._pipelined_model_energies(
+                    encoding, chunksize, prefetch, progress
+                )
+            return np.concatenate(energies)
+
         for idx in tqdm(
             range(num_slices), position=0, desc=tqdm_desc, disable=disable
         ):
             start_idx = idx * chunksize
             encoding_slice = encoding[start_idx:start_idx + chunksize]
 
-            dense_encoding = encoding_slice.toarray()
+            if linear_params is not None:
+                weights, min_clip, max_clip = linear_params
+                # Summed in float64 so that csr_array and PaddedEncoding give
+                # the same float32 energies.
+                energies_slice = encoding_dot(encoding_slice, weights.astype(np.float64))
+                energies.append(
+                    np.clip(energies_slice, min_clip, max_clip).astype(np.float32)
+                )
+                continue
 
-            if hasattr(self, 'split_encoding'):
-                dense_encoding = self.split_encoding(dense_encoding)
-            try:
-                energies_slice = self.model(dense_encoding)[:, 0].numpy()
-            except Exception as e:
-                if 'Failed copying' in str(e):
-                    raise RuntimeError(
-                        'There is not enough GPU memory available to copy the '
-                        'one-hot encoding from CPU to GPU. Try requesting more '
-                        'GPU memory or using a smaller chunksize when calling '
-                        'this function (compute_energy).'
-                    )
-                else:
-                    raise e
-            energies.append(energies_slice)
+            energies.append(self._model_energies(encoding_slice))
 
         energies = np.concatenate(energies)
         return energies
 
+    def energy_row_bytes(
+        self,
+        prefetch: int = 1
+    ) -> int:
+        """
+        Return the bytes taken per sequence by the working arrays of compute_energy.
+
+        A linear model takes its float64 energies. Other models hold the
+        model inputs of prefetch + 1 chunks and the float32 outputs of all
+        the layers of the model.
+        """
+        if self.linear_energy_params() is not None:
+            return 16
+        activation_bytes = 0
+        for layer in self.model.layers:
+            outputs = layer.output
+            if not isinstance(outputs, (list, tuple)):
+                outputs = [outputs]
+            for output in outputs:
+                activation_bytes += 4 * int(np.prod(output.shape[1:]))
+        return self._input_row_bytes() * (prefetch + 1) + activation_bytes
+
+    def _input_row_bytes(
+        self
+    ) -> int:
+        """Return the bytes per sequence of the inputs built by _model_inputs."""
+        return len(self.features)
+
+    def budget_chunksize(
+        self,
+        stage: str,
+        row_bytes: int,
+        default: int,
+        chunksize: Optional[int] = None
+    ) -> int:
+        """
+        Return the number of sequences a stage processes at once.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage, used in the log and error messages.
+        row_bytes : int
+            The bytes taken per sequence by the working arrays of the stage.
+        default : int
+            The chunk size used without memory_budget and chunksize.
+        chunksize : int, optional
+            A requested chunk size. It is used as is without memory_budget and
+            capped by memory_budget otherwise.
+
+        Returns
+        -------
+        chunksize : int
+            The chunk size. With memory_budget, it is the number of sequences
+            of row_bytes fitting in the budget unless chunksize is smaller.
+        """
+        if self.memory_budget is None:
+            return default if chunksize is None else chunksize
+        if row_bytes > self.memory_budget:
+            raise RuntimeError(
+                f'A single sequence takes {row_bytes} bytes in {stage}, which '
+                f'exceeds the memory_budget of {self.memory_budget} bytes.'
+            )
+        budget_rows = int(self.memory_budget // max(row_bytes, 1))
+        if chunksize is not None and chunksize <= budget_rows:
+            return chunksize
+        if (stage, budget_rows) not in self._logged_chunksizes:
+            self._logged_chunksizes.add((stage, budget_rows))
+            logging.info(f'{stage}: chunks of {budget_rows} sequences of '
+                         f'{row_bytes} bytes for a memory_budget of '
+                         f'{self.memory_budget} bytes.')
+        return budget_rows
+
+    def _pipelined_model_energies(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding,
+        chunksize: int,
+        prefetch: int,
+        progress: tqdm
+    ) -> List[NDArray[np.float32]]:
+        """
+        Evaluate the model on chunks of an encoding prepared by a background thread.
+
+        The producer thread builds the model inputs of the next chunks into
+        prefetch + 1 recycled buffers, and a bounded queue hands them to the
+        model, so the chunk being evaluated and the prepared ones are the
+        only ones in memory.
+        """
+        ready_inputs = queue.Queue(maxsize=prefetch)
+        free_buffers = queue.Queue()
+        for _ in range(prefetch + 1):
+            # Buffers are allocated by the first chunks which use them.
+            free_buffers.put(None)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for start_idx in range(0, encoding.shape[0], chunksize):
+                    buffer = _get_unless_stopped(free_buffers, stop)
+                    if stop.is_set():
+                        return
+                    model_inputs = self._model_inputs(
+                        encoding[start_idx:start_idx + chunksize], buffer
+                    )
+                    if not _put_unless_stopped(ready_inputs, model_inputs, stop):
+                        return
+                _put_unless_stopped(ready_inputs, None, stop)
+            except BaseException as e:
+                _put_unless_stopped(ready_inputs, e, stop)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        energies = []
+        try:
+            while True:
+                model_inputs = ready_inputs.get()
+                if model_inputs is None:
+                    break
+                if isinstance(model_inputs, BaseException):
+                    raise model_inputs
+                inputs, buffer = model_inputs
+                energies.append(self._call_model(inputs))
+                # The model has copied the inputs, so the buffer can be refilled.
+                del inputs, model_inputs
+                free_buffers.put(buffer)
+                progress.update()
+        finally:
+            stop.set()
+            producer.join()
+        return energies
+
+    def _model_energies(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding
+    ) -> NDArray[np.float32]:
+        """
+        Evaluate the Keras model on a chunk of a one-hot encoding.
+        """
+        return self._call_model(self._model_inputs(encoding)[0])
+
+    def _model_inputs(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding,
+        buffer: Optional[NDArray] = None
+    ) -> Tuple[Any, Optional[NDArray]]:
+        """
+        Return the Keras inputs of a chunk of an encoding and the buffer holding them.
+
+        The dense encoding is written to buffer when it is large enough, and
+        the returned buffer can be passed again for the next chunk.
+        """
+        dtype = np.int8 if isinstance(encoding, PaddedEncoding) else encoding.dtype
+        if (buffer is None or buffer.shape[0] < encoding.shape[0]
+                or buffer.shape[1:] != encoding.shape[1:] or buffer.dtype != dtype):
+            buffer = np.empty(encoding.shape, dtype=dtype)
+        dense_encoding = buffer[:encoding.shape[0]]
+        # csr_array.toarray adds to out, so it must start from zeros.
+        dense_encoding.fill(0)
+        encoding.toarray(out=dense_encoding)
+
+        if hasattr(self, 'split_encoding'):
+            dense_encoding = self.split_encoding(dense_encoding)
+        return dense_encoding, buffer
+
+    def _call_model(
+        self,
+        inputs: Any
+    ) -> NDArray[np.float32]:
+        """Return the energies of the Keras model on the inputs of _model_inputs."""
+        try:
+            return self.model(inputs)[:, 0].numpy()
+        except Exception as e:
+            if 'Failed copying' in str(e):
+                raise RuntimeError(
+                    'There is not enough GPU memory available to copy the '
+                    'one-hot encoding from CPU to GPU. Try requesting more '
+                    'GPU memory or using a smaller chunksize when calling '
+                    'this function (compute_energy).'
+                )
+            else:
+                raise e
+
+    def linear_energy_params(
+        self
+    ) -> Optional[Tuple[NDArray[np.float32], float, float]]:
+        """
+        Return the feature energies and clip bounds of a linear model.
+
+        Returns
+        -------
+        params : tuple of (numpy.ndarray of numpy.float32, float, float) or None
+            The feature energies and the minimum and maximum energy clips if
+            the model is the linear model built by update_model_structure
+            (one bias-free linear Dense layer followed by the clip), otherwise
+            None.
+        """
+        if hasattr(self, 'split_encoding'):
+            return None
+        layers = [
+            layer for layer in self.model.layers
+            if not isinstance(layer, keras.layers.InputLayer)
+        ]
+        if len(layers) != 2:
+            return None
+        dense, clip = layers
+        if (not isinstance(dense, Dense) or dense.use_bias or dense.units != 1
+                or dense.activation is not keras.activations.linear):
+            return None
+        if not isinstance(clip, Lambda) or clip.function is not ko.clip:
+            return None
+        return (
+            dense.get_weights()[0][:, 0], clip.arguments['x_min'], clip.arguments['x_max']
+        )
+
     def compute_marginals(
         self,
-        encoding: Optional[sparse.csr_array] = None,
+        encoding: Optional[sparse.csr_array | PaddedEncoding | Iterable[Any]] = None,
         seqs: Optional[Sequence[Sequence[str]]] = None,
         features: Optional[Sequence[Tuple[str]]] = None,
         use_flat_distribution: bool = False,
+        counts: Optional[NDArray[np.int64]] = None,
     ) -> np.ndarray:
         """Computes the marginals of each feature over sequences.
 
@@ -499,8 +995,10 @@ class Sonia(object):
 
         Parameters
         ----------
-        encoding : scipy.sparse.csr_array, optional
-            A sparse represention of the one hot encoded sequence features.
+        encoding : scipy.sparse.csr_array, PaddedEncoding or iterable, optional
+            A sparse represention of the one hot encoded sequence features, or
+            an iterable of encoding chunks or of (seqs, encoding) pairs, such
+            as the generator returned by iter_encode.
         seqs : sequence of sequence of str, optional
             List of sequences to compute the feature marginals over. Note, each
             'sequence' is a list where the first element is the CDR3 sequence
@@ -512,6 +1010,9 @@ class Sonia(object):
             Marginals will be computed using a flat distribution (each seq is
             weighted as 1) if True. If False, the marginals are computed using
             model weights (each sequence is weighted as exp(-E) = Q).
+        counts : numpy.ndarray of numpy.int64, optional
+            The multiplicity of each sequence, e.g. data_seq_counts of a
+            deduplicated model. Each sequence is additionally weighted by it.
 
         Returns
         -------
@@ -536,20 +1037,53 @@ class Sonia(object):
         if seqs is not None:
             encoding = self.encode_data(seqs, features)
 
-        if use_flat_distribution:
-            marginals = (
-                np.bincount(encoding.indices, minlength=num_features) / encoding.shape[0]
-            )
-        else:
-            energies = self.compute_energy(encoding)
-            qs = sparse.csr_array(np.exp(-energies))
-            marginals = (qs.dot(encoding) / qs.data.sum())
-            # In older versions of scipy, performing a dot product ensued in
-            # a two-dimensional array.
-            marginals = marginals.toarray().ravel()
-            return marginals
+        marginals, normalization = self._marginal_sums(
+            encoding, num_features, use_flat_distribution, counts
+        )
+        return marginals / normalization
+
+    def _marginal_sums(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding | Iterable[Any],
+        num_features: int,
+        use_flat_distribution: bool = False,
+        counts: Optional[NDArray[np.int64]] = None
+    ) -> Tuple[NDArray[np.float64], float]:
+        """
+        Return the weighted number of sequences with each feature and the total weight.
 
-        return marginals
+        The weights are those of compute_marginals, whose marginals are the
+        ratio of the two.
+        """
+        # Sums over the chunks of the encoding, which is a single chunk unless
+        # an iterable was given.
+        marginals = np.zeros(num_features)
+        normalization = 0.
+        start_idx = 0
+        for encoding_chunk in iter_encoding_chunks(encoding):
+            if counts is None:
+                weights = None
+            else:
+                weights = counts[start_idx:start_idx + encoding_chunk.shape[0]]
+                start_idx += encoding_chunk.shape[0]
+            if not use_flat_distribution:
+                qs = np.exp(-self.compute_energy(encoding_chunk))
+                weights = qs if weights is None else qs * weights
+
+            if self.processes > 1 and encoding_chunk.shape[0] >= PARALLEL_MIN_SEQS:
+                if weights is None:
+                    weights = np.ones(encoding_chunk.shape[0])
+                marginals += parallel_feature_sums(
+                    encoding_chunk, [weights], self.processes
+                )[0]
+            else:
+                marginals += feature_sums(encoding_chunk, weights)
+            if weights is None:
+                normalization += encoding_chunk.shape[0]
+            else:
+                normalization += weights.sum(dtype=np.float64)
+
+        return marginals, normalization
 
     def infer_selection(
         self,
@@ -560,7 +1094,17 @@ class Sonia(object):
         validation_split: float = 0.2,
         verbose: int = 0,
         set_gauge: bool = True,
-        sampling: Optional[str] = None
+        sampling: Optional[str] = None,
+        workers: int = 1,
+        use_multiprocessing: bool = False,
+        max_queue_size: int = 10,
+        solver: str = 'keras',
+        tol: float = 1e-5,
+        max_iter: int = 1000,
+        checkpoint_dir: Optional[str] = None,
+        checkpoint_every: int = 1,
+        keep_checkpoints: int = 2,
+        resume_from: Optional[str] = None
     ) -> None:
         """
         Infer model parameters, i.e. energies for each model feature.
@@ -581,32 +1125,98 @@ class Sonia(object):
             Output the training progress.
         set_gauge : bool, default True
             Set the gauge for the model output.
-        sampling : str, default 'unbalanced'
+        sampling : str, optional
             How the data seqs and gen seqs should be loaded into mini-batches.
-            If 'legacy' the sonnia.SoniaDataset class will not be used, and
+            If None, mini-batches are drawn from all the shuffled seqs, and
             a data sequence always appearing in a mini-batch will not be guaranteed.
-            See sonnia.SoniaDataset for other sampling options.
+            See sonnia.SoniaDataset for other sampling options. In all cases
+            the encoding is kept sparse and only mini-batches are densified.
+        workers : int, default 1
+            The number of workers assembling mini-batches ahead of training.
+            With 1 worker (and no multiprocessing), mini-batches are assembled
+            on the training thread. The mini-batches do not depend on the
+            number of workers.
+        use_multiprocessing : bool, default False
+            Use processes rather than threads as workers.
+        max_queue_size : int, default 10
+            The number of mini-batches the workers may prepare ahead.
+        solver : str, default 'keras'
+            'keras' trains the model on mini-batches with RMSprop for the given
+            epochs. Linear models can instead be trained to convergence on the
+            full training set, with 'lbfgs' (L-BFGS-B) or 'proximal'
+            (accelerated proximal gradient, which applies l1_reg exactly).
+            These fill L1_converge_history at each iteration, and ignore
+            epochs, batch_size, sampling and the worker settings.
+        tol : float, default 1e-5
+            The 'lbfgs' and 'proximal' solvers stop when no component of the
+            (projected or proximal) gradient of the loss exceeds tol.
+        max_iter : int, default 1000
+            The maximum number of iterations of the 'lbfgs' and 'proximal' solvers.
+        checkpoint_dir : str, optional
+            The directory in which checkpoints of the training are saved (see
+            sonnia.checkpoint). Only the 'keras' solver is checkpointed.
+        checkpoint_every : int, default 1
+            The number of epochs between checkpoints.
+        keep_checkpoints : int, default 2
+            The number of most recent checkpoints kept in checkpoint_dir.
+        resume_from : str, optional
+            A checkpoint, or a directory of checkpoints whose latest one is
+            used, from which training continues up to epochs. The weights,
+            optimizer state, shuffle of the training set, mini-batch plans and
+            likelihood history are restored, so the result is that of an
+            uninterrupted run. The model, seqs and training settings must be
+            those of the checkpointed run, and seed is ignored.
 
         Returns
         -------
         None
         """
+        if solver not in ('keras', 'lbfgs', 'proximal'):
+            raise ValueError('solver must be \'keras\', \'lbfgs\' or \'proximal\'.')
+        if solver != 'keras' and (checkpoint_dir is not None or resume_from is not None):
+            raise ValueError('Only the keras solver can be checkpointed.')
         if seed is not None:
             rng = np.random.default_rng(seed)
         else:
             rng = self.rng
 
+        resume_state = None
+        if resume_from is not None:
+            resume_state = load_checkpoint(resume_from, self.model)
+            rng.bit_generator.state = resume_state['rng_state']
+        # The state which shuffles the training set, saved with checkpoints.
+        rng_state = rng.bit_generator.state
+
         if initialize:
-            self.X = sparse.vstack((self.data_encoding, self.gen_encoding))
+            # The training set is a view of the rows of the data and gen
+            # encodings, so shuffling, splitting and repeating it only moves
+            # row indices.
+            self.X = EncodingView((self.data_encoding, self.gen_encoding))
             self.Y = np.zeros(
                 self.data_encoding.shape[0] + self.gen_encoding.shape[0],
                 dtype=np.int8
             )
             self.Y[self.data_encoding.shape[0]:] += 1
+            self.W = None
+
+            if self.deduplicate:
+                counts = np.concatenate((self.data_seq_counts, self.gen_seq_counts))
+                if self.objective == 'BCE':
+                    # Rescaled so that the mean weighted loss over the distinct
+                    # sequences equals the mean loss over all their copies.
+                    self.W = counts * (len(counts) / counts.sum())
+                else:
+                    # The other objective is not a mean of per-sequence losses,
+                    # so the copies are restored for training.
+                    repeats = np.repeat(np.arange(len(counts)), counts)
+                    self.X = self.X[repeats]
+                    self.Y = self.Y[repeats]
 
             shuffle = rng.permutation(self.X.shape[0])
             self.X = self.X[shuffle]
             self.Y = self.Y[shuffle]
+            if self.W is not None:
+                self.W = self.W[shuffle]
 
         num_data_seqs = np.count_nonzero(self.Y == 0)
         if num_data_seqs == 0:
@@ -618,53 +1228,99 @@ class Sonia(object):
             TerminateOnNaN(),
         ]
 
-        if sampling is None:
-            # Presently, GPU cannot process sparse arrays, so the encoding
-            # must be in the dense representation.
-            if hasattr(self, 'split_encoding'):
-                input_data = self.split_encoding(self.X.toarray())
-            else:
-                input_data = self.X.toarray()
-            self.learning_history = self.model.fit(
-                input_data, self.Y, epochs=epochs, batch_size=batch_size,
-                validation_split=validation_split, verbose=verbose, callbacks=callbacks,
-            )
+        if validation_split < 0 or validation_split >= 1:
+            raise ValueError('validation_split must be in [0, 1).')
+        if hasattr(self, 'split_encoding'):
+            split_encoding = self.split_encoding
         else:
-            if validation_split < 0 or validation_split >= 1:
-                raise ValueError('validation_split must be in [0, 1).')
-            if validation_split == 0:
-                validation_data = None
-            else:
-                if hasattr(self, 'split_encoding'):
-                    split_encoding = self.split_encoding
-                else:
-                    split_encoding = None
-
-                val_end_idx = int(validation_split * len(self.Y))
-                val_x, val_y = self.X[:val_end_idx], self.Y[:val_end_idx]
-                train_x, train_y = self.X[val_end_idx:], self.Y[val_end_idx:]
+            split_encoding = None
+
+        # The encoding stays sparse, and only the mini-batches are densified,
+        # so that memory grows with the number of nonzero features rather
+        # than with the size of the dense encoding.
+        val_end_idx = int(validation_split * len(self.Y))
+        val_x, val_y = self.X[:val_end_idx], self.Y[:val_end_idx]
+        train_x, train_y = self.X[val_end_idx:], self.Y[val_end_idx:]
+        if self.W is None:
+            val_w, train_w = None, None
+        else:
+            val_w, train_w = self.W[:val_end_idx], self.W[val_end_idx:]
 
-                child_rngs = [
-                    np.random.default_rng(child_state)
-                    for child_state in rng.bit_generator._seed_seq.spawn(2)
-                ]
+        if solver != 'keras':
+            self._infer_linear_selection(
+                solver, (train_x, train_y, train_w), (val_x, val_y, val_w),
+                tol, max_iter, verbose
+            )
+        else:
+            child_rngs = [
+                np.random.default_rng(child_state)
+                for child_state in rng.bit_generator._seed_seq.spawn(2)
+            ]
 
-                train_generator = SoniaDataset(
-                    train_x, train_y, sampling, batch_size, seed=child_rngs[0],
-                    split_encoding=split_encoding,
-                )
+            train_generator = SoniaDataset(
+                train_x, train_y, sampling, batch_size, seed=child_rngs[0],
+                split_encoding=split_encoding, sample_weight=train_w,
+                memory_budget=self.memory_budget, workers=workers,
+                use_multiprocessing=use_multiprocessing, max_queue_size=max_queue_size,
+            )
+            if val_end_idx == 0:
+                val_generator = None
+            else:
                 val_generator = SoniaDataset(
                     val_x, val_y, sampling, batch_size, seed=child_rngs[1],
-                    split_encoding=split_encoding,
+                    split_encoding=split_encoding, sample_weight=val_w,
+                    memory_budget=self.memory_budget, workers=workers,
+                    use_multiprocessing=use_multiprocessing, max_queue_size=max_queue_size,
                 )
 
-                self.learning_history = self.model.fit(
-                    train_generator, validation_data=val_generator, epochs=epochs,
-                    batch_size=batch_size, verbose=verbose, callbacks=callbacks,
+            state = {
+                'rng_state': rng_state,
+                'num_seqs': len(self.Y),
+                'validation_split': validation_split,
+                'batch_size': batch_size,
+                'sampling': sampling,
+                'train_entropy': train_generator.entropy,
+                'val_entropy': None if val_generator is None else val_generator.entropy,
+                'history': {},
+            }
+            initial_epoch = 0
+            if resume_state is not None:
+                for key in ('num_seqs', 'validation_split', 'batch_size', 'sampling'):
+                    if resume_state[key] != state[key]:
+                        raise ValueError(
+                            f'The {key} of the checkpoint ({resume_state[key]}) '
+                            f'differs from that of this training ({state[key]}).'
+                        )
+                state = resume_state
+                initial_epoch = resume_state['epoch']
+                train_generator.entropy = resume_state['train_entropy']
+                if val_generator is not None:
+                    val_generator.entropy = resume_state['val_entropy']
+            prior_history = state['history']
+            callbacks.append(PlanEpochs(train_generator, val_generator))
+            if checkpoint_dir is not None:
+                callbacks.append(TrainingCheckpoint(
+                    checkpoint_dir, state, history=state['history'],
+                    every=checkpoint_every, keep=keep_checkpoints
+                ))
+
+            # The epoch plans of SoniaDataset already shuffle the mini-batches, and
+            # keras would reorder them with the global random module.
+            self.learning_history = self.model.fit(
+                train_generator, validation_data=val_generator, epochs=epochs,
+                initial_epoch=initial_epoch, verbose=verbose, callbacks=callbacks,
+                shuffle=False,
+            )
+            for key, values in prior_history.items():
+                self.learning_history.history[key] = (
+                    values + self.learning_history.history.get(key, [])
                 )
 
-        self.likelihood_train = -np.array(self.learning_history.history['_likelihood']) * 1.44
-        self.likelihood_test = -np.array(self.learning_history.history['val__likelihood']) * 1.44
+            self.likelihood_train = -np.array(self.learning_history.history['_likelihood']) * 1.44
+            self.likelihood_test = -np.array(
+                self.learning_history.history.get('val__likelihood', [])
+            ) * 1.44
+
         self.model_params = self.model.get_weights()
 
         if np.isnan(self.likelihood_train).any() or np.isnan(self.likelihood_test).any():
@@ -677,13 +1333,90 @@ class Sonia(object):
 
         # set Z    
         self.energies_gen = self.compute_energy(self.gen_encoding)
-        self.Z = np.mean(np.exp(-self.energies_gen))
+        self.Z = np.average(
+            np.exp(-self.energies_gen), weights=self._seq_counts(self.gen_seq_counts)
+        )
         if set_gauge and self.gene_features != 'vjl': self.set_gauge()
         logging.info('Updating marginals.')
         self.update_model(update_marginals=True)
         logging.info('Finished updating marginals.')
         self.model_params = self.model.get_weights()
 
+    def _infer_linear_selection(
+        self,
+        solver: str,
+        train: Tuple[Any, NDArray[np.int8], Optional[NDArray[np.float64]]],
+        val: Tuple[Any, NDArray[np.int8], Optional[NDArray[np.float64]]],
+        tol: float,
+        max_iter: int,
+        verbose: int
+    ) -> None:
+        """
+        Fit the energies of a linear model with a full-batch convex solver.
+
+        Parameters
+        ----------
+        solver : str
+            'lbfgs' or 'proximal'.
+        train : tuple
+            The encoding, labels and sample weights of the training seqs.
+        val : tuple
+            The encoding, labels and sample weights of the validation seqs.
+        tol : float
+            The tolerance of the solver.
+        max_iter : int
+            The maximum number of iterations.
+        verbose : int
+            Log the likelihood at each iteration.
+
+        Returns
+        -------
+        None
+        """
+        linear_params = self.linear_energy_params()
+        if linear_params is None:
+            raise ValueError(f'The {solver} solver can only train linear models.')
+        energy_params, min_clip, max_clip = linear_params
+
+        objective_kwargs = dict(
+            objective=self.objective, gamma=self.gamma, l2_reg=self.l2_reg,
+            min_energy_clip=min_clip, max_energy_clip=max_clip
+        )
+        train_objective = LinearObjective(*train, **objective_kwargs)
+        if len(val[1]) == 0:
+            val_objective = None
+        else:
+            val_objective = LinearObjective(*val, **objective_kwargs)
+
+        likelihood_train = []
+        likelihood_test = []
+        self.L1_converge_history = []
+        def record(params):
+            likelihood_train.append(-train_objective.likelihood(params) * 1.44)
+            if val_objective is not None:
+                likelihood_test.append(-val_objective.likelihood(params) * 1.44)
+            self.L1_converge_history.append(float(np.abs(
+                train_objective.data_marginals - train_objective.model_marginals(params)
+            ).sum()))
+            if verbose:
+                logging.info(
+                    f'Iteration {len(likelihood_train)}: likelihood '
+                    f'{likelihood_train[-1]:.6f}, L1 distance of the marginals '
+                    f'{self.L1_converge_history[-1]:.6f}.'
+                )
+
+        minimize = minimize_lbfgs if solver == 'lbfgs' else minimize_proximal
+        self.learning_history = minimize(
+            train_objective, energy_params.astype(np.float64), l1_reg=self.l1_reg,
+            tol=tol, max_iter=max_iter, callback=record
+        )
+        if not self.learning_history.success:
+            logging.warning(f'The {solver} solver did not converge: '
+                            f'{self.learning_history.message}')
+        self.model.set_weights([self.learning_history.x[:, None].astype(np.float32)])
+        self.likelihood_train = np.array(likelihood_train)
+        self.likelihood_test = np.array(likelihood_test)
+
     def set_gauge(
         self
     ) -> None:
@@ -823,6 +1556,46 @@ class Sonia(object):
         )
         return gen + data
 
+    def _seq_counts(
+        self,
+        counts: NDArray[np.int64]
+    ) -> Optional[NDArray[np.int64]]:
+        """
+        Return the multiplicities of the sequences if they are deduplicated, else None.
+        """
+        if self.deduplicate:
+            return counts
+        return None
+
+    def _filter_seqs(
+        self,
+        seqs: Sequence[Sequence[str]] | pd.DataFrame | str,
+        **kwargs: Dict[str, Any]
+    ) -> NDArray[str]:
+        """
+        Run sonnia.utils.filter_seqs with the pgen model, through the encoding cache if set.
+        """
+        if self.encoding_cache is None:
+            return filter_seqs(seqs, self.pgen_dir, **kwargs)
+
+        try:
+            seqs_hash = hash_seqs(seqs)
+        except (OSError, ValueError):
+            # Unreadable files and ragged sequences are left to filter_seqs.
+            return filter_seqs(seqs, self.pgen_dir, **kwargs)
+        cache_key = self.encoding_cache.key(
+            'filter_seqs', os.path.abspath(self.pgen_dir), sorted(kwargs.items()), seqs_hash
+        )
+        arrays = self.encoding_cache.load(cache_key)
+        if arrays is not None:
+            logging.info('Loaded the filtered sequences from the encoding cache.')
+            return arrays['seqs']
+
+        filtered_seqs = filter_seqs(seqs, self.pgen_dir, **kwargs)
+        if np.asarray(filtered_seqs).dtype.kind != 'O':
+            self.encoding_cache.save(cache_key, seqs=filtered_seqs)
+        return filtered_seqs
+
     def update_model(
         self,
         add_data_seqs: List[Sequence[str]] = [],
@@ -840,7 +1613,11 @@ class Sonia(object):
         This method is used to add/remove model features or data/generated
         sequences. These changes will be propagated through the class to update
         any other attributes that need to match (e.g. the marginals or
-        seq_features).
+        seq_features). Added sequences are encoded on their own and appended
+        to the encodings, whose marginals are updated with their sums, so
+        sequences can be added in many small batches. The energies of the gen
+        sequences are only recomputed for the model marginals when the gen
+        sequences, the features or the model weights changed.
 
         Parameters
         ----------
@@ -896,11 +1673,24 @@ class Sonia(object):
             self.update_model_structure(initialize=True)
             self.feature_dict = {tuple(f): i for i, f in enumerate(self.features)}
 
+        # Unless the features change, the encodings are extended with the
+        # added seqs only and their marginals are updated as running sums.
+        features_changed = len(add_features) + len(remove_features) > 0
+        extend_data = (not features_changed and not update_seq_features
+                       and self._encodes_seqs(self.data_encoding, self.data_seqs))
+        extend_gen = (not features_changed and not update_seq_features
+                      and self._encodes_seqs(self.gen_encoding, self.gen_seqs))
+        num_gen_seqs = len(self.gen_seqs)
+        data_first_idxs = None
+        gen_first_idxs = None
+        add_data_encoding = None
+        add_gen_encoding = None
+
         if len(add_data_seqs) > 0:
             logging.info('Adding data seqs.')
             try:
                 if 'Paired' not in type(self).__name__:
-                    add_data_seqs = filter_seqs(add_data_seqs, self.pgen_dir, **kwargs)
+                    add_data_seqs = self._filter_seqs(add_data_seqs, **kwargs)
                 else:
                     pass
                     #add_data_seqs = filter_seqs_paired(
@@ -912,14 +1702,27 @@ class Sonia(object):
             add_data_seqs = np.array(
                 [[seq, '', ''] if isinstance(seq, str) else seq for seq in add_data_seqs]
             )
-            if len(self.data_seqs) == 0: self.data_seqs = add_data_seqs
-            else: self.data_seqs = np.concatenate([self.data_seqs, add_data_seqs])
+            add_data_gene_ids = self.gene_ids(add_data_seqs)
+            add_data_seq_counts = np.ones(len(add_data_seqs), dtype=np.int64)
+            if len(self.data_seqs) == 0:
+                self.data_seqs = add_data_seqs
+                self.data_gene_ids = add_data_gene_ids
+                self.data_seq_counts = add_data_seq_counts
+            else:
+                self.data_seqs = np.concatenate([self.data_seqs, add_data_seqs])
+                self.data_gene_ids = np.concatenate([self.data_gene_ids, add_data_gene_ids])
+                self.data_seq_counts = np.concatenate([self.data_seq_counts, add_data_seq_counts])
+            if self.deduplicate:
+                self.data_seqs, self.data_seq_counts, data_first_idxs = deduplicate_seqs(
+                    self.data_seqs, self.data_seq_counts
+                )
+                self.data_gene_ids = self.data_gene_ids[data_first_idxs]
 
         if len(add_gen_seqs) > 0:
             logging.info('Adding gen seqs.')
             try:
                 if 'Paired' not in type(self).__name__:
-                    add_gen_seqs = filter_seqs(add_gen_seqs, self.pgen_dir, **kwargs)
+                    add_gen_seqs = self._filter_seqs(add_gen_seqs, **kwargs)
                 else:
                     pass
             except Exception as e:
@@ -927,35 +1730,157 @@ class Sonia(object):
             add_gen_seqs=np.array(
                 [[seq,'',''] if isinstance(seq, str) else seq for seq in add_gen_seqs]
             )
-            if len(self.gen_seqs) == 0: self.gen_seqs = add_gen_seqs
-            else: self.gen_seqs = np.concatenate([self.gen_seqs, add_gen_seqs])
+            add_gen_gene_ids = self.gene_ids(add_gen_seqs)
+            add_gen_seq_counts = np.ones(len(add_gen_seqs), dtype=np.int64)
+            if len(self.gen_seqs) == 0:
+                self.gen_seqs = add_gen_seqs
+                self.gen_gene_ids = add_gen_gene_ids
+                self.gen_seq_counts = add_gen_seq_counts
+            else:
+                self.gen_seqs = np.concatenate([self.gen_seqs, add_gen_seqs])
+                self.gen_gene_ids = np.concatenate([self.gen_gene_ids, add_gen_gene_ids])
+                self.gen_seq_counts = np.concatenate([self.gen_seq_counts, add_gen_seq_counts])
+            if self.deduplicate:
+                self.gen_seqs, self.gen_seq_counts, gen_first_idxs = deduplicate_seqs(
+                    self.gen_seqs, self.gen_seq_counts
+                )
+                self.gen_gene_ids = self.gen_gene_ids[gen_first_idxs]
 
-        if ((len(add_data_seqs) + len(add_features) + len(remove_features) > 0
-             or update_seq_features)
+        if ((len(add_data_seqs) > 0 or features_changed or update_seq_features)
              and len(self.features) > 0 and len(self.data_seqs) > 0):
             logging.info('Encode data seqs.')
-            self.data_encoding = self.encode_data(self.data_seqs)
+            if extend_data and len(add_data_seqs) > 0:
+                add_data_encoding = self.encode_data(add_data_seqs, gene_ids=add_data_gene_ids)
+                self.data_encoding = self._extend_encoding(
+                    self.data_encoding, add_data_encoding, data_first_idxs
+                )
+            else:
+                self.data_encoding = self.encode_data(self.data_seqs, gene_ids=self.data_gene_ids)
 
-        if ((len(add_data_seqs) + len(add_features) + len(remove_features) > 0
-             or update_marginals) and len(self.features) > 0):
+        if ((len(add_data_seqs) > 0 or features_changed or update_marginals)
+             and len(self.features) > 0):
             if self.data_encoding.shape[0]:
-                self.data_marginals = self.compute_marginals(
-                    encoding=self.data_encoding, use_flat_distribution=True
-                )
+                if add_data_encoding is not None and not update_marginals:
+                    self.data_marginals = self._add_marginal_sums(
+                        self.data_marginals, self.data_seq_counts.sum() - len(add_data_seqs),
+                        *self._marginal_sums(
+                            add_data_encoding, len(self.features), use_flat_distribution=True
+                        )
+                    )
+                else:
+                    self.data_marginals = self.compute_marginals(
+                        encoding=self.data_encoding, use_flat_distribution=True,
+                        counts=self._seq_counts(self.data_seq_counts)
+                    )
 
-        if ((len(add_gen_seqs) + len(add_features) + len(remove_features) > 0
-             or update_seq_features)
+        if ((len(add_gen_seqs) > 0 or features_changed or update_seq_features)
             and len(self.features) > 0 and len(self.gen_seqs) > 0):
             logging.info('Encode gen seqs.')
-            self.gen_encoding = self.encode_data(self.gen_seqs)
+            if extend_gen and len(add_gen_seqs) > 0:
+                add_gen_encoding = self.encode_data(add_gen_seqs, gene_ids=add_gen_gene_ids)
+                self.gen_encoding = self._extend_encoding(
+                    self.gen_encoding, add_gen_encoding, gen_first_idxs
+                )
+            else:
+                self.gen_encoding = self.encode_data(self.gen_seqs, gene_ids=self.gen_gene_ids)
+                self._model_marginals_state = None
 
-        if ((len(add_gen_seqs) + len(add_features) + len(remove_features) > 0
-             or update_marginals) and len(self.features) > 0):
+        if ((len(add_gen_seqs) > 0 or features_changed or update_marginals)
+             and len(self.features) > 0):
             if self.gen_encoding.shape[0]:
-                self.gen_marginals = self.compute_marginals(
-                    encoding=self.gen_encoding, use_flat_distribution=True
-                )
-                self.model_marginals = self.compute_marginals(encoding=self.gen_encoding)
+                if add_gen_encoding is not None and not update_marginals:
+                    self.gen_marginals = self._add_marginal_sums(
+                        self.gen_marginals, self.gen_seq_counts.sum() - len(add_gen_seqs),
+                        *self._marginal_sums(
+                            add_gen_encoding, len(self.features), use_flat_distribution=True
+                        )
+                    )
+                else:
+                    self.gen_marginals = self.compute_marginals(
+                        encoding=self.gen_encoding, use_flat_distribution=True,
+                        counts=self._seq_counts(self.gen_seq_counts)
+                    )
+                self._update_model_marginals(add_gen_encoding, num_gen_seqs)
+
+    def _encodes_seqs(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding | NDArray,
+        seqs: Sequence[Sequence[str]]
+    ) -> bool:
+        """Return whether encoding is the encoding of seqs with the current features."""
+        if len(seqs) == 0:
+            return True
+        return is_encoding(encoding) and encoding.shape == (len(seqs), len(self.features))
+
+    def _extend_encoding(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding | NDArray,
+        add_encoding: sparse.csr_array | PaddedEncoding,
+        first_idxs: Optional[NDArray[np.int64]] = None
+    ) -> sparse.csr_array | PaddedEncoding:
+        """
+        Append the encoding of added seqs to an encoding.
+
+        first_idxs are the rows kept by deduplicate_seqs among the stacked
+        rows, if the seqs were deduplicated.
+        """
+        if is_encoding(encoding) and encoding.shape[0] > 0:
+            encoding = vstack_encodings((encoding, add_encoding))
+        else:
+            encoding = add_encoding
+        # Without duplicates the rows are kept in order.
+        if first_idxs is not None and len(first_idxs) < encoding.shape[0]:
+            encoding = encoding[first_idxs]
+        return encoding
+
+    @staticmethod
+    def _add_marginal_sums(
+        marginals: NDArray[np.float64],
+        normalization: float,
+        add_sums: NDArray[np.float64],
+        add_normalization: float
+    ) -> NDArray[np.float64]:
+        """Return the marginals of seqs extended by seqs with the given weighted sums."""
+        if normalization == 0:
+            return add_sums / add_normalization
+        return (marginals * normalization + add_sums) / (normalization + add_normalization)
+
+    def _update_model_marginals(
+        self,
+        add_gen_encoding: Optional[sparse.csr_array | PaddedEncoding],
+        num_gen_seqs: int
+    ) -> None:
+        """
+        Update model_marginals after the gen seqs, the features or the weights changed.
+
+        The pass over the gen encoding that computes the energies is only run
+        when the weights or the gen seqs changed since the last one. If only
+        gen seqs were added, just their energies are computed, and their
+        Q-weighted sums are added to those of the previous gen seqs.
+        """
+        weights_key = (self._weights_digest(), self.min_energy_clip, self.max_energy_clip)
+        state = self._model_marginals_state
+        current = (
+            state is not None and state[0] == weights_key
+            and len(self.model_marginals) == len(self.features)
+        )
+        if current and add_gen_encoding is None and state[1] == self.gen_encoding.shape[0]:
+            return
+        if current and add_gen_encoding is not None and state[1] == num_gen_seqs:
+            add_sums, add_normalization = self._marginal_sums(
+                add_gen_encoding, len(self.features)
+            )
+            self.model_marginals = self._add_marginal_sums(
+                self.model_marginals, state[2], add_sums, add_normalization
+            )
+            normalization = state[2] + add_normalization
+        else:
+            sums, normalization = self._marginal_sums(
+                self.gen_encoding, len(self.features),
+                counts=self._seq_counts(self.gen_seq_counts)
+            )
+            self.model_marginals = sums / normalization
+        self._model_marginals_state = (weights_key, self.gen_encoding.shape[0], normalization)
 
     def add_generated_seqs(
         self,
@@ -1033,7 +1958,10 @@ class Sonia(object):
             with open(os.path.join(save_dir, 'data_seqs.tsv'), 'w') as data_seqs_file:
                 data_seq_energies = self.compute_energy(self.data_encoding)
                 data_seq_features = self.encoding_to_feature_strs(self.data_encoding)
-                data_seqs_file.write('Sequence;Genes\tLog(Q)\tFeatures\n')
+                data_seqs_file.write(
+                    'Sequence;Genes\tLog(Q)\tFeatures'
+                    + '\tCount' * self.deduplicate + '\n'
+                )
                 data_seqs_file.write(
                     '\n'.join(
                         [';'.join(seq) + '\t'
@@ -1041,6 +1969,7 @@ class Sonia(object):
                          + ';'.join(
                              [','.join(features) for features in data_seq_features[i]]
                          )
+                         + (f'\t{self.data_seq_counts[i]}' if self.deduplicate else '')
                          for i, seq in enumerate(self.data_seqs)]
                     )
                 )
@@ -1049,7 +1978,10 @@ class Sonia(object):
             with open(os.path.join(save_dir, 'gen_seqs.tsv'), 'w') as gen_seqs_file:
                 gen_seq_energies = self.compute_energy(self.gen_encoding)
                 gen_seq_features = self.encoding_to_feature_strs(self.gen_encoding)
-                gen_seqs_file.write('Sequence;Genes\tLog(Q)\tFeatures\n')
+                gen_seqs_file.write(
+                    'Sequence;Genes\tLog(Q)\tFeatures'
+                    + '\tCount' * self.deduplicate + '\n'
+                )
                 gen_seqs_file.write(
                     '\n'.join(
                         [';'.join(seq) + '\t'
@@ -1057,6 +1989,7 @@ class Sonia(object):
                          + ';'.join(
                              [','.join(features) for features in gen_seq_features[i]]
                          )
+                         + (f'\t{self.gen_seq_counts[i]}' if self.deduplicate else '')
                          for i, seq in enumerate(self.gen_seqs)
                         ]
                     )
@@ -1195,6 +2128,7 @@ class Sonia(object):
         def seq_loader(
             infile,
             seqs,
+            counts,
         ) -> sparse.csr_array:
             indices = []
             indptr = [0]
@@ -1204,6 +2138,8 @@ class Sonia(object):
                 for line in fin:
                     split_line = line.split('\t')
                     seqs.append(split_line[0].split(';'))
+                    # Deduplicated models save the multiplicities in a fourth column.
+                    counts.append(int(split_line[3]) if len(split_line) > 3 else 1)
                     features = split_line[2].strip().split(';')
                     specified_features = []
                     for feature in features:
@@ -1216,20 +2152,34 @@ class Sonia(object):
                     indices += specified_features
                     indptr.append(len(specified_features) + indptr[-1])
             data = np.ones(len(indices), dtype=np.int8)
-            return sparse.csr_array(
+            encoding = sparse.csr_array(
                 (data, indices, indptr),
                 shape=(len(indptr) - 1, len(self.features))
             )
+            if self.padded_encoding:
+                return PaddedEncoding.from_csr(encoding)
+            return encoding
 
         if os.path.isfile(data_seq_file):
             self.data_seqs = []
-            self.data_encoding = seq_loader(data_seq_file, self.data_seqs)
+            data_seq_counts = []
+            self.data_encoding = seq_loader(data_seq_file, self.data_seqs, data_seq_counts)
+            self.data_gene_ids = self.gene_ids(self.data_seqs)
+            self.data_seq_counts = np.array(data_seq_counts, dtype=np.int64)
+            if np.any(self.data_seq_counts != 1):
+                self.deduplicate = True
         elif verbose:
             logging.info('Cannot find data_seqs.tsv  --  no data seqs loaded.')
 
         if os.path.isfile(gen_seq_file):
             self.gen_seqs = []
-            self.gen_encoding = seq_loader(gen_seq_file, self.gen_seqs)
+            gen_seq_counts = []
+            self.gen_encoding = seq_loader(gen_seq_file, self.gen_seqs, gen_seq_counts)
+            self._model_marginals_state = None
+            self.gen_gene_ids = self.gene_ids(self.gen_seqs)
+            self.gen_seq_counts = np.array(gen_seq_counts, dtype=np.int64)
+            if np.any(self.gen_seq_counts != 1):
+                self.deduplicate = True
         elif verbose:
             logging.info('Cannot find gen_seqs.tsv  --  no generated seqs loaded.')
 
@@ -1323,6 +2273,7 @@ class Sonia(object):
          self.pgen_dir) = define_pgen_model(
              self.pgen_model, self.recompute_productive_norm, return_pgen_dir=True
          )
+        self.gene_vocabulary = GeneVocabulary(self.genomic_data)
 
         with open(os.path.join(self.pgen_dir, 'model_params.txt'), 'r') as fin:
             sep = 0
@@ -1416,7 +2367,7 @@ class Sonia(object):
         upper_bound: float = 10,
         nucleotide: bool = False,
         seed: Optional[int | np.random.Generator | np.random.BitGenerator | np.random.SeedSequence] = None,
-        max_chunksize: int = int(2e6),
+        max_chunksize: Optional[int] = None,
     ) -> NDArray[str]:
         """
         Generate Monte Carlo sequences from Sonia through rejection sampling.
@@ -1433,12 +2384,14 @@ class Sonia(object):
             acid sequence, V gene, and J gene.
         seed : int or numpy.random.Generator or numpy.random.BitGenerator or numpy.random.SeedSequence, optional
             The seed for random number generation.
-        max_chunksize : int, default int(2e6)
+        max_chunksize : int, optional
             The maximum chunksize for generating sequences. The default is to
             generate int(1.1 * upper_bound * num_seqs) sequences and then perform
             rejection sampling. However, if num_seqs is very large, this can ensue
             in high memory costs. The minimum between max_chunksize and the
-            aforementioned default amount is used for chunking.
+            aforementioned default amount is used for chunking. Defaults to the
+            number of sequences fitting in memory_budget, or to int(2e6)
+            without a budget.
 
         Returns
         -------
@@ -1452,6 +2405,10 @@ class Sonia(object):
 
         seqs = []
 
+        max_chunksize = self.budget_chunksize(
+            'generate_sequences_post', self.energy_row_bytes() + SEQ_ROW_BYTES,
+            int(2e6), max_chunksize
+        )
         chunksize = min(
             max_chunksize, int(upper_bound * num_seqs * 1.1)
         )
@@ -1512,6 +2469,77 @@ class Sonia(object):
 
         return random_samples < q / upper_bound
 
+    def clear_score_cache(
+        self
+    ) -> None:
+        """
+        Empty the memo of energies and Pgens and reset its statistics.
+
+        The energies are dropped automatically when the model weights change,
+        but the Pgens are not, so the memo must be cleared by hand after
+        replacing the pgen model.
+        """
+        if self.score_cache_size > 0:
+            self.energy_cache = LRUCache(self.score_cache_size)
+            self.pgen_cache = LRUCache(self.score_cache_size)
+        else:
+            self.energy_cache = None
+            self.pgen_cache = None
+        self._energy_cache_weights = None
+
+    def score_cache_info(
+        self
+    ) -> Dict[str, Dict[str, int]]:
+        """Return the hits, misses and sizes of the energy and Pgen memos."""
+        if self.energy_cache is None:
+            raise RuntimeError('The score cache is disabled (score_cache_size=0).')
+        return {'energy': self.energy_cache.info(), 'pgen': self.pgen_cache.info()}
+
+    def _weights_digest(
+        self
+    ) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(str(id(self.model)).encode())
+        for weights in self.model.get_weights():
+            digest.update(np.ascontiguousarray(weights).data)
+        return digest.hexdigest()
+
+    def _memoized(
+        self,
+        cache: LRUCache,
+        seqs: NDArray[str],
+        keys: List[Hashable],
+        compute: Callable[[NDArray[str]], NDArray],
+        dtype: DTypeLike
+    ) -> NDArray:
+        """Look keys up in cache and compute the values of the misses only."""
+        values, miss_idxs = cache.lookup(keys, dtype)
+        if len(miss_idxs) == 0:
+            return values
+        # Repeated misses within the batch are computed once.
+        unique_idxs = {}
+        for idx in miss_idxs:
+            unique_idxs.setdefault(keys[idx], idx)
+        unique_values = compute(seqs[list(unique_idxs.values())])
+        cache.update(unique_idxs.keys(), unique_values)
+        miss_values = dict(zip(unique_idxs.keys(), unique_values))
+        values[miss_idxs] = [miss_values[keys[idx]] for idx in miss_idxs]
+        return values
+
+    def _cached_energies(
+        self,
+        seqs: NDArray[str],
+        keys: List[Hashable]
+    ) -> NDArray[np.float32]:
+        weights_digest = self._weights_digest()
+        if weights_digest != self._energy_cache_weights:
+            self.energy_cache.clear()
+            self._energy_cache_weights = weights_digest
+        return self._memoized(
+            self.energy_cache, seqs, keys,
+            lambda miss_seqs: self.compute_energy(self.encode_data(miss_seqs)), np.float32
+        )
+
     def evaluate_seqs(
         self,
         seqs: Sequence[Sequence[str]] = [],
@@ -1537,10 +2565,20 @@ class Sonia(object):
             The product of the normalized selection factors and productive-normalized
             probabilities of generating the given sequences.
         """
-        encoding = self.encode_data(seqs)
-        energies = self.compute_energy(encoding)
+        if self.energy_cache is None:
+            encoding = self.encode_data(seqs)
+            energies = self.compute_energy(encoding)
+            pgens = self.compute_all_pgens(seqs, include_genes)
+        else:
+            seqs = as_seq_array(seqs)
+            keys = list(map(tuple, seqs.tolist()))
+            energies = self._cached_energies(seqs, keys)
+            pgens = self._memoized(
+                self.pgen_cache, seqs, [(key, include_genes) for key in keys],
+                lambda miss_seqs: self.compute_all_pgens(miss_seqs, include_genes), np.float64
+            )
         qs = np.exp(-energies) / self.Z
-        pgens = self.compute_all_pgens(seqs, include_genes) / self.norm_productive
+        pgens = pgens / self.norm_productive
         pposts = pgens * qs
 
         return qs, pgens, pposts
@@ -1563,17 +2601,24 @@ class Sonia(object):
             The normalized selection factors computed by the model associated
             with each sequence.
         """
-        encoding = self.encode_data(seqs)
-        energies = self.compute_energy(encoding)
+        if self.energy_cache is None:
+            energies = self.compute_energy(self.encode_data(seqs))
+        else:
+            seqs = as_seq_array(seqs)
+            energies = self._cached_energies(seqs, list(map(tuple, seqs.tolist())))
         return np.exp(-energies) / self.Z
 
     def joint_marginals(
         self,
-        encoding: Optional[sparse.csr_array] = None,
+        encoding: Optional[sparse.csr_array | PaddedEncoding] = None,
         seqs: Optional[Sequence[Sequence[str]]] = None,
         features: Optional[Sequence[Tuple[str]]] = None,
         use_flat_distribution: bool = False,
-    ) -> None:
+        counts: Optional[NDArray[np.int64]] = None,
+        sparse_output: bool = False,
+        blocks: Optional[Sequence[Tuple[str, str]]] = None,
+        memmap_file: Optional[str] = None,
+    ) -> NDArray[np.float64] | sparse.csr_array | JointMarginalBlocks:
         '''Returns joint marginals P(i,j) with i and j features of sonia (l3, aA6, etc..), index of features attribute is preserved.
            Matrix is lower-triangular.
         Parameters
@@ -1586,10 +2631,20 @@ class Sonia(object):
             seqs to encode.
         use_flat_distribution: bool
             for data and generated seqs is True, for model is False (weights with Q)
+        counts: array
+            multiplicity of each sequence (e.g. of a deduplicated model)
+        sparse_output: bool
+            return a scipy.sparse.csr_array instead of a dense array
+        blocks: list of tuple of str
+            pairs of feature groups (see feature_groups), e.g.
+            [('a', 'a'), ('v', 'j')], to compute only these float32 blocks
+        memmap_file: str
+            file in which the blocks are memory-mapped instead of kept in RAM
         Returns
         -------
-        joint_marginals: array
-            matrix (i,j) of joint marginals
+        joint_marginals: array or JointMarginalBlocks
+            matrix (i,j) of joint marginals, with zeros on and above the
+            diagonal, or its blocks if blocks is given
         '''
 
         if encoding is None and seqs is None:
@@ -1601,64 +2656,159 @@ class Sonia(object):
             raise RuntimeError('Both encoding and features cannot be given. '
                                'If features is given, seqs must be given to redo '
                                'the one-hot encoding.')
-        if features is not None:
-            num_features = len(features)
-        else:
-            num_features = len(self.features)
+        if features is None:
             features = self.features
 
         if seqs is not None:
             encoding = self.encode_data(seqs, features)
-        seq_model_features = self.encoding_to_feature_idxs(encoding)
-
-        l = len(features)
-        two_points_marginals = np.zeros((l,l))
-        n = len(seq_model_features)
-        procs = mp.cpu_count()
-        sizeSegment = int(n / procs)
 
         if not use_flat_distribution:
             energies = self.compute_energy(encoding)
             Qs = np.exp(-energies)
         else:
             Qs = np.ones(encoding.shape[0])
+        if counts is not None:
+            Qs = Qs * counts
+
+        if blocks is not None:
+            return self._joint_marginal_blocks(
+                encoding, [Qs], feature_groups(features), blocks, [memmap_file]
+            )[0]
+        return self._joint_marginals(encoding, [Qs], sparse_output)[0]
 
-        # Overhead of parallel is too long for small amount of sequences.
-        if len(seq_model_features) < int(1e5):
-            two_points_marginals, Z = partial_joint_marginals(
-                (seq_model_features, Qs, np.zeros((l, l)))
+    def _joint_marginals(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding,
+        weights: Sequence[NDArray[np.float64]],
+        sparse_output: bool = False
+    ) -> List[NDArray[np.float64] | sparse.csr_array]:
+        """
+        Return the normalized joint marginals of an encoding for several weightings.
+
+        The pair counts are the lower triangle, without the diagonal, of
+        encoding.T @ diag(w) @ encoding, computed in one chunked pass over the
+        encoding for all the weight vectors w.
+        """
+        num_features = encoding.shape[1]
+        if not sparse_output:
+            # Raises if the dense matrices do not fit in the budget.
+            self.budget_chunksize(
+                'joint_marginals', 8 * num_features**2 * len(weights), 1
+            )
+        # A sequence with k features adds k**2 products to the chunk sums.
+        mean_nnz = encoding.nnz / max(encoding.shape[0], 1)
+        chunksize = self.budget_chunksize(
+            'joint_marginals', int(16 * len(weights) * (mean_nnz**2 + mean_nnz)) + 1,
+            int(1e5)
+        )
+        sums = self._cooccurrence_sums(encoding, weights, chunksize, [None])[0]
+
+        joint_marginals = []
+        for pair_sums, w in zip(sums, weights):
+            pair_sums = sparse.csr_array(sparse.tril(pair_sums, k=-1, format='csr'))
+            pair_sums /= np.sum(w)
+            joint_marginals.append(pair_sums if sparse_output else pair_sums.toarray())
+        return joint_marginals
+
+    def _joint_marginal_blocks(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding,
+        weights: Sequence[NDArray[np.float64]],
+        groups: Dict[str, NDArray[np.int64]],
+        blocks: Sequence[Tuple[str, str]],
+        memmap_files: Sequence[Optional[str]]
+    ) -> List[JointMarginalBlocks]:
+        """
+        Return blocks of the normalized joint marginals of an encoding for several weightings.
+
+        The blocks are the products of the columns of their two groups, all
+        computed in one pass over the encoding for all the weight vectors.
+        """
+        results = [
+            JointMarginalBlocks(groups, blocks, memmap_file) for memmap_file in memmap_files
+        ]
+        if all(memmap_file is None for memmap_file in memmap_files):
+            # Raises if the blocks do not fit in the budget.
+            self.budget_chunksize(
+                'joint_marginals',
+                4 * len(weights) * sum(len(groups[a]) * len(groups[b]) for a, b in blocks), 1
+            )
+        mean_nnz = encoding.nnz / max(encoding.shape[0], 1)
+        chunksize = self.budget_chunksize(
+            'joint_marginals', int(16 * len(weights) * (mean_nnz**2 + mean_nnz)) + 1,
+            int(1e5)
+        )
+        totals = [np.sum(w) for w in weights]
+        block_names = list(results[0])
+        block_sums = self._cooccurrence_sums(
+            encoding, weights, chunksize, [results[0].features(block) for block in block_names]
+        )
+        for block, sums in zip(block_names, block_sums):
+            for result, pair_sums, total in zip(results, sums, totals):
+                if block[0] == block[1]:
+                    pair_sums = sparse.tril(pair_sums, k=-1, format='csr')
+                values = result[block]
+                values[:] = pair_sums.toarray() / total
+                del values
+        return results
+
+    def _cooccurrence_sums(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding,
+        weights: Sequence[NDArray[np.float64]],
+        chunksize: int,
+        blocks: Sequence[Optional[Tuple[NDArray[np.int64], NDArray[np.int64]]]]
+    ) -> List[List[sparse.csr_array]]:
+        """Return cooccurrence_block_sums, from one pool of worker processes for large encodings."""
+        if self.processes > 1 and encoding.shape[0] >= PARALLEL_MIN_SEQS:
+            return parallel_cooccurrence_block_sums(
+                encoding, weights, self.processes, blocks, chunksize
             )
-            return two_points_marginals / Z
-
-        # Create size segments list
-        jobs = []
-        for i in range(0, procs-1):
-            jobs.append([seq_model_features[i*sizeSegment:(i+1)*sizeSegment],Qs[i*sizeSegment:(i+1)*sizeSegment],np.zeros((l,l))])
-        p=mp.Pool(procs)
-        pool = p.map(partial_joint_marginals, jobs)
-        p.close()
-        Z=0
-        two_points_marginals=0
-        for m,z in pool:
-            Z+=z
-            two_points_marginals+=m
-        return two_points_marginals/Z
+        return cooccurrence_block_sums(encoding, weights, blocks, chunksize)
+
+    def feature_groups(
+        self
+    ) -> Dict[str, NDArray[np.int64]]:
+        """
+        Return the indices of the model features of each feature group.
+
+        The groups name the blocks of joint_marginals, e.g. 'l', 'a' and
+        'v-j' for joint_vj features (see sonnia.joint_marginals).
+        """
+        return feature_groups(self.features)
 
     def joint_marginals_independent(
         self,
-        marginals: np.ndarray
-    ) -> np.ndarray:
+        marginals: np.ndarray,
+        blocks: Optional[Sequence[Tuple[str, str]]] = None,
+        memmap_file: Optional[str] = None
+    ) -> np.ndarray | JointMarginalBlocks:
         '''Returns independent joint marginals P(i,j)=P(i)*P(j) with i and j features of sonia (l3, aA6, etc..), index of features attribute is preserved.
         Matrix is lower-triangular.
         Parameters
         ----------
         marginals: list
             marginals.
+        blocks: list of tuple of str
+            pairs of feature groups to compute only these float32 blocks
+        memmap_file: str
+            file in which the blocks are memory-mapped instead of kept in RAM
         Returns
         -------
-        joint_marginals: array
-            matrix (i,j) of joint marginals
+        joint_marginals: array or JointMarginalBlocks
+            matrix (i,j) of joint marginals, or its blocks if blocks is given
         '''
+        if blocks is not None:
+            result = JointMarginalBlocks(self.feature_groups(), blocks, memmap_file)
+            for block in result:
+                rows, cols = result.features(block)
+                values = result[block]
+                values[:] = np.outer(marginals[rows], marginals[cols])
+                if block[0] == block[1]:
+                    values[:] = np.tril(values, k=-1)
+                del values
+            return result
+
         joint_marginals = np.outer(marginals, marginals)
 
         # Return the lower triangle of the matrix with zeros along the diagonal,
@@ -1668,9 +2818,19 @@ class Sonia(object):
         return joint_marginals
 
     def compute_joint_marginals(
-        self
+        self,
+        blocks: Optional[Sequence[Tuple[str, str]]] = None,
+        memmap_dir: Optional[str] = None
     ) -> None:
         '''Computes joint marginals for all.
+        Parameters
+        ----------
+        blocks: list of tuple of str
+            pairs of feature groups (see feature_groups) to compute only
+            these blocks. The attributes are then JointMarginalBlocks.
+        memmap_dir: str
+            directory in which the blocks are memory-mapped, one file per
+            attribute. Requires blocks.
         Attributes Set
         -------
         gen_marginals_two: array
@@ -1687,18 +2847,52 @@ class Sonia(object):
             matrix (i,j) of joint marginals for pre-selection distribution
         '''
 
-        self.gen_marginals_two = self.joint_marginals(
-            encoding=self.gen_encoding,
-            use_flat_distribution=True
+        gen_counts = self._seq_counts(self.gen_seq_counts)
+        if gen_counts is None:
+            gen_counts = np.ones(self.gen_encoding.shape[0])
+        data_counts = self._seq_counts(self.data_seq_counts)
+        if data_counts is None:
+            data_counts = np.ones(self.data_encoding.shape[0])
+
+        if memmap_dir is not None and blocks is None:
+            raise ValueError('memmap_dir requires blocks.')
+        names = ['gen_marginals_two', 'model_marginals_two', 'data_marginals_two']
+        names += [f'{name}_independent' for name in names]
+        if memmap_dir is None:
+            memmap_files = dict.fromkeys(names)
+        else:
+            os.makedirs(memmap_dir, exist_ok=True)
+            memmap_files = {name: os.path.join(memmap_dir, f'{name}.dat') for name in names}
+
+        # The flat and Q weighted gen marginals share one pass over gen_encoding.
+        gen_Qs = np.exp(-self.compute_energy(self.gen_encoding))
+        gen_weights = [gen_counts, gen_Qs * gen_counts]
+        if blocks is None:
+            self.gen_marginals_two, self.model_marginals_two = self._joint_marginals(
+                self.gen_encoding, gen_weights
+            )
+            self.data_marginals_two = self._joint_marginals(
+                self.data_encoding, [data_counts]
+            )[0]
+        else:
+            groups = self.feature_groups()
+            self.gen_marginals_two, self.model_marginals_two = self._joint_marginal_blocks(
+                self.gen_encoding, gen_weights, groups, blocks,
+                [memmap_files['gen_marginals_two'], memmap_files['model_marginals_two']]
+            )
+            self.data_marginals_two = self._joint_marginal_blocks(
+                self.data_encoding, [data_counts], groups, blocks,
+                [memmap_files['data_marginals_two']]
+            )[0]
+        self.gen_marginals_two_independent = self.joint_marginals_independent(
+            self.gen_marginals, blocks, memmap_files['gen_marginals_two_independent']
+        )
+        self.data_marginals_two_independent = self.joint_marginals_independent(
+            self.data_marginals, blocks, memmap_files['data_marginals_two_independent']
         )
-        self.data_marginals_two = self.joint_marginals(
-            encoding=self.data_encoding,
-            use_flat_distribution=True
+        self.model_marginals_two_independent = self.joint_marginals_independent(
+            self.model_marginals, blocks, memmap_files['model_marginals_two_independent']
         )
-        self.model_marginals_two = self.joint_marginals(encoding=self.gen_encoding)
-        self.gen_marginals_two_independent = self.joint_marginals_independent(self.gen_marginals)
-        self.data_marginals_two_independent = self.joint_marginals_independent(self.data_marginals)
-        self.model_marginals_two_independent = self.joint_marginals_independent(self.model_marginals)
 
     def compute_all_pgens(
         self,
@@ -1739,6 +2933,7 @@ class Sonia(object):
         if self.gen_encoding.shape[0] >= int(1e4):
             encoding = self.gen_encoding[:n]
             seqs= self.gen_seqs[:n]
+            counts = self._seq_counts(self.gen_seq_counts[:n])
         else:
             raise RuntimeError('At least 10,000 generated sequences must be used '
                                f'for estimating entropy. Only {self.gen_encoding.shape[0]} '
@@ -1753,7 +2948,10 @@ class Sonia(object):
             logging.info(f'{num_zero_pgen} sequences have zero Pgen, we remove '
                          'them in the evaluation of the entropy')
         self.gen_ppost = self.gen_pgen * self.gen_Q # compute ppost
-        self._entropy = -np.mean(self.gen_Q[sel] * np.log2(self.gen_ppost[sel]))
+        self._entropy = -np.average(
+            self.gen_Q[sel] * np.log2(self.gen_ppost[sel]),
+            weights=None if counts is None else counts[sel]
+        )
         return self._entropy
 
     def dkl_post_gen(
@@ -1773,11 +2971,14 @@ class Sonia(object):
                     f'DKL(post || gen). Only {len(self.energies_gen)} were used.'
                 )
             Q = np.exp(-self.energies_gen) / self.Z
-            self.dkl = np.mean(Q * np.log2(Q))
+            self.dkl = np.average(
+                Q * np.log2(Q), weights=self._seq_counts(self.gen_seq_counts)
+            )
             return self.dkl
 
         if self.gen_encoding.shape[0] >= int(1e4):
             encoding = self.gen_encoding[:n]
+            counts = self._seq_counts(self.gen_seq_counts[:n])
         else:
             raise RuntimeError(
                 'At least 10,000 generated sequences must be used for estimating '
@@ -1785,5 +2986,5 @@ class Sonia(object):
             )
         energies = self.compute_energy(encoding) # compute energies
         Q = np.exp(-energies) / self.Z # compute Q
-        self.dkl = np.mean(Q * np.log2(Q))
+        self.dkl = np.average(Q * np.log2(Q), weights=counts)
         return self.dkl
@@ -17,6 +17,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """Script containing the SoniaDataset class for loading data into mini-batches.
 """
+import threading
 from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import keras
@@ -25,15 +26,32 @@ import numpy as np
 from numpy.typing import NDArray
 import scipy.sparse as sparse
 
+from sonnia.feature_encoder import EncodingView, PaddedEncoding
+
 class SoniaDataset(keras.utils.PyDataset):
     """
     A Dataset class for ensuring both gen seqs and data seqs appear in a mini-batch.
     Options allow there to be the original imbalance as well as sampling schemes for
     balancing the two datasets in mini-batches using over- and undersampling.
 
+    The rows of every mini-batch of an epoch are fixed by a plan, which depends
+    only on the seed and the epoch number. __getitem__ only reads the plan, so
+    mini-batches can be assembled concurrently by keras workers (see the
+    workers, use_multiprocessing and max_queue_size keyword arguments of
+    keras.utils.PyDataset), and a given seed yields the same mini-batches
+    whatever the number of workers.
+
+    When the first mini-batch of an epoch is requested, the features, labels
+    and weights are laid out in the order of the plan, so that every mini-batch is a contiguous range
+    of rows (a slice of indptr for a csr_array). For an EncodingView, only its
+    row indices are laid out, and the rows of a mini-batch are read from the
+    encodings it views. Each mini-batch is densified into a new float32
+    array, since keras may keep the arrays of several mini-batches (the
+    tensors of tf.data share their memory) while the next ones are built.
+
     Attributes
     ----------
-    x : numpy.ndarray of numpy.int8 or scipy.sparse.csr_array
+    x : numpy.ndarray of numpy.int8, scipy.sparse.csr_array, PaddedEncoding or EncodingView
         The dense or sparse one-hot feature encoding.
     y : numpy.ndarray of numpy.int8
         The labels for whether the feature comes from data (0) or gen (1).
@@ -41,13 +59,26 @@ class SoniaDataset(keras.utils.PyDataset):
         How big a mini-batch is.
     shuffle : bool
         Whether the features and labels should be shuffled after each epoch.
-    rng : numpy.random.Generator
-        A random number generator.
+    entropy : int
+        The entropy, drawn from the seed, of the random number generators of
+        the epochs.
+    epoch : int
+        The current epoch.
+    plan : tuple of (numpy.ndarray of numpy.int64, numpy.ndarray of numpy.int64)
+        The rows of x in mini-batch order and the bounds of the mini-batches
+        in them for the current epoch (see epoch_plan). Read-only.
+    max_batches_held : int
+        The number of dense mini-batches which keras may hold at once, which
+        bounds their memory with memory_budget.
     split_encoding : callable
         A function for SoNNia models for splitting the encoding into separate
         length, amino acid, and gene feature arrays.
     sparse_input : bool
-        If the encoding of features is a scipy.sparse.csr_array.
+        If the encoding of features is a scipy.sparse.csr_array, a
+        sonnia.feature_encoder.PaddedEncoding or an EncodingView of them.
+    sample_weight : numpy.ndarray of numpy.float64 or None
+        The weights of the datapoints in the loss, e.g. the multiplicities of
+        deduplicated sequences.
     where_class_0 : numpy.ndarray of numpy.int32
         The indices of data features in x.
     where_class_1 : numpy.ndarray of numpy.int32
@@ -62,7 +93,7 @@ class SoniaDataset(keras.utils.PyDataset):
         The size of the minority class.
     batch_constraint : int
         The constraint on the number of mini-batches.
-    sampling : str
+    sampling : str or None
         The type of sampling using to construct mini-batches.
     class_0_batch : int
         The number of class 0 datapoints when using imbalanced sampling.
@@ -75,12 +106,12 @@ class SoniaDataset(keras.utils.PyDataset):
         Return the mini-batch indexed by index.
     __len__()
         Return the number of mini-batches in an epoch.
-    on_epoch_end_oversample()
-        Update the indices for the next epoch when oversampling the minority class.
-    on_epoch_end_undersample()
-        Update the indices for the next epoch when undersampling the majority class.
+    epoch_plan(epoch)
+        Return the rows of the mini-batches of an epoch.
     on_epoch_end()
-        How to update the indices (determined by the sampling scheme).
+        Move to the plan of the next epoch.
+    set_epoch(epoch)
+        Move to the plan of an epoch, e.g. when resuming training.
     """
     def __init__(
         self,
@@ -91,6 +122,8 @@ class SoniaDataset(keras.utils.PyDataset):
         shuffle: bool = True,
         seed: Optional[int | np.random.Generator | np.random.BitGenerator | np.random.SeedSequence] = None,
         split_encoding: Optional[Callable] = None,
+        sample_weight: Optional[NDArray[np.float64]] = None,
+        memory_budget: Optional[int] = None,
         **kwargs: Dict[str, Any],
     ) -> None:
         """
@@ -98,34 +131,64 @@ class SoniaDataset(keras.utils.PyDataset):
 
         Parameters
         ----------
-        x : numpy.ndarray of numpy.int8
+        x : numpy.ndarray of numpy.int8, scipy.sparse.csr_array, PaddedEncoding or EncodingView
             The one-hot encoded sequence features.
         y : numpy.ndarray of numpy.int8
             The labels of the data.
-        sampling : str
+        sampling : str or None
             Options are 'undersample' (undersample the majority class each epoch).
-            'oversample' (oversample the minority class each epoch), or 'unbalanced'
+            'oversample' (oversample the minority class each epoch), 'unbalanced'
             (use the original proportion of data and gen but ensure that both data
-            and gen appear in each mini-batch).
+            and gen appear in each mini-batch), or None (shuffle all the datapoints
+            together, as model.fit does for arrays).
         batch_size : int, default 512
             The size of the mini-batch.
         shuffle : bool, default True
             After every epoch, reshuffle the data.
         seed : int or np.random.Generator or np.random.BitGenerator or np.random.SeedSequence, optional
-            Sets random seed.
+            Sets random seed. The plan of each epoch is derived from the seed
+            and the epoch number.
+        split_encoding : callable, optional
+            A function for splitting the encoding of SoNNia models.
+        sample_weight : numpy.ndarray of numpy.float64, optional
+            The weights of the datapoints in the loss. If given, mini-batches
+            are (x, y, sample_weight) tuples.
+        memory_budget : int, optional
+            The number of bytes the dense float32 mini-batches held at once
+            may take. A RuntimeError is raised if batch_size does not fit.
         **kwargs
-            Keyword arguments to keras.utils.PyDataset.
+            Keyword arguments to keras.utils.PyDataset, e.g. workers,
+            use_multiprocessing and max_queue_size.
         """
         super().__init__(**kwargs)
         self.batch_size = batch_size
         self.shuffle = shuffle
-        self.rng = np.random.default_rng(seed)
+        self.entropy = int(np.random.default_rng(seed).integers(2**63))
         self.split_encoding = split_encoding
 
-        self.sparse_input = isinstance(x, sparse.csr_array)
+        self.sparse_input = isinstance(x, (sparse.csr_array, PaddedEncoding, EncodingView))
+
+        # Keras keeps up to max_queue_size mini-batches in its queue while
+        # each worker builds another one, and tf.data holds the one being
+        # trained on and the one prefetched after it.
+        if self.workers > 1 or self.use_multiprocessing:
+            self.max_batches_held = self.max_queue_size + self.workers + 2
+        else:
+            self.max_batches_held = 2
+
+        if memory_budget is not None:
+            batch_bytes = batch_size * x.shape[1] * 4 * self.max_batches_held
+            if batch_bytes > memory_budget:
+                raise RuntimeError(
+                    f'The {self.max_batches_held} mini-batches of {batch_size} '
+                    f'sequences held at once take {batch_bytes} bytes, which exceeds the '
+                    f'memory_budget of {memory_budget} bytes. Decrease the batch_size '
+                    'or the max_queue_size.'
+                )
 
         self.x = x
         self.y = y
+        self.sample_weight = sample_weight
 
         self.where_class_0 = ko.where(y == 0)[0].numpy()
         self.where_class_1 = ko.where(y == 1)[0].numpy()
@@ -150,10 +213,10 @@ class SoniaDataset(keras.utils.PyDataset):
         self.sampling = sampling
         if self.sampling == 'undersample':
             self.batch_constraint = self.smaller_size * 2
-            self.on_epoch_end = self.on_epoch_end_shuffle
         elif self.sampling == 'oversample':
             self.batch_constraint = self.bigger_size * 2
-            self.on_epoch_end = self.on_epoch_end_oversample
+        elif self.sampling is None:
+            self.batch_constraint = self.class_0_size + self.class_1_size
         elif self.sampling == 'unbalanced':
             self.batch_constraint = self.class_0_size + self.class_1_size
             self.class_0_batch = int(
@@ -177,26 +240,25 @@ class SoniaDataset(keras.utils.PyDataset):
                     'a gen sequence. One possible way to mitigate this is increasing '
                     'the batch_size.'
                 )
-
-            self.on_epoch_end = self.on_epoch_end_shuffle
         else:
             raise ValueError(
-                'sampling must be \'undersample\', \'oversample\', or \'unbalanced\'.'
+                'sampling must be \'undersample\', \'oversample\', \'unbalanced\' or None.'
             )
 
-        self.on_epoch_end()
+        self.epoch = 0
+        self._layout = None
+        self._layout_lock = threading.Lock()
 
     def __getitem__(
         self,
         index: int
-    ) -> Tuple[NDArray[np.int8] | List[NDArray[np.int8]], NDArray[np.int8]]:
+    ) -> Tuple[NDArray[np.float32] | List[NDArray[np.float32]], NDArray[np.int8], ...]:
         """
-        Return a mini-batch which is guaranteed to include both gen and data seqs.
+        Return a mini-batch which is guaranteed to include both gen and data seqs
+        (unless sampling is None).
 
-        For the undersample stratgey, there are batches indexed beyond the object's
-        length which contain only one class. In practice, keras does not index beyond
-        the SoniaDataset object's length, so this isn't a problem at the moment for
-        ensuring both data and gen seqs appear in a mini-batch.
+        Only the mini-batches of the current plan can be indexed, i.e. index must be
+        smaller than the object's length.
 
         Parameters
         ----------
@@ -205,40 +267,35 @@ class SoniaDataset(keras.utils.PyDataset):
 
         Returns
         -------
-        x : numpy.ndarray of numpy.int8 or list of numpy.ndarray of numpy.int8
+        x : numpy.ndarray of numpy.float32 or list of numpy.ndarray of numpy.float32
             The features of class 0 and class 1 data.
         y : numpy.ndarray of numpy.int8
             The labels denoting which features come from class 0 or class 1 data.
+        sample_weight : numpy.ndarray of numpy.float64
+            The weights of the datapoints. Only returned if sample_weight was given.
         """
-        if self.sampling != 'unbalanced':
-            start_idx = index * self.batch_size // 2
-            end_idx = start_idx + self.batch_size // 2
-            indices_0 = self.class_0_indices[start_idx:end_idx]
-            indices_1 = self.class_1_indices[start_idx:end_idx]
-        else:
-            start_idx_0 = index * self.class_0_batch
-            end_idx_0 = start_idx_0 + self.class_0_batch
-            start_idx_1 = index * self.class_1_batch
-            end_idx_1 = start_idx_1 + self.class_1_batch
-            indices_0 = self.class_0_indices[start_idx_0:end_idx_0]
-            indices_1 = self.class_1_indices[start_idx_1:end_idx_1]
-
-        # It is faster to concatenate indices than it is to concatenate arrays
-        # of large two-dimensional arrays of features.
-        batch_indices = np.concatenate((
-            self.where_class_0[indices_0], self.where_class_1[indices_1]
-        ))
-
-        if self.sparse_input:
-            x = self.x[batch_indices].toarray()
+        # The layout is read once, as it is replaced (not modified) between epochs.
+        _, (_, bounds), x, y, sample_weight = self._current_layout()
+        start, stop = bounds[index], bounds[index + 1]
+
+        # A new array, as the tensors keras makes of a mini-batch may share its memory.
+        if isinstance(x, sparse.csr_array):
+            dense = np.zeros((stop - start, x.shape[1]), dtype=np.float32)
+            indptr = x.indptr[start:stop + 1]
+            rows = np.repeat(np.arange(stop - start), np.diff(indptr))
+            dense[rows, x.indices[indptr[0]:indptr[-1]]] = x.data[indptr[0]:indptr[-1]]
+        elif isinstance(x, (PaddedEncoding, EncodingView)):
+            dense = x[start:stop].toarray(
+                out=np.empty((stop - start, x.shape[1]), dtype=np.float32)
+            )
         else:
-            x = self.x[batch_indices]
-
-        y = self.y[batch_indices]
+            dense = np.array(x[start:stop], dtype=np.float32)
 
         if self.split_encoding is not None:
-            x = self.split_encoding(x)
-        return x, y
+            dense = self.split_encoding(dense)
+        if sample_weight is not None:
+            return dense, y[start:stop], sample_weight[start:stop]
+        return dense, y[start:stop]
 
     def __len__(
         self
@@ -256,50 +313,89 @@ class SoniaDataset(keras.utils.PyDataset):
             The number of mini-batches per epoch. If undersampling the majority
             class, the number of mini-batches is set by the minority class, and
             vice versa for oversampling. If unbalanced sampling, the number of
-            mini-batches is set by the total number of data and gen seqs.
+            mini-batches is set by the total number of data and gen seqs, as
+            it is if sampling is None.
         """
         return int(np.ceil(self.batch_constraint / self.batch_size))
 
-    def on_epoch_end_oversample(
-        self
-    ) -> None:
+    def epoch_plan(
+        self,
+        epoch: int
+    ) -> Tuple[NDArray[np.int64], NDArray[np.int64]]:
         """
-        Update the indices for the next epoch.
+        Return the rows of the mini-batches of an epoch.
 
-        For oversampling, the minority class is sampled with replacement each epoch
-        to match the size of the majority class. Shuffling affects only the indices
-        of the majority class.
+        The plan depends only on the seed and the epoch, so it is the same
+        whichever process computes it and however often it is computed.
+
+        For oversampling, the minority class is sampled with replacement to
+        match the size of the majority class, and shuffling affects only the
+        indices of the majority class. For undersampling and unbalanced
+        sampling, shuffling affects both classes. Without a sampling scheme,
+        data and gen seqs are shuffled together.
 
         Parameters
         ----------
-        None
+        epoch : int
+            The epoch.
 
         Returns
         -------
-        None
+        order : numpy.ndarray of numpy.int64
+            The rows of x in mini-batch order.
+        bounds : numpy.ndarray of numpy.int64
+            The mini-batch index gets the rows order[bounds[index]:bounds[index + 1]].
         """
-        if self.majority_class == 1:
-            self.class_0_indices = self.rng.choice(
-                self.class_0_size, size=self.class_1_size
-            )
-            self.class_1_indices = np.arange(self.class_1_size)
+        rng = np.random.default_rng(
+            np.random.SeedSequence(self.entropy, spawn_key=(epoch,))
+        )
+        num_batches = len(self)
+
+        if self.sampling is None:
+            order = np.arange(self.class_0_size + self.class_1_size)
             if self.shuffle == True:
-                self.rng.shuffle(self.class_1_indices)
-        else:
-            self.class_1_indices = self.rng.choice(
-                self.class_1_size, size=self.class_0_size
+                rng.shuffle(order)
+            bounds = np.minimum(
+                np.arange(num_batches + 1) * self.batch_size, len(order)
             )
-            self.class_0_indices = np.arange(self.class_0_size)
+            return order, bounds
+
+        if self.sampling == 'oversample':
+            if self.majority_class == 1:
+                class_0_indices = rng.choice(self.class_0_size, size=self.class_1_size)
+                class_1_indices = np.arange(self.class_1_size)
+                if self.shuffle == True:
+                    rng.shuffle(class_1_indices)
+            else:
+                class_1_indices = rng.choice(self.class_1_size, size=self.class_0_size)
+                class_0_indices = np.arange(self.class_0_size)
+                if self.shuffle == True:
+                    rng.shuffle(class_0_indices)
+        else:
+            class_0_indices = np.arange(self.class_0_size)
+            class_1_indices = np.arange(self.class_1_size)
             if self.shuffle == True:
-                self.rng.shuffle(self.class_0_indices)
+                rng.shuffle(class_0_indices)
+                rng.shuffle(class_1_indices)
 
-    def on_epoch_end_shuffle(
+        if self.sampling == 'unbalanced':
+            class_0_batch, class_1_batch = self.class_0_batch, self.class_1_batch
+        else:
+            class_0_batch = class_1_batch = self.batch_size // 2
+
+        return _interleave_classes(
+            self.where_class_0[class_0_indices], self.where_class_1[class_1_indices],
+            class_0_batch, class_1_batch, num_batches
+        )
+
+    def on_epoch_end(
         self
     ) -> None:
         """
-        Update the indices for the next epoch.
+        Move to the plan of the next epoch.
 
-        Shuffling affects both minority and majority classes.
+        Keras stops its workers before calling on_epoch_end. The rows are laid
+        out in the order of the new plan when a mini-batch is first requested.
 
         Parameters
         ----------
@@ -309,8 +405,115 @@ class SoniaDataset(keras.utils.PyDataset):
         -------
         None
         """
-        self.class_0_indices = np.arange(self.class_0_size)
-        self.class_1_indices = np.arange(self.class_1_size)
-        if self.shuffle == True:
-            self.rng.shuffle(self.class_0_indices)
-            self.rng.shuffle(self.class_1_indices)
+        self.epoch += 1
+
+    def set_epoch(
+        self,
+        epoch: int
+    ) -> None:
+        """
+        Move to the plan of an epoch, e.g. when resuming training.
+
+        Parameters
+        ----------
+        epoch : int
+            The epoch.
+
+        Returns
+        -------
+        None
+        """
+        self.epoch = epoch
+
+    @property
+    def plan(
+        self
+    ) -> Tuple[NDArray[np.int64], NDArray[np.int64]]:
+        """The plan of the current epoch (see epoch_plan)."""
+        return self._current_layout()[1]
+
+    def _current_layout(
+        self
+    ) -> Tuple[int, Tuple[NDArray[np.int64], NDArray[np.int64]], Any,
+               NDArray[np.int8], Optional[NDArray[np.float64]]]:
+        """
+        Return the epoch, plan, features, labels and weights of the current
+        epoch laid out in the order of the plan, building them once per epoch.
+        """
+        layout = self._layout
+        if layout is None or layout[0] != self.epoch:
+            # Workers may request the first mini-batches of an epoch at once.
+            with self._layout_lock:
+                layout = self._layout
+                epoch = self.epoch
+                if layout is None or layout[0] != epoch:
+                    plan = self.epoch_plan(epoch)
+                    order = plan[0]
+                    sample_weight = (
+                        None if self.sample_weight is None else self.sample_weight[order]
+                    )
+                    # A single assignment, so that __getitem__ never sees parts
+                    # of two epochs.
+                    layout = (epoch, plan, self.x[order], self.y[order], sample_weight)
+                    self._layout = layout
+        return layout
+
+def _interleave_classes(
+    rows_0: NDArray[np.int64],
+    rows_1: NDArray[np.int64],
+    class_0_batch: int,
+    class_1_batch: int,
+    num_batches: int
+) -> Tuple[NDArray[np.int64], NDArray[np.int64]]:
+    """
+    Lay out num_batches mini-batches of class_0_batch rows of rows_0 followed
+    by class_1_batch rows of rows_1, as (order, bounds) of SoniaDataset.epoch_plan.
+    """
+    # The rows of each class left after the last mini-batch are not used.
+    bounds_0 = np.minimum(np.arange(num_batches + 1) * class_0_batch, len(rows_0))
+    bounds_1 = np.minimum(np.arange(num_batches + 1) * class_1_batch, len(rows_1))
+    counts_0 = np.diff(bounds_0)
+    bounds = np.concatenate(([0], np.cumsum(counts_0 + np.diff(bounds_1))))
+
+    order = np.empty(bounds[-1], dtype=np.int64)
+    batch_0 = np.repeat(np.arange(num_batches), counts_0)
+    order[bounds[batch_0] + np.arange(bounds_0[-1]) - bounds_0[batch_0]] = rows_0[:bounds_0[-1]]
+    batch_1 = np.repeat(np.arange(num_batches), np.diff(bounds_1))
+    order[bounds[batch_1] + counts_0[batch_1] + np.arange(bounds_1[-1]) - bounds_1[batch_1]] = (
+        rows_1[:bounds_1[-1]]
+    )
+    return order, bounds
+
+class PlanEpochs(keras.callbacks.Callback):
+    """
+    Keras callback keeping the plans of SoniaDatasets at the epoch of model.fit.
+
+    Keras calls on_epoch_end of a dataset more than once per epoch, e.g. at
+    the start of fit and around each validation. This callback sets the
+    epoch of the datasets explicitly, so that the mini-batches of an epoch
+    only depend on its number, also when fit starts from initial_epoch.
+    """
+    def __init__(
+        self,
+        train_dataset: SoniaDataset,
+        val_dataset: Optional[SoniaDataset] = None
+    ) -> None:
+        super().__init__()
+        self.train_dataset = train_dataset
+        self.val_dataset = val_dataset
+        self._epoch = 0
+
+    def on_epoch_begin(
+        self,
+        epoch: int,
+        logs: Optional[Dict[str, float]] = None
+    ) -> None:
+        self._epoch = epoch
+        self.train_dataset.set_epoch(epoch)
+
+    def on_test_begin(
+        self,
+        logs: Optional[Dict[str, float]] = None
+    ) -> None:
+        if self.val_dataset is not None:
+            self.val_dataset.set_epoch(self._epoch)
@@ -15,8 +15,9 @@ from tensorflow import keras
 import tensorflow.keras.backend as K
 from tqdm import tqdm
 
+from sonnia.feature_encoder import FeatureEncoder, PAIRED_CHAINS, PAIRED_CROSS_CHAIN
 from sonnia.sonia import Sonia
-from sonnia.utils import define_pgen_model, gene_to_num_str, get_model_dir
+from sonnia.utils import define_pgen_model, get_model_dir, GeneVocabulary
 
 ACROSS_CHAIN_FEATURES_OPTIONS = {'jhjl', 'jhvl', 'vhjl', 'vhvl'}
 
@@ -102,6 +103,9 @@ class SoniaPaired(Sonia):
             raise RuntimeError('A VJ model was given to pgen_model_heavy. Please '
                                'rerun and point pgen_model_heavy to a VDJ pgen model.')
 
+        self.gene_vocabulary_light = GeneVocabulary(self.genomic_data_light)
+        self.gene_vocabulary_heavy = GeneVocabulary(self.genomic_data_heavy)
+
         valid_chain_pairs = [('IGL', 'IGH'), ('IGK', 'IGH'),
                              ('TRA', 'TRB'), ('TRG', 'TRD')]
 
@@ -139,20 +143,21 @@ class SoniaPaired(Sonia):
             If true, features for gene selection are also generated. Currently
             joint V/J pairs used.
         """
+        v_h_genes = ['v_h' + v[1:] for v in self.gene_vocabulary_heavy.genomic_num_strs('V')]
+        j_h_genes = ['j_h' + j[1:] for j in self.gene_vocabulary_heavy.genomic_num_strs('J')]
+        v_l_genes = ['v_l' + v[1:] for v in self.gene_vocabulary_light.genomic_num_strs('V')]
+        j_l_genes = ['j_l' + j[1:] for j in self.gene_vocabulary_light.genomic_num_strs('J')]
+
         features = []
 
         if self.gene_features == 'vjl':
             for l in range(1, self.max_L + 1):
                 features += [[v, j, f'l_l{l}']
-                             for v in set(['v_l' + gene_to_num_str(genV[0],'V')[1:]
-                                       for genV in self.genomic_data_light.genV])
-                             for j in set(['j_l' + gene_to_num_str(genJ[0],'J')[1:]
-                                       for genJ in self.genomic_data_light.genJ])]
+                             for v in v_l_genes
+                             for j in j_l_genes]
                 features += [[v, j, f'l_h{l}']
-                             for v in set(['v_h' + gene_to_num_str(genV[0],'V')[1:]
-                                       for genV in self.genomic_data_heavy.genV])
-                             for j in set(['j_h' + gene_to_num_str(genJ[0],'J')[1:]
-                                       for genJ in self.genomic_data_heavy.genJ])]
+                             for v in v_h_genes
+                             for j in j_h_genes]
         else:
             for l in range(1, self.max_L + 1):
                 features += [[f'l_l{l}'], [f'l_h{l}']]
@@ -164,54 +169,34 @@ class SoniaPaired(Sonia):
 
         if self.gene_features == 'joint_vj':
             features += [[v, j]
-                         for v in set(['v_l' + gene_to_num_str(genV[0],'V')[1:]
-                                       for genV in self.genomic_data_light.genV])
-                         for j in set(['j_l' + gene_to_num_str(genJ[0],'J')[1:]
-                                       for genJ in self.genomic_data_light.genJ])]
+                         for v in v_l_genes
+                         for j in j_l_genes]
             features += [[v, j]
-                         for v in set(['v_h'  + gene_to_num_str(genV[0],'V')[1:]
-                                       for genV in self.genomic_data_heavy.genV])
-                         for j in set(['j_h'  + gene_to_num_str(genJ[0],'J')[1:]
-                                       for genJ in self.genomic_data_heavy.genJ])]
+                         for v in v_h_genes
+                         for j in j_h_genes]
         if self.gene_features in {'indep_vj', 'v'}:
-            features += [[v]
-                         for v in set(['v_l' + gene_to_num_str(genV[0],'V')[1:]
-                                       for genV in self.genomic_data_light.genV])]
-            features += [[v]
-                         for v in set(['v_h' + gene_to_num_str(genV[0],'V')[1:]
-                                       for genV in self.genomic_data_heavy.genV])]
+            features += [[v] for v in v_l_genes]
+            features += [[v] for v in v_h_genes]
         if self.gene_features in {'indep_vj', 'j'}:
-            features += [[j]
-                         for j in set(['j_l'  + gene_to_num_str(genJ[0],'J')[1:]
-                                       for genJ in self.genomic_data_light.genJ])]
-            features += [[j]
-                         for j in set(['j_h'  + gene_to_num_str(genJ[0],'J')[1:]
-                                       for genJ in self.genomic_data_heavy.genJ])]
+            features += [[j] for j in j_l_genes]
+            features += [[j] for j in j_h_genes]
 
         if 'vhvl' in self.across_chain_features:
             features += [[vh, vl]
-                         for vh in set(['v_h'  + gene_to_num_str(genV[0],'V')[1:]
-                                        for genV in self.genomic_data_heavy.genV])
-                         for vl in set(['v_l' + gene_to_num_str(genV[0],'V')[1:]
-                                        for genV in self.genomic_data_light.genV])]
+                         for vh in v_h_genes
+                         for vl in v_l_genes]
         if 'jhjl' in self.across_chain_features:
             features += [[jh, jl]
-                         for jh in set(['j_h'  + gene_to_num_str(genJ[0],'J')[1:]
-                                        for genJ in self.genomic_data_heavy.genJ])
-                         for jl in set(['j_l'  + gene_to_num_str(genJ[0],'J')[1:]
-                                        for genJ in self.genomic_data_light.genJ])]
+                         for jh in j_h_genes
+                         for jl in j_l_genes]
         if 'vhjl' in self.across_chain_features:
             features += [[vh, jl]
-                         for vh in set(['v_h'  + gene_to_num_str(genV[0],'V')[1:]
-                                        for genV in self.genomic_data_heavy.genV])
-                         for jl in set(['j_l'  + gene_to_num_str(genJ[0],'J')[1:]
-                                        for genJ in self.genomic_data_light.genJ])]
+                         for vh in v_h_genes
+                         for jl in j_l_genes]
         if 'jhvl' in self.across_chain_features:
             features += [[jh, vl]
-                         for jh in set(['j_h'  + gene_to_num_str(genJ[0],'J')[1:]
-                                        for genJ in self.genomic_data_heavy.genJ])
-                         for vl in set(['v_l' + gene_to_num_str(genV[0],'V')[1:]
-                                        for genV in self.genomic_data_light.genV])]
+                         for jh in j_h_genes
+                         for vl in v_l_genes]
 
         self.update_model(add_features=features)
 
@@ -261,8 +246,8 @@ class SoniaPaired(Sonia):
             if bkd_key in feature_dict:
                 seq_features.add(feature_dict[bkd_key])
 
-        v_key_h = ('v_h' + gene_to_num_str(seq[1], 'V')[1:],)
-        j_key_h = ('j_h' + gene_to_num_str(seq[2], 'J')[1:],)
+        v_key_h = ('v_h' + self.gene_vocabulary_heavy.num_str(seq[1], 'V')[1:],)
+        j_key_h = ('j_h' + self.gene_vocabulary_heavy.num_str(seq[2], 'J')[1:],)
         vj_key = v_key_h + j_key_h
         vjl_key = vj_key + cdr3_len_key_h
         if v_key_h in feature_dict:
@@ -288,8 +273,8 @@ class SoniaPaired(Sonia):
             if bkd_key in feature_dict:
                 seq_features.add(feature_dict[bkd_key])
 
-        v_key_l = ('v_l' + gene_to_num_str(seq[4], 'V')[1:],)
-        j_key_l = ('j_l' + gene_to_num_str(seq[5], 'J')[1:],)
+        v_key_l = ('v_l' + self.gene_vocabulary_light.num_str(seq[4], 'V')[1:],)
+        j_key_l = ('j_l' + self.gene_vocabulary_light.num_str(seq[5], 'J')[1:],)
         vj_key = v_key_l + j_key_l
         vjl_key = vj_key + cdr3_len_key_l
         if v_key_l in feature_dict:
@@ -317,6 +302,23 @@ class SoniaPaired(Sonia):
 
         return list(seq_features)
 
+    def feature_encoder(
+        self,
+        features: Optional[Sequence[Tuple[str]]] = None,
+    ) -> FeatureEncoder:
+        """Return a vectorized encoder of the heavy, light and across chain features."""
+        if features is None:
+            feature_dict = self.feature_dict
+            num_features = len(self.features)
+        else:
+            feature_dict = {tuple(feature): idx for idx, feature in enumerate(features)}
+            num_features = len(features)
+        return FeatureEncoder(
+            feature_dict, num_features, chains=PAIRED_CHAINS,
+            cross_chain=PAIRED_CROSS_CHAIN,
+            vocabularies=(self.gene_vocabulary_heavy, self.gene_vocabulary_light)
+        )
+
     def generate_sequences_pre(
         self,
         num_seqs: int = 1,
@@ -16,8 +16,10 @@ import keras
 import keras.ops as ko
 from keras.losses import BinaryCrossentropy
 from keras.models import load_model as lm
+import scipy.sparse as sparse
 from tqdm import tqdm
 
+from sonnia.feature_encoder import as_csr, PaddedEncoding
 from sonnia.sonia import Sonia, GENE_FEATURE_OPTIONS
 from sonnia.utils import gene_to_num_str
 
@@ -165,6 +167,172 @@ class SoNNia(Sonia):
         enc3 = encoding[:, self.l_length + self.a_length:]
         return enc1, enc2, enc3
 
+    def index_encoding(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding
+    ) -> Tuple[NDArray[np.int32], NDArray[np.int32], NDArray[np.int32]]:
+        """
+        Split a one-hot encoding into the index inputs of the gather model.
+
+        This is the index counterpart of split_encoding, computed without
+        densifying the encoding.
+
+        Parameters
+        ----------
+        encoding : scipy.sparse.csr_array or sonnia.feature_encoder.PaddedEncoding
+            The one-hot encoding of the sequences.
+
+        Returns
+        -------
+        l_idxs : numpy.ndarray of numpy.int32
+            The length feature columns of each sequence, padded with l_length.
+        aa_idxs : numpy.ndarray of numpy.int32
+            Array of shape (N, 2 * max_depth) with the amino acid index of each
+            position, or 20 where the sequence has no amino acid.
+        vj_idxs : numpy.ndarray of numpy.int32
+            The gene feature columns of each sequence (relative to the first
+            gene feature), padded with vj_length.
+        """
+        num_seqs = encoding.shape[0]
+        if isinstance(encoding, PaddedEncoding):
+            rows = np.nonzero(encoding.idxs >= 0)[0]
+            cols = encoding.indices.astype(np.int64)
+        else:
+            encoding = as_csr(encoding)
+            rows = np.repeat(np.arange(num_seqs), np.diff(encoding.indptr))
+            cols = encoding.indices.astype(np.int64)
+
+        a_start = self.l_length
+        vj_start = self.l_length + self.a_length
+        num_positions = self.max_depth * 2
+
+        is_l = cols < a_start
+        is_vj = cols >= vj_start
+        is_aa = ~is_l & ~is_vj
+
+        aa_idxs = np.full((num_seqs, num_positions), 20, dtype=np.int32)
+        aa_cols = cols[is_aa] - a_start
+        aa_idxs[rows[is_aa], aa_cols % num_positions] = aa_cols // num_positions
+
+        l_idxs = _pad_rows(rows[is_l], cols[is_l], num_seqs, self.l_length)
+        vj_idxs = _pad_rows(rows[is_vj], cols[is_vj] - vj_start, num_seqs, self.vj_length)
+        return l_idxs, aa_idxs, vj_idxs
+
+    def _gather_layers(
+        self
+    ) -> Optional[Tuple[keras.layers.Dense, 'EmbedViaMatrix', keras.layers.Dense, keras.Model]]:
+        """
+        Return the layers used to evaluate the deep model from index inputs.
+
+        The length and gene inputs of the deep model built by
+        update_model_structure feed a Dense layer and the amino acid input an
+        EmbedViaMatrix layer. On one-hot inputs these layers select rows of
+        their kernels, so they can be replaced by lookups, followed by the
+        rest of the network. None is returned for other structures.
+        """
+        if getattr(self, '_gather_cache', (None,))[0] is self.model:
+            return self._gather_cache[1]
+
+        gather_layers = None
+        if len(self.model.inputs) == 3:
+            first_layers = []
+            for model_input in self.model.inputs:
+                consumers = [
+                    layer for layer in self.model.layers
+                    if not isinstance(layer, keras.layers.InputLayer)
+                    and any(layer_input is model_input for layer_input in
+                            keras.tree.flatten(layer.input))
+                ]
+                first_layers.append(consumers[0] if len(consumers) == 1 else None)
+            dense_l, embed, dense_vj = first_layers
+            if (isinstance(dense_l, keras.layers.Dense)
+                    and isinstance(embed, EmbedViaMatrix)
+                    and isinstance(dense_vj, keras.layers.Dense)):
+                head = keras.Model(
+                    [dense_l.output, embed.output, dense_vj.output], self.model.output
+                )
+                gather_layers = (dense_l, embed, dense_vj, head)
+
+        self._gather_cache = (self.model, gather_layers)
+        return gather_layers
+
+    def _model_inputs(
+        self,
+        encoding: sparse.csr_array | PaddedEncoding,
+        buffer: Optional[NDArray] = None
+    ) -> Tuple[Any, Optional[NDArray]]:
+        """
+        Return the model inputs of a chunk of a one-hot encoding.
+
+        The deep model is evaluated from the index inputs of index_encoding,
+        with the input layers replaced by row lookups of their kernels. On
+        one-hot inputs the lookups give exactly the products of the dense
+        layers, so the energies are identical, without building the dense
+        (N, 2 * max_depth, 20) amino acid tensor.
+        """
+        if self._gather_layers() is None:
+            return Sonia._model_inputs(self, encoding, buffer)
+        return self.index_encoding(encoding), None
+
+    def _input_row_bytes(
+        self
+    ) -> int:
+        """Return the bytes per sequence of the inputs built by _model_inputs."""
+        if self._gather_layers() is None:
+            return Sonia._input_row_bytes(self)
+        # The amino acid indices and at most a few length and gene indices.
+        return 4 * (2 * self.max_depth + 4)
+
+    def _call_model(
+        self,
+        inputs: Any
+    ) -> NDArray[np.float32]:
+        """Return the energies of the model on the inputs of _model_inputs."""
+        gather_layers = self._gather_layers()
+        if gather_layers is None:
+            return Sonia._call_model(self, inputs)
+
+        dense_l, embed, dense_vj, head = gather_layers
+        l_idxs, aa_idxs, vj_idxs = inputs
+        outputs = [
+            _gather_dense(dense_l, l_idxs),
+            ko.take(_pad_kernel(embed.kernel), aa_idxs, axis=0),
+            _gather_dense(dense_vj, vj_idxs),
+        ]
+        return ko.convert_to_numpy(head(outputs)[:, 0])
+
+    def linear_energy_params(
+        self
+    ) -> Optional[Tuple[NDArray[np.float32], float, float]]:
+        """
+        Return the feature energies and clip bounds of a shallow (deep=False) model.
+
+        The kernel of the single Dense layer is reordered from the flattened
+        (position, amino acid) order of the model input to the feature order.
+        None is returned for the deep model.
+        """
+        layers = [
+            layer for layer in self.model.layers
+            if not isinstance(layer, keras.layers.InputLayer)
+        ]
+        layer_types = [type(layer) for layer in layers]
+        if layer_types != [keras.layers.Flatten, keras.layers.Concatenate,
+                           keras.layers.Dense, keras.layers.Lambda]:
+            return None
+        _, _, dense, clip = layers
+        if (dense.use_bias or dense.units != 1
+                or dense.activation is not keras.activations.linear
+                or clip.function is not ko.clip):
+            return None
+
+        kernel = dense.get_weights()[0][:, 0]
+        a_end = self.l_length + self.a_length
+        aa_kernel = kernel[self.l_length:a_end].reshape(self.max_depth * 2, 20)
+        weights = np.concatenate(
+            (kernel[:self.l_length], aa_kernel.T.ravel(), kernel[a_end:])
+        )
+        return weights, clip.arguments['x_min'], clip.arguments['x_max']
+
     def _load_features_and_model(
         self,
         feature_file: str,
@@ -235,6 +403,36 @@ class SoNNia(Sonia):
         '''
         pass
 
+def _pad_rows(
+    rows: NDArray[np.int64],
+    values: NDArray[np.int64],
+    num_rows: int,
+    pad_value: int
+) -> NDArray[np.int32]:
+    """Gather the values of each row (rows must be sorted) into a padded matrix."""
+    counts = np.bincount(rows, minlength=num_rows)
+    width = max(int(counts.max(initial=0)), 1)
+    padded = np.full((num_rows, width), pad_value, dtype=np.int32)
+    starts = np.cumsum(counts) - counts
+    padded[rows, np.arange(len(rows)) - starts[rows]] = values
+    return padded
+
+def _pad_kernel(
+    kernel: keras.Variable
+):
+    """Append a row of zeros to a kernel, which is looked up by padding indices."""
+    return ko.concatenate([kernel, ko.zeros((1, kernel.shape[1]), dtype=kernel.dtype)], axis=0)
+
+def _gather_dense(
+    dense: keras.layers.Dense,
+    idxs: NDArray[np.int32]
+):
+    """Apply a Dense layer to the multi-hot inputs whose hot columns are idxs."""
+    outputs = ko.sum(ko.take(_pad_kernel(dense.kernel), idxs, axis=0), axis=1)
+    if dense.use_bias:
+        outputs = ko.add(outputs, dense.bias)
+    return dense.activation(outputs)
+
 class EmbedViaMatrix(keras.layers.Layer):
     """
     This layer defines a (learned) matrix M such that given matrix input X the
@@ -1,4 +1,5 @@
 from __future__ import annotations
+from collections import OrderedDict
 import inspect
 import logging
 import os
@@ -6,7 +7,7 @@ import subprocess
 from typing import *
 
 import numpy as np
-from numpy.typing import NDArray
+from numpy.typing import DTypeLike, NDArray
 import pandas as pd
 
 import olga.generation_probability as generation_probability
@@ -196,6 +197,7 @@ def filter_seqs(
     deduplicate_nt_recombinations: bool = True,
     return_bools: bool = False,
     verbose: bool = True,
+    raise_if_empty: bool = True,
     **kwargs: Dict[str, Any]
 ) -> NDArray[str]:
     """
@@ -238,6 +240,9 @@ def filter_seqs(
         Return a boolean array of whether the sequences are valid.
     verbose: bool, default True
         Print how many sequences remain after each filter.
+    raise_if_empty : bool, default True
+        Raise a RuntimeError if no sequences pass the filters. If False, an
+        empty result is returned instead (e.g. for a chunk of a large file).
     **kwargs : dict of {str : any}
         Keyword arguments to pandas.read_csv.
 
@@ -375,7 +380,7 @@ def filter_seqs(
     if v_col is not None:
         bool_arr[bool_arr] *= df.loc[bool_arr, v_col].isin(v_genes)
         num_pass = np.count_nonzero(bool_arr)
-        if num_pass == 0:
+        if num_pass == 0 and raise_if_empty:
             raise RuntimeError('No data are consistent with the V genes used '
                                f'in the model. Does {v_col} point to the column '
                                'containing V genes? Is the model choice correct '
@@ -387,7 +392,7 @@ def filter_seqs(
     if j_col is not None:
         bool_arr[bool_arr] *= df.loc[bool_arr, j_col].isin(j_genes)
         num_pass = np.count_nonzero(bool_arr)
-        if num_pass == 0:
+        if num_pass == 0 and raise_if_empty:
             raise RuntimeError('No data are consistent with the J genes used '
                                f'in the model. Does {j_col} point to the column '
                                'containing J genes? Is the model choice correct '
@@ -428,7 +433,7 @@ def filter_seqs(
     if verbose:
         logging.info(f'{num_pass} sequences remain. Filtering completed.')
 
-    if num_pass == 0:
+    if num_pass == 0 and raise_if_empty:
         verbose_str = ''
         if not verbose:
             verbose_str = ('Rerun with verbose = True for more details on how many '
@@ -453,6 +458,142 @@ def filter_seqs(
 
     return res
 
+def deduplicate_seqs(
+    seqs: Sequence[Sequence[str]] | NDArray[str],
+    counts: Optional[NDArray[np.int64]] = None
+) -> Tuple[NDArray[str], NDArray[np.int64], NDArray[np.int64]]:
+    """
+    Collapse identical sequences into unique sequences with multiplicities.
+
+    Parameters
+    ----------
+    seqs : iterable of iterable of str or numpy.ndarray of str
+        The sequences, e.g. rows of (CDR3, V gene, J gene).
+    counts : numpy.ndarray of numpy.int64, optional
+        The multiplicity of each sequence. Defaults to ones.
+
+    Returns
+    -------
+    unique_seqs : numpy.ndarray of str
+        The distinct sequences in order of first appearance.
+    unique_counts : numpy.ndarray of numpy.int64
+        The summed multiplicity of each distinct sequence.
+    first_idxs : numpy.ndarray of numpy.int64
+        The index in seqs of the first appearance of each distinct sequence.
+    """
+    seqs = np.asarray(seqs)
+    if counts is None:
+        counts = np.ones(len(seqs), dtype=np.int64)
+    if len(seqs) == 0:
+        return seqs, np.asarray(counts, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    if seqs.ndim == 1:
+        codes, _ = pd.factorize(seqs)
+    else:
+        codes, _ = pd.MultiIndex.from_arrays(list(seqs.T)).factorize()
+    # Codes are numbered in order of first appearance.
+    _, first_idxs = np.unique(codes, return_index=True)
+    unique_counts = np.bincount(codes, weights=counts).astype(np.int64)
+    return seqs[first_idxs], unique_counts, first_idxs
+
+class LRUCache(object):
+    """
+    Bounded mapping which evicts the least recently used keys.
+
+    Attributes
+    ----------
+    maxsize : int
+        The largest number of stored keys.
+    hits : int
+        The number of keys found by lookup since the cache was created.
+    misses : int
+        The number of keys not found by lookup since the cache was created.
+
+    Methods
+    -------
+    lookup(keys)
+        Return the stored values of keys and the indices of the missing keys.
+    update(keys, values)
+        Store values, evicting the least recently used keys over maxsize.
+    clear()
+        Remove all keys.
+    info()
+        Return the statistics of the cache.
+    """
+    def __init__(
+        self,
+        maxsize: int
+    ) -> None:
+        self.maxsize = maxsize
+        self._values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(
+        self
+    ) -> int:
+        return len(self._values)
+
+    def lookup(
+        self,
+        keys: Sequence[Hashable],
+        dtype: DTypeLike = np.float64
+    ) -> Tuple[NDArray, NDArray[np.int64]]:
+        """
+        Return the stored values of keys and the indices of the missing keys.
+
+        Parameters
+        ----------
+        keys : sequence of hashable
+            The keys looked up. Found keys become the most recently used.
+        dtype : numpy.dtype, default numpy.float64
+            The dtype of the returned values.
+
+        Returns
+        -------
+        values : numpy.ndarray
+            The value of each key, and 0 for missing keys.
+        miss_idxs : numpy.ndarray of numpy.int64
+            The indices in keys of the missing keys.
+        """
+        values = np.zeros(len(keys), dtype=dtype)
+        miss_idxs = []
+        for idx, key in enumerate(keys):
+            value = self._values.get(key)
+            if value is None:
+                miss_idxs.append(idx)
+            else:
+                self._values.move_to_end(key)
+                values[idx] = value
+        self.misses += len(miss_idxs)
+        self.hits += len(keys) - len(miss_idxs)
+        return values, np.array(miss_idxs, dtype=np.int64)
+
+    def update(
+        self,
+        keys: Sequence[Hashable],
+        values: Sequence[Any]
+    ) -> None:
+        """Store values of keys, evicting the least recently used keys over maxsize."""
+        for key, value in zip(keys, values):
+            self._values[key] = value
+            self._values.move_to_end(key)
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+
+    def clear(
+        self
+    ) -> None:
+        """Remove all keys, keeping the hit and miss counts."""
+        self._values.clear()
+
+    def info(
+        self
+    ) -> Dict[str, int]:
+        """Return the hits, misses, current size and maxsize of the cache."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._values), 'maxsize': self.maxsize}
+
 def sample_olga(num_gen_seqs=1,custom_model_folder=None,vj=False,chain_type='human_T_beta'):
     (genomic_data, generative_model,
      _, seq_model) = define_pgen_model(custom_model_folder, chain_type, vj)
@@ -464,81 +605,63 @@ def sample_olga(num_gen_seqs=1,custom_model_folder=None,vj=False,chain_type='hum
             for seq in [sg_model.gen_rnd_prod_CDR3(conserved_J_residues='ABCEDFGHIJKLMNOPQRSTUVWXYZ')
                         for _ in range(int(num_gen_seqs))]]
 
-def correct_olga_heavy(qm):
-    # this corrects only the V gene distribution.
-    # P(D,J)= P(D|J)P(J)
-    old_pv=qm.generative_model.PV
-    old_names=qm.pgen_model.V_allele_names
-    old_ns=[gene_to_num_str(v,'V') for v in old_names]
+def _p_allele_given_gene(probs, gene_ids):
+    # P(allele|gene) from the (marginal) probabilities of the alleles.
+    weigths=np.zeros(len(gene_ids))
+    for gene_id in np.unique(gene_ids):
+        indices=np.flatnonzero(gene_ids==gene_id)
+        weigths[indices]=np.nan_to_num(probs[indices]/np.sum(probs[indices]),1)
+    return weigths
+
+def _gene_freqs(gene_ids, num_genes):
+    # Frequencies of the genes (columns of gene_ids are combined) in the data.
+    gene_ids=gene_ids[np.all(gene_ids>=0,axis=1)]
+    flat_ids=np.ravel_multi_index(gene_ids.T,num_genes)
+    counts=np.bincount(flat_ids,minlength=np.prod(num_genes)).reshape(num_genes)
+    return counts/np.sum(counts)
+
+def _corrected_pv(old_pv, old_names, data_v_ids, vocabulary):
+    # P(V) of the data, split over the alleles of each gene as in old_pv.
+    old_ids=vocabulary.gene_ids(old_names,'V')
 
     #P(allele|V)
-    p_allele_given_v={}
-    for v in set(old_ns):
-        indices=np.arange(len(old_ns))[np.array(old_ns)==v]
-        alleles_probs=np.nan_to_num(old_pv[indices]/np.sum(old_pv[indices]),1)
-        for i,j in enumerate(alleles_probs):
-            p_allele_given_v[str(i)+'_'+str(indices[i])+'_' +v]=j
-    weigths=np.zeros(len(old_names))
-    for v in list(p_allele_given_v): weigths[int(v.split('_')[1])]=p_allele_given_v[v]
+    weigths=_p_allele_given_gene(old_pv,old_ids)
 
     # compute probabilities data
-    v_data,count_data=np.unique(np.array(qm.data_seqs)[:,1],return_counts=True)
-    freq_data=count_data/np.sum(count_data)
-    v_data_ns=[gene_to_num_str(v,'V') for v in v_data]
-    dict_data=dict(zip(v_data_ns,freq_data))
-
-    new_pv=np.zeros(len(old_ns))
-    for i,v in enumerate(old_ns):
-        if v in v_data_ns: new_pv[i]=weigths[i]*dict_data[v]
-
-    qm.generative_model.PV=np.array(new_pv)
-    qm.seq_gen_model = sequence_generation.SequenceGenerationVDJ(qm.generative_model, qm.genomic_data)
-    qm.pgen_model = generation_probability.GenerationProbabilityVDJ(qm.generative_model, qm.genomic_data)
-
-def correct_olga_light(qm):
+    freq_data=_gene_freqs(data_v_ids[:,None],(len(vocabulary.num_strs['V']),))
+    return weigths*freq_data[old_ids]
 
-    old_pvj=qm.generative_model.PVJ
-    old_names_v=qm.pgen_model.V_allele_names
-    old_names_j=qm.pgen_model.J_allele_names
-    old_ns_v=[gene_to_num_str(v,'V') for v in old_names_v]
-    old_ns_j=[gene_to_num_str(v,'J') for v in old_names_j]
+def _corrected_pvj(old_pvj, old_names_v, old_names_j, data_vj_ids, vocabulary):
+    # P(V,J) of the data, split over the alleles of each gene as in old_pvj.
+    old_ids_v=vocabulary.gene_ids(old_names_v,'V')
+    old_ids_j=vocabulary.gene_ids(old_names_j,'J')
 
     #P(alleleV|VJ)
-    p_allele_given_v={}
-    for v in set(old_ns_v):
-        indices=np.arange(len(old_ns_v))[np.array(old_ns_v)==v]
-        new_probs=old_pvj[indices].sum(axis=-1)
-        alleles_probs=np.nan_to_num(new_probs/np.sum(new_probs),1)
-        for i,j in enumerate(alleles_probs):
-            p_allele_given_v[str(i)+'_'+str(indices[i])+'_' +v]=j
-
-    weigths_v={}
-    for v in list(p_allele_given_v): weigths_v[int(v.split('_')[1])]=p_allele_given_v[v]
-
+    weigths_v=_p_allele_given_gene(old_pvj.sum(axis=-1),old_ids_v)
     #P(alleleJ|VJ)
-    p_allele_given_j={}
-    for v in set(old_ns_j):
-        indices=np.arange(len(old_ns_j))[np.array(old_ns_j)==v]
-        new_probs=old_pvj.T[indices].sum(axis=-1)
-        alleles_probs=np.nan_to_num(new_probs/np.sum(new_probs),1)
-        for i,j in enumerate(alleles_probs):
-            p_allele_given_j[str(i)+'_'+str(indices[i])+'_' +v]=j
-    weigths_j={}
-    for v in list(p_allele_given_j): weigths_j[int(v.split('_')[1])]=p_allele_given_j[v]
+    weigths_j=_p_allele_given_gene(old_pvj.T.sum(axis=-1),old_ids_j)
 
     # compute probabilities data
-    VJ_pair= [gene_to_num_str(v,'V')+','+gene_to_num_str(j,'J') for v,j in np.array(qm.data_seqs)[:,1:]]
-    vj_data,count_data=np.unique(VJ_pair,return_counts=True)
-    freq_data=count_data/np.sum(count_data)
-    dict_data=dict(zip(vj_data,freq_data))
-
-    new_pvj=np.zeros(np.array(old_pvj).shape)
-    for i,v in enumerate(old_ns_v):
-        for k,j in enumerate(old_ns_j):
-            if v+','+j in vj_data: new_pvj[i,k]=dict_data[v+','+j]*weigths_v[i]*weigths_j[k]
-    new_pvj=new_pvj/np.sum(new_pvj)
-
-    qm.generative_model.PVJ=np.array(new_pvj)
+    num_genes=(len(vocabulary.num_strs['V']),len(vocabulary.num_strs['J']))
+    freq_data=_gene_freqs(data_vj_ids,num_genes)
+    new_pvj=freq_data[np.ix_(old_ids_v,old_ids_j)]*weigths_v[:,None]*weigths_j[None,:]
+    return new_pvj/np.sum(new_pvj)
+
+def correct_olga_heavy(qm):
+    # this corrects only the V gene distribution.
+    # P(D,J)= P(D|J)P(J)
+    qm.generative_model.PV=_corrected_pv(
+        qm.generative_model.PV,qm.pgen_model.V_allele_names,
+        qm.data_gene_ids[:,0],qm.gene_vocabulary
+    )
+    qm.seq_gen_model = sequence_generation.SequenceGenerationVDJ(qm.generative_model, qm.genomic_data)
+    qm.pgen_model = generation_probability.GenerationProbabilityVDJ(qm.generative_model, qm.genomic_data)
+
+def correct_olga_light(qm):
+    qm.generative_model.PVJ=_corrected_pvj(
+        qm.generative_model.PVJ,qm.pgen_model.V_allele_names,qm.pgen_model.J_allele_names,
+        qm.data_gene_ids[:,:2],qm.gene_vocabulary
+    )
     qm.seq_gen_model = sequence_generation.SequenceGenerationVJ(qm.generative_model, qm.genomic_data)
     qm.pgen_model = generation_probability.GenerationProbabilityVJ(qm.generative_model, qm.genomic_data)
 
@@ -549,31 +672,10 @@ def correct_olga_paired(qm):
     ### heavy chain #####
     #####################
 
-    old_pv=qm.generative_model_heavy.PV
-    old_names=qm.pgen_model_heavy.V_allele_names
-    old_ns=[gene_to_num_str(v,'V') for v in old_names]
-
-    #P(allele|V)
-    p_allele_given_v={}
-    for v in set(old_ns):
-        indices=np.arange(len(old_ns))[np.array(old_ns)==v]
-        alleles_probs=np.nan_to_num(old_pv[indices]/np.sum(old_pv[indices]),1)
-        for i,j in enumerate(alleles_probs):
-            p_allele_given_v[str(i)+'_'+str(indices[i])+'_' +v]=j
-    weigths=np.zeros(len(old_names))
-    for v in list(p_allele_given_v): weigths[int(v.split('_')[1])]=p_allele_given_v[v]
-
-    # compute probabilities data
-    v_data,count_data=np.unique(np.array(qm.data_seqs)[:,1],return_counts=True)
-    freq_data=count_data/np.sum(count_data)
-    v_data_ns=[gene_to_num_str(v,'V') for v in v_data]
-    dict_data=dict(zip(v_data_ns,freq_data))
-
-    new_pv=np.zeros(len(old_ns))
-    for i,v in enumerate(old_ns):
-        if v in v_data_ns: new_pv[i]=weigths[i]*dict_data[v]
-
-    qm.generative_model_heavy.PV=np.array(new_pv)
+    qm.generative_model_heavy.PV=_corrected_pv(
+        qm.generative_model_heavy.PV,qm.pgen_model_heavy.V_allele_names,
+        qm.data_gene_ids[:,0],qm.gene_vocabulary_heavy
+    )
     qm.seq_gen_model_heavy = sequence_generation.SequenceGenerationVDJ(qm.generative_model_heavy, qm.genomic_data_heavy)
     qm.pgen_model_heavy = generation_probability.GenerationProbabilityVDJ(qm.generative_model_heavy, qm.genomic_data_heavy)
 
@@ -581,47 +683,10 @@ def correct_olga_paired(qm):
     ### light chain #####
     #####################
 
-    old_pvj=qm.generative_model_light.PVJ
-    old_names_v=qm.pgen_model_light.V_allele_names
-    old_names_j=qm.pgen_model_light.J_allele_names
-    old_ns_v=[gene_to_num_str(v,'V') for v in old_names_v]
-    old_ns_j=[gene_to_num_str(v,'J') for v in old_names_j]
-
-    #P(alleleV|VJ)
-    p_allele_given_v={}
-    for v in set(old_ns_v):
-        indices=np.arange(len(old_ns_v))[np.array(old_ns_v)==v]
-        new_probs=old_pvj[indices].sum(axis=-1)
-        alleles_probs=np.nan_to_num(new_probs/np.sum(new_probs),1)
-        for i,j in enumerate(alleles_probs):
-            p_allele_given_v[str(i)+'_'+str(indices[i])+'_' +v]=j
-
-    weigths_v={}
-    for v in list(p_allele_given_v): weigths_v[int(v.split('_')[1])]=p_allele_given_v[v]
-
-    #P(alleleJ|VJ)
-    p_allele_given_j={}
-    for v in set(old_ns_j):
-        indices=np.arange(len(old_ns_j))[np.array(old_ns_j)==v]
-        new_probs=old_pvj.T[indices].sum(axis=-1)
-        alleles_probs=np.nan_to_num(new_probs/np.sum(new_probs),1)
-        for i,j in enumerate(alleles_probs):
-            p_allele_given_j[str(i)+'_'+str(indices[i])+'_' +v]=j
-    weigths_j={}
-    for v in list(p_allele_given_j): weigths_j[int(v.split('_')[1])]=p_allele_given_j[v]
-
-    # compute probabilities data
-    VJ_pair= [gene_to_num_str(v,'V')+','+gene_to_num_str(j,'J') for v,j in np.array(qm.data_seqs)[:,4:]]
-    vj_data,count_data=np.unique(VJ_pair,return_counts=True)
-    freq_data=count_data/np.sum(count_data)
-    dict_data=dict(zip(vj_data,freq_data))
-
-    new_pvj=np.zeros(np.array(old_pvj).shape)
-    for i,v in enumerate(old_ns_v):
-        for k,j in enumerate(old_ns_j):
-            if v+','+j in vj_data: new_pvj[i,k]=dict_data[v+','+j]*weigths_v[i]*weigths_j[k]
-    new_pvj=new_pvj/np.sum(new_pvj)
-    qm.generative_model_light.PVJ=np.array(new_pvj)
+    qm.generative_model_light.PVJ=_corrected_pvj(
+        qm.generative_model_light.PVJ,qm.pgen_model_light.V_allele_names,
+        qm.pgen_model_light.J_allele_names,qm.data_gene_ids[:,2:4],qm.gene_vocabulary_light
+    )
     qm.seq_gen_model_light = sequence_generation.SequenceGenerationVJ(qm.generative_model_light, qm.genomic_data_light)
     qm.pgen_model_light = generation_probability.GenerationProbabilityVJ(qm.generative_model_light, qm.genomic_data_light)
 
@@ -664,6 +729,132 @@ def gene_to_num_str(
              ).replace('/', '').replace('-1', '')
     return gene_type + suffix
 
+class GeneVocabulary(object):
+    """
+    Integer IDs of V and J genes.
+
+    Each distinct gene_to_num_str name gets an ID. The vocabulary is built
+    from the genes of an OLGA genomic data object, so that IDs 0, ...,
+    num_genomic_genes[gene_type] - 1 are the genes of the pgen model. Raw gene
+    or allele strings are mapped to IDs through a memoized table, so that
+    gene_to_num_str runs once per distinct string. Names which are not in the
+    genomic data are appended to the vocabulary when first seen.
+
+    Attributes
+    ----------
+    num_strs : dict of {str : list of str}
+        The gene_to_num_str name of each ID for the gene types 'V' and 'J'.
+    num_genomic_genes : dict of {str : int}
+        The number of IDs coming from the genomic data for each gene type.
+
+    Methods
+    -------
+    gene_id(gene, gene_type)
+        Return the ID of a gene or allele string.
+    gene_ids(genes, gene_type)
+        Return the IDs of an array of gene or allele strings.
+    genomic_num_strs(gene_type)
+        Return the names of the genes in the genomic data.
+    """
+    def __init__(
+        self,
+        genomic_data: Optional[Union[olga_load_model.GenomicDataVJ,
+                                     olga_load_model.GenomicDataVDJ]] = None
+    ) -> None:
+        self.num_strs = {'V': [], 'J': []}
+        self.num_genomic_genes = {'V': 0, 'J': 0}
+        self._num_str_ids = {'V': {}, 'J': {}}
+        self._gene_ids = {'V': {}, 'J': {}}
+
+        if genomic_data is not None:
+            for gene_type, genes in (('V', genomic_data.genV), ('J', genomic_data.genJ)):
+                for gene in genes:
+                    self.gene_id(gene[0], gene_type)
+                self.num_genomic_genes[gene_type] = len(self.num_strs[gene_type])
+
+    def __len__(
+        self
+    ) -> int:
+        return len(self.num_strs['V']) + len(self.num_strs['J'])
+
+    def gene_id(
+        self,
+        gene: str,
+        gene_type: str
+    ) -> int:
+        """
+        Return the ID of a gene or allele string.
+
+        Parameters
+        ----------
+        gene : str
+            Gene or allele name.
+        gene_type : str
+            'V' or 'J'.
+
+        Returns
+        -------
+        int
+            The ID of the gene_to_num_str name of the gene.
+        """
+        gene_ids = self._gene_ids[gene_type]
+        gene_id = gene_ids.get(gene)
+        if gene_id is None:
+            num_str = gene_to_num_str(gene, gene_type)
+            num_str_ids = self._num_str_ids[gene_type]
+            gene_id = num_str_ids.get(num_str)
+            if gene_id is None:
+                gene_id = len(self.num_strs[gene_type])
+                num_str_ids[num_str] = gene_id
+                self.num_strs[gene_type].append(num_str)
+            gene_ids[gene] = gene_id
+        return gene_id
+
+    def gene_ids(
+        self,
+        genes: Sequence[str],
+        gene_type: str
+    ) -> NDArray[np.int32]:
+        """
+        Return the IDs of an array of gene or allele strings.
+
+        Missing values (e.g. NaN in a DataFrame column) get the ID -1.
+
+        Parameters
+        ----------
+        genes : sequence of str
+            Gene or allele names.
+        gene_type : str
+            'V' or 'J'.
+
+        Returns
+        -------
+        numpy.ndarray of numpy.int32
+            The ID of each gene.
+        """
+        codes, unique_genes = pd.factorize(np.asarray(genes))
+        unique_ids = np.array(
+            [self.gene_id(gene, gene_type) for gene in unique_genes.tolist()] + [-1],
+            dtype=np.int32
+        )
+        # pandas codes missing values as -1, which picks the trailing -1.
+        return unique_ids.take(codes)
+
+    def num_str(
+        self,
+        gene: str,
+        gene_type: str
+    ) -> str:
+        """Memoized equivalent of gene_to_num_str(gene, gene_type)."""
+        return self.num_strs[gene_type][self.gene_id(gene, gene_type)]
+
+    def genomic_num_strs(
+        self,
+        gene_type: str
+    ) -> List[str]:
+        """Return the names of the genes in the genomic data."""
+        return self.num_strs[gene_type][:self.num_genomic_genes[gene_type]]
+
 def compute_pgen_expand(x):
     # compute pgen conditioned on gene usage
     return x[1].compute_aa_CDR3_pgen(x[0][0],x[0][1],x[0][2])
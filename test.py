@@ -8,8 +8,16 @@ from sonnia.sonnia import SoNNia
 from sonnia.sonia import Sonia
 from sonnia.sonia_paired import SoniaPaired
 from sonnia.sonnia_paired import SoNNiaPaired
+from sonnia.scorer import NumpyScorer, quantization_report
+from sonnia.utils import gene_to_num_str, GeneVocabulary, partial_joint_marginals
+from sonnia.feature_encoder import cooccurrence_block_sums, cooccurrence_sums, encoding_dot, EncodingView, feature_sums, vstack_encodings
+from sonnia.parallel_marginals import parallel_cooccurrence_block_sums, parallel_cooccurrence_sums, parallel_feature_sums
+from sonnia.sonia_dataset import SoniaDataset
+from sonnia.multi_sonia import infer_selection_models
 import os
+import threading
 import unittest
+from unittest import mock
 import shutil
 
 class Test(unittest.TestCase):
@@ -56,6 +64,269 @@ class Test(unittest.TestCase):
         qm3.infer_selection(epochs=5)
         self.assertTrue(len(qm3.likelihood_test)==5)
 
+    def test_gene_vocabulary(self):
+        vocabulary=GeneVocabulary(Sonia(pgen_model='humanTRB').genomic_data)
+        num_genomic_genes=vocabulary.num_genomic_genes['V']
+        genes=np.array(['TRBV10-1*01','TRBV10-1','TRBV10-1*02',None,np.nan,'TRBV99-9','TRBV99-9*01'],dtype=object)
+        ids=vocabulary.gene_ids(genes,'V')
+        self.assertEqual(ids.dtype,np.int32)
+        self.assertTrue(ids[0]==ids[1]==ids[2] and 0<=ids[0]<num_genomic_genes)
+        self.assertEqual(vocabulary.num_strs['V'][ids[0]],gene_to_num_str('TRBV10-1*01','V'))
+        # Missing genes map to -1, genes unknown to the pgen model get new IDs.
+        self.assertTrue(ids[3]==ids[4]==-1)
+        self.assertTrue(ids[5]==ids[6]==num_genomic_genes)
+        self.assertTrue(np.array_equal(vocabulary.gene_ids(genes[::-1],'V'),ids[::-1]))
+        self.assertEqual(vocabulary.num_genomic_genes['V'],num_genomic_genes)
+
+    def test_encode_data(self):
+        qm=Sonia(ppost_model='humanTRB')
+        seqs=qm.generate_sequences_pre(int(1e3))
+        encoding=qm.encode_data(seqs)
+        for i, seq in enumerate(seqs):
+            self.assertTrue(
+                sorted(qm.find_seq_features(seq))==encoding.indices[encoding.indptr[i]:encoding.indptr[i+1]].tolist()
+            )
+        parallel=qm.feature_encoder().encode(seqs,chunksize=70,processes=3)
+        self.assertEqual(parallel.shape,encoding.shape)
+        self.assertTrue(np.array_equal(parallel.indices,encoding.indices) and np.array_equal(parallel.indptr,encoding.indptr))
+
+    def test_iter_encode(self):
+        qm=Sonia(ppost_model='humanTRB')
+        seqs=qm.generate_sequences_pre(int(1e3))
+        energies=qm.compute_energy(qm.encode_data(seqs))
+        chunks=list(qm.iter_encode(seqs,chunksize=300,filter_sequences=False))
+        self.assertTrue(len(chunks)==4)
+        self.assertTrue(np.allclose(qm.compute_energy(chunks),energies))
+
+    def test_padded_encode(self):
+        qm=Sonia(ppost_model='humanTRB')
+        seqs=qm.generate_sequences_pre(int(1e3))
+        encoding=qm.encode_data(seqs)
+        padded=qm.encode_data(seqs,padded=True)
+        self.assertTrue((padded.tocsr()!=encoding).nnz==0)
+        self.assertTrue(np.allclose(qm.compute_energy(padded),qm.compute_energy(encoding)))
+        self.assertTrue(np.allclose(qm.compute_marginals(encoding=padded),qm.compute_marginals(encoding=encoding)))
+
+    def test_gather_energies(self):
+        seqs=Sonia(ppost_model='humanTRB').generate_sequences_pre(int(1e3))
+        for gene_features in ['indep_vj','joint_vj']:
+            qm=SoNNia(pgen_model='humanTRB',gene_features=gene_features)
+            self.assertTrue(qm._gather_layers() is not None)
+            csr=qm.encode_data(seqs)
+            dense=qm.model(list(qm.split_encoding(csr.toarray())))[:,0].numpy()
+            for encoding in [csr,qm.encode_data(seqs,padded=True)]:
+                idxs=qm.index_encoding(encoding)
+                self.assertTrue(all(np.array_equal(a,b) for a,b in zip(idxs,qm.index_encoding(csr))))
+                self.assertTrue(np.allclose(qm._call_model(idxs),dense,atol=1e-6))
+                self.assertTrue(np.allclose(qm.compute_energy(encoding),dense,atol=1e-6))
+
+    def test_pipelined_energies(self):
+        qm=SoNNia(pgen_model='humanTRB')
+        seqs=qm.generate_sequences_pre(int(1e3))
+        csr=qm.encode_data(seqs)
+        dense=qm.model(list(qm.split_encoding(csr.toarray())))[:,0].numpy()
+        for encoding in [csr,qm.encode_data(seqs,padded=True)]:
+            pipelined=qm.compute_energy(encoding,chunksize=128,prefetch=2)
+            self.assertTrue(np.array_equal(pipelined,qm.compute_energy(encoding,chunksize=128,prefetch=0)))
+            self.assertTrue(np.allclose(pipelined,dense,atol=1e-6))
+        # The dense inputs recycle their buffers between chunks.
+        qm._gather_cache=(qm.model,None)
+        self.assertTrue(np.allclose(qm.compute_energy(csr,chunksize=128,prefetch=2),dense,atol=1e-6))
+        del qm._gather_cache
+
+        num_threads=threading.active_count()
+        model_inputs=qm._model_inputs
+        def failing_inputs(encoding,buffer=None):
+            if failing_inputs.calls==2:
+                raise ValueError('chunk failed')
+            failing_inputs.calls+=1
+            return model_inputs(encoding,buffer)
+        failing_inputs.calls=0
+        with mock.patch.object(qm,'_model_inputs',failing_inputs):
+            with self.assertRaises(ValueError):
+                qm.compute_energy(csr,chunksize=128,prefetch=2)
+        self.assertEqual(threading.active_count(),num_threads)
+
+    def test_encoding_view(self):
+        qm=Sonia(ppost_model='humanTRB')
+        seqs=qm.generate_sequences_pre(int(1e3))
+        encodings=(qm.encode_data(seqs[:400]),qm.encode_data(seqs[400:],padded=True))
+        rows=np.random.default_rng(0).integers(1000,size=1500)
+        view=EncodingView(encodings)[rows]
+        stacked=vstack_encodings(encodings)[rows]
+        self.assertTrue(np.array_equal(view[100:600].toarray(),stacked[100:600].toarray()))
+        values,weights=np.random.default_rng(1).normal(size=(2,len(qm.features))),np.arange(1500.)
+        self.assertTrue(np.allclose(encoding_dot(view,values[0]),encoding_dot(stacked,values[0])))
+        self.assertTrue(np.allclose(feature_sums(view,weights),feature_sums(stacked,weights)))
+
+    def test_encoding_cache(self):
+        qm=Sonia(pgen_model='humanTRB')
+        seqs=qm.generate_sequences_pre(int(1e3))
+        qm1=Sonia(pgen_model='humanTRB',data_seqs=seqs,gen_seqs=seqs,encoding_cache='cache_test')
+        qm2=Sonia(pgen_model='humanTRB',data_seqs=seqs,gen_seqs=seqs,encoding_cache='cache_test')
+        self.assertTrue((qm1.gen_encoding!=qm2.gen_encoding).nnz==0)
+        self.assertTrue(len(os.listdir('cache_test'))==2)
+        shutil.rmtree('cache_test')
+
+    def test_deduplicate(self):
+        qm=Sonia(pgen_model='humanTRB')
+        seqs=qm.generate_sequences_pre(int(1e2))
+        seqs=np.concatenate([seqs,seqs[:50]])
+        qm1=Sonia(pgen_model='humanTRB',data_seqs=seqs,gen_seqs=seqs)
+        qm2=Sonia(pgen_model='humanTRB',data_seqs=seqs,gen_seqs=seqs,deduplicate=True)
+        self.assertTrue(qm2.data_encoding.shape[0]<=100)
+        self.assertTrue(np.sum(qm2.data_seq_counts)==150)
+        self.assertTrue(np.allclose(qm1.data_marginals,qm2.data_marginals))
+
+    def test_numpy_scorer(self):
+        qm=Sonia(ppost_model='humanTRB')
+        seqs=qm.generate_sequences_pre(int(1e3))
+        NumpyScorer.from_model(qm).save('scorer_test.npz')
+        scorer=NumpyScorer.load('scorer_test.npz')
+        os.remove('scorer_test.npz')
+        self.assertTrue(np.allclose(scorer.evaluate_selection_factors(seqs),qm.evaluate_selection_factors(seqs)))
+        scorer.quantize('int8').save('scorer_test.npz')
+        quantized=NumpyScorer.load('scorer_test.npz')
+        os.remove('scorer_test.npz')
+        self.assertTrue(np.allclose(quantized.evaluate_selection_factors(seqs),scorer.quantize('int8').evaluate_selection_factors(seqs)))
+        report=quantization_report(scorer,seqs)
+        self.assertTrue(report['float16']['max_abs_log_q_error']<0.05)
+        self.assertTrue(report['int8']['speedup']>0)
+        self.assertTrue(report['int8']['weight_nbytes']<report['float32']['weight_nbytes'])
+
+    def test_score_cache(self):
+        qm=Sonia(ppost_model='humanTRB',score_cache_size=int(1e3))
+        seqs=qm.generate_sequences_pre(int(1e3))
+        q=qm.evaluate_selection_factors(seqs)
+        self.assertTrue(np.array_equal(qm.evaluate_selection_factors(seqs),q))
+        self.assertEqual(qm.score_cache_info()['energy']['hits'],len(seqs))
+        qm.model.set_weights([w*0.5 for w in qm.model.get_weights()])
+        qm.Z=2.
+        q_new=qm.evaluate_selection_factors(seqs)
+        self.assertTrue(np.allclose(q_new,np.exp(-qm.compute_energy(qm.encode_data(seqs)))/2.))
+
+    def test_joint_marginals(self):
+        qm=Sonia(ppost_model='humanTRB')
+        encoding=qm.encode_data(qm.generate_sequences_pre(int(1e3)))
+        l=encoding.shape[1]
+        expected,Z=partial_joint_marginals((qm.encoding_to_feature_idxs(encoding),np.ones(encoding.shape[0]),np.zeros((l,l))))
+        self.assertTrue(np.allclose(qm.joint_marginals(encoding=encoding,use_flat_distribution=True),expected/Z))
+        blocks=qm.joint_marginals(encoding=encoding,use_flat_distribution=True,blocks=[('a','a')])
+        a_idxs=qm.feature_groups()['a']
+        self.assertTrue(np.allclose(blocks[('a','a')],(expected/Z)[np.ix_(a_idxs,a_idxs)],atol=1e-7))
+        weights=np.random.rand(encoding.shape[0])
+        self.assertTrue(np.allclose(parallel_feature_sums(encoding,[weights],2,chunksize=300)[0],feature_sums(encoding,weights)))
+        self.assertTrue(np.allclose(parallel_cooccurrence_sums(encoding,[weights],2,chunksize=300)[0].toarray(),cooccurrence_sums(encoding,[weights])[0].toarray()))
+        l_idxs=qm.feature_groups()['l']
+        block_columns=[(a_idxs,a_idxs),(a_idxs,l_idxs),None]
+        for block_sums in [cooccurrence_block_sums(encoding,[weights,np.ones(len(weights))],block_columns,chunksize=300),
+                           parallel_cooccurrence_block_sums(encoding,[weights,np.ones(len(weights))],2,block_columns,chunksize=300)]:
+            for columns,sums in zip(block_columns,block_sums):
+                expected_sums=cooccurrence_sums(encoding,[weights,np.ones(len(weights))],columns=columns)
+                self.assertTrue(all(np.allclose(s.toarray(),e.toarray()) for s,e in zip(sums,expected_sums)))
+
+    def test_memory_budget(self):
+        qm=Sonia(ppost_model='humanTRB',memory_budget=16*300)
+        seqs=qm.generate_sequences_pre(int(1e3))
+        self.assertEqual(qm.energy_row_bytes(),16)
+        self.assertEqual(qm.budget_chunksize('compute_energy',qm.energy_row_bytes(),int(1e6)),300)
+        self.assertEqual(qm.budget_chunksize('compute_energy',16,int(1e6),chunksize=100),100)
+        self.assertEqual(qm.budget_chunksize('compute_energy',16,int(1e6),chunksize=1000),300)
+        with self.assertRaises(RuntimeError):
+            qm.budget_chunksize('compute_energy',16*301,int(1e6))
+        encoding=qm.encode_data(seqs)
+        energies=qm.compute_energy(encoding)
+        qm.memory_budget=None
+        self.assertTrue(np.allclose(energies,qm.compute_energy(encoding)))
+        y=(np.arange(encoding.shape[0])%2).astype(np.int8)
+        with self.assertRaises(RuntimeError):
+            SoniaDataset(encoding,y,None,100,memory_budget=100*encoding.shape[1]*4)
+        SoniaDataset(encoding,y,None,100,memory_budget=2*100*encoding.shape[1]*4)
+
+    def test_dataset_plan(self):
+        qm=Sonia(pgen_model='humanTRB')
+        x=qm.encode_data(qm.generate_sequences_pre(int(1e3)))
+        y=(np.arange(x.shape[0])%3==0).astype(np.int8)
+        for sampling in ['undersample','oversample','unbalanced',None]:
+            dataset=SoniaDataset(x,y,sampling,100,seed=0)
+            dataset.on_epoch_end()
+            threaded=SoniaDataset(x,y,sampling,100,seed=0,workers=4)
+            plan=threaded.epoch_plan(1)
+            self.assertTrue(np.array_equal(dataset.plan[0],plan[0]) and np.array_equal(dataset.plan[1],plan[1]))
+            if sampling is not None:
+                self.assertTrue(all(len(np.unique(dataset[i][1]))==2 for i in range(len(dataset))))
+
+    def test_dataset_batches_held(self):
+        from keras.src.trainers.data_adapters.py_dataset_adapter import PyDatasetAdapter
+        qm=Sonia(pgen_model='humanTRB')
+        x=qm.encode_data(qm.generate_sequences_pre(int(4e3)))
+        y=(np.arange(x.shape[0])%3==0).astype(np.int8)
+        dataset=SoniaDataset(x,y,'unbalanced',256,seed=0)
+        order,bounds=dataset.epoch_plan(0)
+        # The mini-batches and their tensors are kept until all of them have been made.
+        planned=[x[order[bounds[i]:bounds[i+1]]].toarray() for i in range(len(dataset))]
+        batches=[dataset[i][0] for i in range(len(dataset))]
+        self.assertTrue(all(np.array_equal(b,p) for b,p in zip(batches,planned)))
+        tensors=[batch[0] for batch in PyDatasetAdapter(dataset).get_tf_dataset()]
+        self.assertTrue(all(np.array_equal(t.numpy(),p) for t,p in zip(tensors,planned)))
+
+    def test_linear_solver(self):
+        qm=Sonia(pgen_model='humanTRB',l2_reg=1e-3)
+        qm.update_model(add_data_seqs=qm.generate_sequences_pre(int(1e3)),add_gen_seqs=qm.generate_sequences_pre(int(3e3)))
+        initial_weights=qm.model.get_weights()
+        qm.infer_selection(solver='lbfgs',validation_split=0.1,seed=0,set_gauge=False)
+        lbfgs_weights=qm.model.get_weights()[0]
+        self.assertEqual(len(qm.L1_converge_history),len(qm.likelihood_train))
+        self.assertEqual(len(qm.likelihood_test),len(qm.likelihood_train))
+        qm.model.set_weights(initial_weights)
+        qm.infer_selection(solver='proximal',validation_split=0.1,seed=0,set_gauge=False)
+        self.assertTrue(np.allclose(qm.model.get_weights()[0],lbfgs_weights,atol=0.01))
+
+    def test_incremental_update(self):
+        qm=Sonia(pgen_model='humanTRB',deduplicate=True)
+        data_seqs,gen_seqs=qm.generate_sequences_pre(int(1e3)),qm.generate_sequences_pre(int(2e3))
+        full=Sonia(pgen_model='humanTRB',deduplicate=True,data_seqs=np.concatenate([data_seqs,data_seqs[:100]]),gen_seqs=gen_seqs)
+        qm.model.set_weights(full.model.get_weights())
+        for i in range(0,len(data_seqs),300): qm.update_model(add_data_seqs=data_seqs[i:i+300])
+        qm.update_model(add_data_seqs=data_seqs[:100])
+        for i in range(0,len(gen_seqs),700): qm.update_model(add_gen_seqs=gen_seqs[i:i+700])
+        self.assertEqual((full.data_encoding!=qm.data_encoding).nnz,0)
+        self.assertTrue(np.array_equal(full.data_seq_counts,qm.data_seq_counts))
+        self.assertTrue(np.allclose(full.data_marginals,qm.data_marginals))
+        self.assertTrue(np.allclose(full.model_marginals,qm.model_marginals))
+        qm.model.set_weights([np.random.default_rng(0).normal(size=(len(qm.features),1))])
+        qm.update_model(update_marginals=True)
+        self.assertFalse(np.allclose(full.model_marginals,qm.model_marginals))
+
+    def test_joint_training(self):
+        template=Sonia(pgen_model='humanTRB',l2_reg=1e-3)
+        template.update_model(add_gen_seqs=template.generate_sequences_pre(int(3e3)))
+        data_seqs=[template.generate_sequences_pre(int(1e3)) for _ in range(2)]
+        models=infer_selection_models(template,data_seqs,seed=0,validation_split=0.,set_gauge=False)
+        qm=Sonia(pgen_model='humanTRB',l2_reg=1e-3,data_seqs=data_seqs[1],gen_seqs=template.gen_seqs)
+        qm.infer_selection(solver='lbfgs',validation_split=0.,set_gauge=False)
+        self.assertTrue(np.allclose(models[1].model.get_weights()[0],qm.model.get_weights()[0],atol=0.01))
+        self.assertTrue(np.isclose(models[1].Z,qm.Z,rtol=0.01))
+        self.assertEqual(len(template.data_seqs),0)
+
+    def test_checkpoint(self):
+        qm=Sonia(pgen_model='humanTRB')
+        data_seqs,gen_seqs=qm.generate_sequences_pre(int(1e3)),qm.generate_sequences_pre(int(3e3))
+        qm.update_model(add_data_seqs=data_seqs,add_gen_seqs=gen_seqs)
+        initial_weights=qm.model.get_weights()
+        qm.infer_selection(epochs=3,batch_size=500,seed=0,set_gauge=False)
+        weights=qm.model.get_weights()
+        qm.update_model_structure(initialize=True)
+        qm.model.set_weights(initial_weights)
+        qm.infer_selection(epochs=2,batch_size=500,seed=0,set_gauge=False,checkpoint_dir='checkpoint_test',keep_checkpoints=1)
+        self.assertEqual(os.listdir('checkpoint_test'),['checkpoint_00002.npz'])
+        resumed=Sonia(pgen_model='humanTRB')
+        resumed.update_model(add_data_seqs=data_seqs,add_gen_seqs=gen_seqs)
+        resumed.infer_selection(epochs=3,batch_size=500,set_gauge=False,resume_from='checkpoint_test')
+        shutil.rmtree('checkpoint_test')
+        self.assertTrue(np.allclose(resumed.model.get_weights()[0],weights[0]))
+        self.assertEqual(len(resumed.likelihood_train),3)
+
     def test_evaluate(self):
         qm=Sonia(ppost_model='humanTRB')
         pre_seqs=qm.generate_sequences_pre(int(1e3))